@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from redis.exceptions import RedisError
+from sqlalchemy.orm import sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .config.db_config import create_database_engine
+from .config.env_config import envs
+from .config.redis_config import get_redis
+from .services.bulk_load import LoadCheckpoint, checkpoint_path, load_claim_file, rebuild_claim_aggregates
+from .models.spaceSavingSketch import SpaceSavingSketch
+from .services.ranking import RedisRanking, SketchRanking
+from .services.response_cache import bump_ranking_version
+
+
+def parse_args(args: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.bulk_load",
+        description="Load historical claim files (.csv, .ndjson) straight into the database, then rebuild "
+                    "the provider aggregates. An interrupted load resumes from its checkpoints when run again.",
+    )
+    parser.add_argument("files", nargs="+", help="claim files, loaded in order")
+    parser.add_argument("--workers", type=int, default=envs.BULK_LOAD_WORKERS,
+                        help="processes parsing the files, 0 for one per core")
+    parser.add_argument("--connections", type=int, default=envs.BULK_LOAD_CONNECTIONS,
+                        help="chunks written concurrently, each with its own connection")
+    parser.add_argument("--chunk-size", type=int, default=envs.BULK_LOAD_CHUNK_SIZE, help="lines per chunk")
+    parser.add_argument("--checkpoint-dir", default=".bulk_load", help="directory of the checkpoints and error logs")
+    parser.add_argument("--skip-aggregates", action="store_true",
+                        help="do not rebuild the aggregates, e.g. when more files are loaded afterwards")
+    return parser.parse_args(args)
+
+
+async def reset_rankings(redis_connection) -> None:
+    """
+    The function `reset_rankings` makes the rankings served by the API read the rebuilt aggregates: the
+    Redis sorted set and the shared sketch are seeded again, the cached responses are dropped and every
+    worker reloads the rankings it keeps in memory.
+    """
+    try:
+        await RedisRanking(redis_connection).unload()
+        await SketchRanking(SpaceSavingSketch(), redis_connection=redis_connection).reset_shared()
+        await bump_ranking_version(redis_connection, reset=True)
+    except RedisError as error:
+        print(f"Could not reset the rankings in Redis ({error}), they are stale until it is flushed")
+
+
+async def main(args: list[str]) -> None:
+    """
+    The function `main` loads claim files with `load_claim_file`, in a process pool of `--workers` and
+    over `--connections` connections, then rebuilds the aggregates once:
+
+        python -m app.bulk_load claims-2016.csv claims-2017.ndjson --workers 8 --connections 4
+    """
+    options = parse_args(args)
+    os.makedirs(options.checkpoint_dir, exist_ok=True)
+    engine = create_database_engine(envs.DATABASE_URL, "bulk_load")
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    workers = options.workers or os.cpu_count()
+    pool = ProcessPoolExecutor(workers)
+    try:
+        for path in options.files:
+            checkpoint = LoadCheckpoint(checkpoint_path(options.checkpoint_dir, path), path, options.chunk_size)
+            report = await load_claim_file(path, session_factory, pool, checkpoint,
+                                           connections=options.connections,
+                                           prefetch=2 * workers,
+                                           errors_path=f"{checkpoint.path}.errors.ndjson")
+            print(f"{path}: {json.dumps(report)}")
+        if not options.skip_aggregates:
+            async with session_factory() as session:
+                print(f"Rebuilt the aggregates of {await rebuild_claim_aggregates(session)} providers")
+            await reset_rankings(get_redis())
+    finally:
+        pool.shutdown(cancel_futures=True)
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))  # pragma: no cover
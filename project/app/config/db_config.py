@@ -1,17 +1,168 @@
-import os
+import logging
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlmodel import SQLModel, create_engine
 from sqlmodel.ext.asyncio.session import AsyncSession, AsyncEngine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from .env_config import envs
+from .metrics_config import (DB_POOL_CHECKED_IN, DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_SIZE,
+                             DB_POOL_WAIT_SECONDS, DB_READ_SESSIONS, DB_REPLICA_LAG_SECONDS)
 
-DATABASE_URL = os.environ.get("DATABASE_URL")
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = envs.DATABASE_URL
+DATABASE_READ_URL = envs.DATABASE_READ_URL
+
+# Replication lag of a postgres standby: none when it replayed everything it received, otherwise the age of
+# the last replayed transaction. A primary is never behind.
+REPLICA_LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    The class `InstrumentedPool` is the queue pool of the async engines, which also records how long
+    every checkout waited for a connection in the `db_pool_wait_seconds` histogram.
+    """
+
+    engine_name = "primary"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.labels(engine=self.engine_name).observe(time.perf_counter() - start)
+
+    def recreate(self):
+        # `dispose()` replaces the pool with a new one
+        pool = super().recreate()
+        pool.engine_name = self.engine_name
+        return pool
+
+
+def engine_options(url: str) -> dict:
+    """
+    The function `engine_options` returns the `create_engine` arguments of a database URL from the
+    `DATABASE_*` settings: pool size, overflow, timeout, recycle, pre-ping and the asyncpg statement
+    cache. sqlite keeps its default pool, which does not take those settings.
+    """
+    options = {"echo": envs.DATABASE_ECHO, "future": True}
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        return options
+    options.update(
+        poolclass=InstrumentedPool,
+        pool_size=envs.DATABASE_POOL_SIZE,
+        max_overflow=envs.DATABASE_MAX_OVERFLOW,
+        pool_timeout=envs.DATABASE_POOL_TIMEOUT,
+        pool_recycle=envs.DATABASE_POOL_RECYCLE,
+        pool_pre_ping=envs.DATABASE_POOL_PRE_PING,
+    )
+    if make_url(url).get_driver_name() == "asyncpg":
+        options["connect_args"] = {"statement_cache_size": envs.DATABASE_STATEMENT_CACHE_SIZE}
+    return options
+
+
+def create_database_engine(url: str, engine_name: str = "primary") -> AsyncEngine:
+    """
+    The function `create_database_engine` creates an async engine with the options of
+    `engine_options` and exports the state of its pool to Prometheus, labelled with `engine_name`. The
+    gauges read the pool when `/metrics` is scraped.
+    """
+    engine = AsyncEngine(create_engine(url, **engine_options(url)))
+    pool = engine.sync_engine.pool
+    if isinstance(pool, InstrumentedPool):
+        pool.engine_name = engine_name
+        # `engine.sync_engine.pool` is looked up on every scrape, the pool is replaced by `dispose()`
+        DB_POOL_SIZE.labels(engine=engine_name).set_function(lambda: engine.sync_engine.pool.size())
+        DB_POOL_CHECKED_OUT.labels(engine=engine_name).set_function(lambda: engine.sync_engine.pool.checkedout())
+        DB_POOL_CHECKED_IN.labels(engine=engine_name).set_function(lambda: engine.sync_engine.pool.checkedin())
+        DB_POOL_OVERFLOW.labels(engine=engine_name).set_function(lambda: max(engine.sync_engine.pool.overflow(), 0))
+    return engine
+
+
+# `engine` is the async engine of the worker, created once per process. Its pool keeps
+# `DATABASE_POOL_SIZE` connections open and opens up to `DATABASE_MAX_OVERFLOW` more under load; a request
+# waits at most `DATABASE_POOL_TIMEOUT` seconds for a connection. Statements are only logged with
+# `DATABASE_ECHO=true`.
+engine = create_database_engine(DATABASE_URL)
+
+# `async_session` is the session factory of the worker, built once and shared by every request.
+async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def replica_lag(session: AsyncSession) -> float:
+    """
+    The function `replica_lag` returns the replication lag of the database of `session` in seconds. Only
+    postgres replicates: the other databases (e.g. two sqlite files standing for a primary and a
+    replica in development) are never behind.
+    """
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        return 0.0
+    return float((await connection.execute(REPLICA_LAG_QUERY)).scalar())
+
+
+class ReadSessionRouter:
+    """
+    The class `ReadSessionRouter` picks the session factory of the read endpoints: the one of the read
+    replica while its replication lag is at most `max_lag` seconds, the one of the primary when it lags
+    further behind or cannot be reached. The lag is measured at most once every `check_interval` seconds
+    per worker, by the first read session requested after the interval.
+    """
+
+    def __init__(self, read_factory, primary_factory, max_lag: float = 5.0, check_interval: float = 1.0,
+                 probe=replica_lag):
+        """
+        :param read_factory: The session factory of the replica, the primary has no replica when it is
+        `primary_factory` itself
+        :param primary_factory: The session factory of the primary
+        :param max_lag: The replication lag in seconds beyond which the primary is read instead
+        :param check_interval: The number of seconds a measured lag is trusted
+        :param probe: A coroutine function returning the lag of the database of a session
+        """
+        self.read_factory = read_factory
+        self.primary_factory = primary_factory
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.probe = probe
+        self.checked_at = None
+        self.stale = False
+
+    async def use_replica(self) -> bool:
+        if self.read_factory is self.primary_factory:
+            return False
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.check_interval:
+            # set first, so that the concurrent requests keep the last result instead of probing too
+            self.checked_at = now
+            try:
+                async with self.read_factory() as session:
+                    lag = await self.probe(session)
+                DB_REPLICA_LAG_SECONDS.set(lag)
+                self.stale = lag > self.max_lag
+            except (OSError, SQLAlchemyError):
+                logger.warning("Could not measure the lag of the read replica, reading the primary", exc_info=True)
+                self.stale = True
+        return not self.stale
+
+    async def session_factory(self):
+        """
+        The function `session_factory` returns the factory of the next read session, the replica one
+        unless it is stale.
+        """
+        if await self.use_replica():
+            DB_READ_SESSIONS.labels(engine="read").inc()
+            return self.read_factory
+        DB_READ_SESSIONS.labels(engine="primary").inc()
+        return self.primary_factory
 
-# The line `engine = AsyncEngine(create_engine(DATABASE_URL, echo=True, future=True))` is creating an
-# asynchronous engine for interacting with the database. Here's what each part of the line is doing:
-# - `create_engine(DATABASE_URL, echo=True, future=True)`: This function creates an engine using the
-#   `DATABASE_URL` environment variable as the connection string. The `echo=True` parameter enables
-#   logging of SQL queries, and the `future=True` parameter enables the use of SQLAlchemy's async
-#   capabilities.
-engine = AsyncEngine(create_engine(DATABASE_URL, echo=True, future=True))
 
 async def init_db():
     """
@@ -25,11 +176,30 @@ async def init_db():
 
 async def get_session() -> AsyncSession:
     """
-    The function `get_session` returns an asynchronous session using `AsyncSession` class with a context
-    manager. The session is created using the `sessionmaker` function from `sqlalchemy.orm` module.
+    The function `get_session` yields an asynchronous session of the `async_session` factory, closed
+    (and its connection given back to the pool) once the request is done.
     """
-    async_session = sessionmaker(
-        engine, class_=AsyncSession, expire_on_commit=False
-    )
     async with async_session() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+# `read_engine` is the engine of the read replica of `DATABASE_READ_URL`, with its own pool sized like the one
+# of the primary, and `read_router` sends the read endpoints to it while it is up to date. Without a replica
+# they share `engine`.
+has_replica = DATABASE_READ_URL != DATABASE_URL
+read_engine = create_database_engine(DATABASE_READ_URL, "read") if has_replica else engine
+async_read_session = (sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+                      if has_replica else async_session)
+read_router = ReadSessionRouter(async_read_session, async_session, max_lag=envs.DATABASE_READ_MAX_LAG,
+                                check_interval=envs.DATABASE_READ_LAG_CHECK_INTERVAL)
+
+
+async def get_read_session() -> AsyncSession:
+    """
+    The function `get_read_session` yields a session of the read replica, or of the primary when there is
+    no replica or when `read_router` found it too far behind. The read endpoints use it, so that their
+    queries do not take the connections of the primary from the ingest.
+    """
+    session_factory = await read_router.session_factory()
+    async with session_factory() as session:
+        yield session
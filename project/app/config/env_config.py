@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 from dotmap import DotMap
 
@@ -9,6 +10,99 @@ envs = {
     "ENVIRONMENT": os.getenv("ENVIRONMENT", "local"),
     "LOG_LEVEL": os.getenv("LOG_LEVEL", "INFO"),
     "DATABASE_URL": os.getenv("DATABASE_URL", "postgresql+asyncpg://postgres:postgres@db:5432/foo"),
+    # read replica used by the read endpoints, none when it is DATABASE_URL, and the replication lag in seconds
+    # beyond which they read the primary again, measured every DATABASE_READ_LAG_CHECK_INTERVAL seconds
+    "DATABASE_READ_URL": os.getenv("DATABASE_READ_URL",
+                                   os.getenv("DATABASE_URL", "postgresql+asyncpg://postgres:postgres@db:5432/foo")),
+    "DATABASE_READ_MAX_LAG": float(os.getenv("DATABASE_READ_MAX_LAG", "5")),
+    "DATABASE_READ_LAG_CHECK_INTERVAL": float(os.getenv("DATABASE_READ_LAG_CHECK_INTERVAL", "1")),
+    "REDIS_URL": os.getenv("REDIS_URL", "redis://redis:6379"),
+    # log every SQL statement, for debugging only
+    "DATABASE_ECHO": os.getenv("DATABASE_ECHO", "false").lower() == "true",
+    # connections kept open by the pool of each worker, and extra ones opened under load
+    "DATABASE_POOL_SIZE": int(os.getenv("DATABASE_POOL_SIZE", "10")),
+    "DATABASE_MAX_OVERFLOW": int(os.getenv("DATABASE_MAX_OVERFLOW", "20")),
+    # seconds a request waits for a free connection before failing
+    "DATABASE_POOL_TIMEOUT": float(os.getenv("DATABASE_POOL_TIMEOUT", "30")),
+    # seconds after which a connection is replaced, -1 to keep connections forever
+    "DATABASE_POOL_RECYCLE": int(os.getenv("DATABASE_POOL_RECYCLE", "1800")),
+    # test connections with a round trip when they are checked out of the pool
+    "DATABASE_POOL_PRE_PING": os.getenv("DATABASE_POOL_PRE_PING", "true").lower() == "true",
+    # prepared statements cached per asyncpg connection, 0 behind pgbouncer in transaction mode
+    "DATABASE_STATEMENT_CACHE_SIZE": int(os.getenv("DATABASE_STATEMENT_CACHE_SIZE", "100")),
+    # months of claim partitions created ahead of the current one, and seconds between two checks
+    "CLAIM_PARTITIONS_AHEAD": int(os.getenv("CLAIM_PARTITIONS_AHEAD", "3")),
+    "CLAIM_PARTITION_MAINTENANCE_INTERVAL": float(os.getenv("CLAIM_PARTITION_MAINTENANCE_INTERVAL", "3600")),
+    # number of claims sent in one multi-row INSERT statement of a /claims batch
+    "CLAIMS_INSERT_CHUNK_SIZE": int(os.getenv("CLAIMS_INSERT_CHUNK_SIZE", "1000")),
+    # batches with at least this many claims are written with COPY instead of INSERT (postgres only)
+    "CLAIMS_COPY_THRESHOLD": int(os.getenv("CLAIMS_COPY_THRESHOLD", "5000")),
+    # lines of a claim file per chunk of the bulk loader, chunks written concurrently, and parsing
+    # processes (0 for one per core), see `python -m app.bulk_load`
+    "BULK_LOAD_CHUNK_SIZE": int(os.getenv("BULK_LOAD_CHUNK_SIZE", "10000")),
+    "BULK_LOAD_CONNECTIONS": int(os.getenv("BULK_LOAD_CONNECTIONS", "4")),
+    "BULK_LOAD_WORKERS": int(os.getenv("BULK_LOAD_WORKERS", "0")),
+    # number of claims of an uploaded file validated and committed together by /claims/upload
+    "UPLOAD_CHUNK_SIZE": int(os.getenv("UPLOAD_CHUNK_SIZE", "1000")),
+    # maximum number of line errors listed in the /claims/upload report
+    "UPLOAD_MAX_ERRORS": int(os.getenv("UPLOAD_MAX_ERRORS", "1000")),
+    # limits of the request bodies sent with `Content-Encoding: gzip|zstd`: decompressed size in bytes, and
+    # ratio of the decompressed to the compressed size, past which the request is rejected with a 413
+    "REQUEST_MAX_DECOMPRESSED_BYTES": int(os.getenv("REQUEST_MAX_DECOMPRESSED_BYTES", "268435456")),
+    "REQUEST_MAX_COMPRESSION_RATIO": float(os.getenv("REQUEST_MAX_COMPRESSION_RATIO", "200")),
+    # responses of at least GZIP_MINIMUM_SIZE bytes are gzipped at GZIP_COMPRESS_LEVEL for the clients accepting it
+    "GZIP_MINIMUM_SIZE": int(os.getenv("GZIP_MINIMUM_SIZE", "1024")),
+    "GZIP_COMPRESS_LEVEL": int(os.getenv("GZIP_COMPRESS_LEVEL", "5")),
+    # maximum number of distinct providers whose running net fee total is kept in memory
+    "TOP_PROVIDER_CAPACITY": int(os.getenv("TOP_PROVIDER_CAPACITY", "1000000")),
+    # store ranking the top providers: "memory" (per worker priority queue), "redis" (shared sorted set)
+    # or "database" (provider_totals table)
+    "RANKING_BACKEND": os.getenv("RANKING_BACKEND", "memory"),
+    # counters of the approximate ranking of /top-provider?mode=approx, its memory is fixed by this number
+    "RANKING_SKETCH_CAPACITY": int(os.getenv("RANKING_SKETCH_CAPACITY", "10000")),
+    # where the approximate ranking is shared between the workers: "redis", or "off" for a sketch per worker
+    "RANKING_SKETCH_SHARING": os.getenv("RANKING_SKETCH_SHARING", "redis"),
+    # seconds between two publications of the sketch of a worker, for the other workers to merge
+    "RANKING_SKETCH_PUBLISH_INTERVAL": float(os.getenv("RANKING_SKETCH_PUBLISH_INTERVAL", "1")),
+    # where the `memory` ranking is snapshotted and restored from at startup: "redis", a file path, or "off"
+    "RANKING_SNAPSHOT": os.getenv("RANKING_SNAPSHOT", "redis"),
+    # seconds between two snapshots, taken by a single worker
+    "RANKING_SNAPSHOT_INTERVAL": float(os.getenv("RANKING_SNAPSHOT_INTERVAL", "60")),
+    # largest `n` accepted by /top-provider and /top/{dimension}
+    "TOP_N_MAX": int(os.getenv("TOP_N_MAX", "100")),
+    # maximum number of claims of a page of GET /claims
+    "CLAIMS_QUERY_MAX_LIMIT": int(os.getenv("CLAIMS_QUERY_MAX_LIMIT", "1000")),
+    # maximum number of claims of a page of /claims/feed
+    "FEED_MAX_LIMIT": int(os.getenv("FEED_MAX_LIMIT", "10000")),
+    # maximum number of seconds /claims/feed waits for new claims, and interval between two checks
+    "FEED_MAX_WAIT": float(os.getenv("FEED_MAX_WAIT", "30")),
+    "FEED_POLL_INTERVAL": float(os.getenv("FEED_POLL_INTERVAL", "0.5")),
+    # seconds a /top-provider or /top/{dimension} response is cached, a committed batch invalidates it
+    "TOP_CACHE_TTL": int(os.getenv("TOP_CACHE_TTL", "300")),
+    # seconds the other workers wait for the one computing a missing ranking before computing it too
+    "TOP_CACHE_LOCK_TIMEOUT": float(os.getenv("TOP_CACHE_LOCK_TIMEOUT", "10")),
+    # default response_mode of /claims: "full" (stored claims), "ids" (ids and net fees) or "none" (counts)
+    "CLAIMS_RESPONSE_MODE": os.getenv("CLAIMS_RESPONSE_MODE", "full"),
+    # requests per client to the ranking endpoints, and claims per client to /claims, per window of seconds
+    "TOP_RATE_LIMIT_TIMES": int(os.getenv("TOP_RATE_LIMIT_TIMES", "10")),
+    "TOP_RATE_LIMIT_SECONDS": float(os.getenv("TOP_RATE_LIMIT_SECONDS", "60")),
+    "CLAIMS_RATE_LIMIT_CLAIMS": int(os.getenv("CLAIMS_RATE_LIMIT_CLAIMS", "1000000")),
+    "CLAIMS_RATE_LIMIT_SECONDS": float(os.getenv("CLAIMS_RATE_LIMIT_SECONDS", "60")),
+    # seconds between two syncs of the in-process rate limits with Redis, and pending usage forcing one
+    "RATE_LIMIT_SYNC_INTERVAL": float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", "1")),
+    "RATE_LIMIT_SYNC_BATCH": int(os.getenv("RATE_LIMIT_SYNC_BATCH", "100")),
+    # number of seconds the response of a /claims request sent with an Idempotency-Key is replayed
+    "IDEMPOTENCY_KEY_TTL": int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400")),
+    # "sync" writes the claims of /claims in the request, "async" queues them for the ingest worker
+    "INGEST_MODE": os.getenv("INGEST_MODE", "sync"),
+    # maximum number of queued claims the ingest worker writes in one transaction
+    "INGEST_WORKER_MAX_CLAIMS": int(os.getenv("INGEST_WORKER_MAX_CLAIMS", "10000")),
+    # number of times the ingest worker tries a batch before moving it to the dead-letter list
+    "INGEST_MAX_ATTEMPTS": int(os.getenv("INGEST_MAX_ATTEMPTS", "5")),
+    # number of seconds the status of a queued batch is kept
+    "INGEST_STATUS_TTL": int(os.getenv("INGEST_STATUS_TTL", "86400")),
+    # name of the ingest worker, unique among the running workers (defaults to the host name)
+    "INGEST_WORKER_NAME": os.getenv("INGEST_WORKER_NAME", socket.gethostname()),
 }
 
 
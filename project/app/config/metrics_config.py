@@ -0,0 +1,73 @@
+import time
+from contextlib import contextmanager
+from opentelemetry import trace
+from prometheus_client import Counter, Gauge, Histogram
+
+# Metrics of the application exported by `/metrics`, registered on the default Prometheus registry next
+# to the HTTP metrics of `prometheus_fastapi_instrumentator`.
+
+# Connection pools of the database engines, labelled with the name of the engine.
+DB_POOL_SIZE = Gauge("db_pool_size", "Connections kept open by the pool", ["engine"])
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections currently in use", ["engine"])
+DB_POOL_CHECKED_IN = Gauge("db_pool_checked_in", "Idle connections in the pool", ["engine"])
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "Connections opened beyond the pool size", ["engine"])
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time spent waiting for a connection of the pool", ["engine"],
+                                 buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+# Replication lag of the read replica as last measured, and read sessions per target engine (read/primary).
+DB_REPLICA_LAG_SECONDS = Gauge("db_replica_lag_seconds", "Replication lag of the read replica")
+DB_READ_SESSIONS = Counter("db_read_sessions", "Read sessions handed out, per engine", ["engine"])
+
+# Decisions of the rate limiter per route (allowed/limited), and duration of its syncs with Redis.
+RATE_LIMIT_DECISIONS = Counter("rate_limit_decisions", "Requests checked by the rate limiter", ["route", "result"])
+RATE_LIMIT_SYNC_SECONDS = Histogram("rate_limit_sync_seconds", "Time spent syncing the rate limits with Redis",
+                                    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+
+# Bytes of the compressed request bodies as received and once decompressed, per content encoding.
+REQUEST_BODY_BYTES = Counter("request_body_bytes", "Bytes of the compressed request bodies", ["encoding", "side"])
+
+# Claims received per batch: a /claims request, a chunk of /claims/upload or a group written by the ingest worker.
+CLAIMS_BATCH_SIZE = Histogram("claims_batch_size", "Number of claims per ingested batch", ["source"],
+                              buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000))
+# Time spent per stage of /claims: validation, net_fee, db_write and aggregator_update.
+CLAIMS_INGEST_STAGE_SECONDS = Histogram("claims_ingest_stage_seconds", "Time spent per stage of a /claims batch", ["stage"],
+                                        buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+# /top-provider and /top/{dimension}: `layer="response"` counts the responses served by the response cache
+# (hit), computed (miss) or computed by a concurrent request and waited for (coalesced), `layer="ranking"` the
+# rankings served by a loaded backend (hit) or after loading it from the database (miss), `layer="sketch"` the
+# same for the approximate ranking.
+TOP_N_CACHE = Counter("top_n_cache_total", "Cache hits and misses of the top N rankings", ["layer", "result"])
+# Time spent computing a ranking, per source: ranking backend, daily buckets, rollup, claims or sketch.
+TOP_N_SECONDS = Histogram("top_n_seconds", "Time spent computing a top N ranking", ["source"],
+                          buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+# The in-process `TopNPriorityQueue` of the worker.
+TOP_N_PROVIDERS = Gauge("top_n_aggregator_providers", "Providers tracked by the in-process top N aggregator")
+TOP_N_MEMORY_BYTES = Gauge("top_n_aggregator_memory_bytes", "Estimated memory used by the in-process top N aggregator")
+# Bound of the error of every total of the approximate ranking, merged over the sketches of all the workers.
+TOP_N_SKETCH_ERROR_BOUND = Gauge("top_n_sketch_error_bound", "Error bound of the merged approximate ranking")
+
+
+class StageTimer:
+    """
+    The class `StageTimer` measures the stages of the processing of a batch. `stage(name)` is a context
+    manager adding the time spent in its block to the stage, `record` exports every stage once to the
+    `claims_ingest_stage_seconds` histogram and as `claims.<stage>_ms` attributes of the current span.
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - start
+
+    def record(self) -> None:
+        span = trace.get_current_span()
+        for name, seconds in self.durations.items():
+            CLAIMS_INGEST_STAGE_SECONDS.labels(stage=name).observe(seconds)
+            span.set_attribute(f"claims.{name}_ms", round(seconds * 1000, 3))
+
@@ -0,0 +1,24 @@
+import redis.asyncio as redis
+from .env_config import envs
+
+# The line `redis_connection = redis.from_url(...)` creates the Redis client shared by the rate limiter,
+# the response cache and the ranking backend of this worker. The client connects lazily, on its first
+# command, and pools its connections. `decode_responses=True` indicates that responses from Redis should
+# be decoded as UTF-8 strings.
+redis_connection = redis.from_url(envs.REDIS_URL, encoding="utf-8", decode_responses=True)
+# Client for the binary values, e.g. the ranking snapshot, whose responses are left as bytes.
+binary_redis_connection = redis.from_url(envs.REDIS_URL)
+
+
+def get_redis() -> redis.Redis:
+    """
+    The function `get_redis` returns the Redis client shared by the worker.
+    """
+    return redis_connection
+
+
+def get_binary_redis() -> redis.Redis:
+    """
+    The function `get_binary_redis` returns the Redis client of the worker that does not decode responses.
+    """
+    return binary_redis_connection
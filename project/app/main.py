@@ -1,23 +1,45 @@
-import os
+import asyncio
+import logging
+import time
 import uvicorn
-from fastapi import Request, Response
-from sqlmodel import select
+from urllib.parse import urlencode
+from datetime import date, datetime, timedelta
+from typing import Optional
+from fastapi import HTTPException, Path, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.exceptions import RequestValidationError
 from sqlmodel.ext.asyncio.session import AsyncSession
-from .config.db_config import get_session
-from .models.models import Claim, ClaimCreate, ClaimTopProvider
-from sqlalchemy.sql import func
-from sqlalchemy import desc
+from .config.db_config import async_session, get_read_session, get_session
+from .config.env_config import envs
+from .models.models import ClaimCreate, RankDimension
 # open telelemetry
 from .config.otlp_config import instrument_tracing
+from opentelemetry import trace
 from prometheus_fastapi_instrumentator import Instrumentator
 from prometheus_client import generate_latest, REGISTRY, CONTENT_TYPE_LATEST
+from .config.metrics_config import (CLAIMS_BATCH_SIZE, TOP_N_CACHE, TOP_N_MEMORY_BYTES, TOP_N_PROVIDERS,
+                                    TOP_N_SECONDS, TOP_N_SKETCH_ERROR_BOUND, StageTimer)
+from .models.spaceSavingSketch import SpaceSavingSketch
 from .models.topNPriorityQueue import TopNPriorityQueue
+from .services.claim_ingest import assign_content_hashes, fetch_claim_ids, ingest_claims, reserve_claim_ids
+from .services.ingest_queue import enqueue_claims, get_batch_status
+from .services.idempotency import (IdempotencyKeyReused, get_idempotent_response, request_fingerprint,
+                                   save_idempotent_response)
+from .services.claim_columns import validate_claim_columns
+from .services.ranking import InProcessRanking, SketchRanking, create_ranking_backend, fetch_top_by_dimension, fetch_top_providers_in_window
+from .services.claim_upload import detect_format, ingest_upload
+from .services.claim_feed import format_feed_cursor, parse_feed_cursor, stream_feed, wait_for_feed_cursor
+from .services.claim_query import parse_fields, query_claims
+from .services.response_cache import RankingResponseCache
+from .services.ranking_snapshot import create_snapshot_store, restore_snapshot, run_snapshots
+from .services.claim_partitions import run_partition_maintenance
+from .services.provider_stats import fetch_provider_stats
 # redis for rate limiter and caching
-import redis.asyncio as redis
+from .config.redis_config import get_binary_redis, get_redis
+from .services.rate_limit import RateLimit, RateLimiter
+from .services.request_compression import RequestDecompressionMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi import Depends, FastAPI
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
-from fastapi_redis_cache import FastApiRedisCache, cache
 
 
 app = FastAPI()
@@ -25,41 +47,86 @@ app = FastAPI()
 Instrumentator().instrument(app)
 # instrument opentelemetry tracing
 instrument_tracing(app)
+# Request bodies sent with `Content-Encoding: gzip` or `zstd` (e.g. large `/claims` batches and
+# `/claims/upload` files) are decompressed as they stream in, within `REQUEST_MAX_DECOMPRESSED_BYTES` and
+# `REQUEST_MAX_COMPRESSION_RATIO`, and responses are gzipped for the clients sending `Accept-Encoding: gzip`.
+app.add_middleware(RequestDecompressionMiddleware, max_size=envs.REQUEST_MAX_DECOMPRESSED_BYTES,
+                   max_ratio=envs.REQUEST_MAX_COMPRESSION_RATIO)
+app.add_middleware(GZipMiddleware, minimum_size=envs.GZIP_MINIMUM_SIZE, compresslevel=envs.GZIP_COMPRESS_LEVEL)
 
 # The `@app.on_event("startup")` decorator in FastAPI is used to register a startup event handler
 # function that will be executed when the application starts up. In the provided code snippet, the
-# `startup()` function is an event handler that establishes a connection to a Redis server using the
-# URL provided in the `REDIS_URL` environment variable. It also initializes FastAPI Limiter with the
-# Redis connection and sets up a FastAPI Redis cache for caching responses.
+# `startup()` function is an event handler that starts following the invalidations of the ranking
+# response cache, the syncs of the rate limits with Redis, the maintenance of the claim partitions, and
+# warm starts the in-process ranking.
 @app.on_event("startup")
 async def startup():
+    app.state.background_tasks = [asyncio.create_task(top_cache.listen()), asyncio.create_task(rate_limiter.run())]
+    # creates the monthly partitions of `claim` before claims of their month come in
+    app.state.background_tasks.append(asyncio.create_task(
+        run_partition_maintenance(async_session, envs.CLAIM_PARTITION_MAINTENANCE_INTERVAL, envs.CLAIM_PARTITIONS_AHEAD)))
 
-    redisUrl = os.environ.get("REDIS_URL")
-   # The code snippet `redis_connection = redis.from_url(redisUrl, encoding="utf-8",
-   # decode_responses=True)` is establishing a connection to a Redis server using the URL provided in
-   # the `redisUrl` environment variable. The `encoding="utf-8"` parameter specifies the encoding to
-   # be used for the connection, and `decode_responses=True` indicates that responses from Redis
-   # should be decoded as UTF-8 strings.
-    redis_connection = redis.from_url(redisUrl, encoding="utf-8", decode_responses=True)
-    await FastAPILimiter.init(redis_connection)
-    
-    # The code snippet is initializing a FastAPI Redis cache
-    redis_cache = FastApiRedisCache()
-    redis_cache.init(
-        host_url=redisUrl,
-        prefix="myapi-cache",
-        response_header="X-MyAPI-Cache",
-        ignore_arg_types=[Request, Response, AsyncSession]
-    )
-
-
-# `pq = TopNPriorityQueue(n=10)` is initializing a priority queue data structure with a maximum size
-# of 10. This priority queue, represented by the variable `pq`, will maintain the top N elements based
-# on a specific priority criterion. In this case, it is used to keep track of the top providers based
-# on their net fees in the given FastAPI application. The priority queue will ensure that only the top
-# 10 providers with the highest net fees are retained, discarding any additional elements beyond this
-# limit.
-pq = TopNPriorityQueue(n=10)
+    # The in-process ranking is restored from the last snapshot plus the claims committed since, so a
+    # restarted worker does not read every provider total on its first `/top-provider`. Snapshots are
+    # then taken every `RANKING_SNAPSHOT_INTERVAL` seconds by one of the workers.
+    store = create_snapshot_store(envs.RANKING_SNAPSHOT, get_binary_redis())
+    if isinstance(ranking, InProcessRanking) and store is not None:
+        try:
+            async with async_session() as session:
+                await restore_snapshot(ranking, session, store)
+        except Exception:
+            logging.exception("Could not restore the ranking snapshot, the ranking is loaded on first use")
+        app.state.background_tasks.append(
+            asyncio.create_task(run_snapshots(store, async_session, envs.RANKING_SNAPSHOT_INTERVAL)))
+    # a shared approximate ranking counts the claims of the worker from its start, and publishes them
+    if approx_ranking.redis is not None:
+        app.state.background_tasks.append(
+            asyncio.create_task(approx_ranking.run(async_session, envs.RANKING_SKETCH_PUBLISH_INTERVAL)))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+    try:
+        await approx_ranking.retire()
+    except Exception:
+        logging.exception("Could not fold the ranking sketch of the worker into the shared one")
+
+
+# `pq = TopNPriorityQueue(n=10, capacity=...)` is initializing the in-process aggregator of the top
+# providers. It keeps the running sum of the net fees of every provider in an indexed max-heap, so each
+# ingested claim moves its provider in O(log P) and the top 10 are read in O(n log n). At most
+# `TOP_PROVIDER_CAPACITY` providers are kept in memory, the ones with the lowest totals being evicted, and
+# the rankings that evictions may have made wrong are read from `provider_totals`.
+pq = TopNPriorityQueue(n=10, capacity=envs.TOP_PROVIDER_CAPACITY)
+# size of the in-process aggregator, read at every scrape of `/metrics`
+TOP_N_PROVIDERS.set_function(lambda: len(pq))
+TOP_N_MEMORY_BYTES.set_function(lambda: pq.memory_bytes())
+# `ranking` is the store `/top-provider` reads from, selected by `RANKING_BACKEND`: `memory` ranks with
+# the `pq` of this worker, `redis` with a sorted set shared by all the workers.
+ranking = create_ranking_backend(envs.RANKING_BACKEND, pq, get_redis())
+# `approx_ranking` answers `/top-provider?mode=approx` from a Space-Saving sketch of `RANKING_SKETCH_CAPACITY`
+# counters, whose memory does not grow with the number of providers. With `RANKING_SKETCH_SHARING=redis` the
+# sketches of the workers are published to Redis and merged by every ranking.
+approx_ranking = SketchRanking(SpaceSavingSketch(envs.RANKING_SKETCH_CAPACITY),
+                               redis_connection=get_binary_redis() if envs.RANKING_SKETCH_SHARING == "redis" else None)
+# `top_cache` caches the responses of `/top-provider` and `/top/{dimension}` in Redis per version of the
+# rankings, which every committed batch bumps.
+top_cache = RankingResponseCache(get_redis(), ttl=envs.TOP_CACHE_TTL, lock_timeout=envs.TOP_CACHE_LOCK_TIMEOUT)
+# the rankings kept in the worker are loaded again from the database once reset, e.g. by a bulk load
+top_cache.reset_handlers.append(approx_ranking.unload)
+if isinstance(ranking, InProcessRanking):
+    top_cache.reset_handlers.append(ranking.unload)
+# `rate_limiter` admits the requests with in-process token buckets and syncs the usage of every client with
+# Redis in the background (`rate_limiter.run`, started at startup) every `RATE_LIMIT_SYNC_INTERVAL` seconds or
+# `RATE_LIMIT_SYNC_BATCH` units, so a request never waits for Redis. `get_redis()` returns the Redis
+# client shared by the worker (see `config/redis_config.py`).
+rate_limiter = RateLimiter(get_redis(), sync_interval=envs.RATE_LIMIT_SYNC_INTERVAL, sync_batch=envs.RATE_LIMIT_SYNC_BATCH)
+# requests per client to the ranking endpoints
+top_rate_limit = RateLimit(rate_limiter, envs.TOP_RATE_LIMIT_TIMES, envs.TOP_RATE_LIMIT_SECONDS)
+# claims per client to `/claims`, each claim of a batch costing one unit
+claims_rate_limit = RateLimit(rate_limiter, envs.CLAIMS_RATE_LIMIT_CLAIMS, envs.CLAIMS_RATE_LIMIT_SECONDS, route="/claims")
 
 @app.get("/hello")
 async def hello():
@@ -76,75 +143,338 @@ async def get_metrics():
     return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
 
 
-@app.post("/claims")
-async def add_multiple_claims(claims: list[ClaimCreate], session: AsyncSession = Depends(get_session)):
+# The request body of `/claims` is validated by `validate_claim_columns` instead of FastAPI, so its
+# schema is declared here for the API docs.
+CLAIMS_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"type": "array", "items": ClaimCreate.schema()}}},
+    }
+}
+
+@app.post("/claims", openapi_extra=CLAIMS_REQUEST_BODY, response_class=ORJSONResponse)
+async def add_multiple_claims(request: Request,
+                              mode: Optional[str] = Query(None, pattern="^(sync|async)$"),
+                              response_mode: Optional[str] = Query(None, pattern="^(full|ids|none)$"),
+                              session: AsyncSession = Depends(get_session)):
     """
     The function `add_multiple_claims` in a Python FastAPI app adds multiple claims to a database and
     calculates the net fee for each claim.
     
-    :param claims: The `claims` parameter in the `add_multiple_claims` endpoint is a list of
-    `ClaimCreate` objects. Each `ClaimCreate` object represents a claim with the following attributes:
-    :type claims: list[ClaimCreate]
+    :param request: The incoming request whose JSON body is a list of claims with the attributes of
+    `ClaimCreate`. The batch is validated column by column by `validate_claim_columns`, with the rules
+    of `ClaimCreate`, and rejected with a 422 listing the errors of every invalid claim. An optional
+    `Idempotency-Key` header makes retries of the request return the response of the first attempt for
+    `IDEMPOTENCY_KEY_TTL` seconds; the key cannot be reused with another body (422).
+    :type request: Request
     :param session: The `session` parameter in the `add_multiple_claims` function is an instance of an
     AsyncSession. It is used to interact with the database to add new Claim records. The `session`
     object allows you to perform database operations like adding, committing, and refreshing objects
     within an asynchronous context
     :type session: AsyncSession
-    :return: The function `add_multiple_claims` is an endpoint that receives a list of `ClaimCreate`
-    objects, creates new `Claim` objects based on the data provided in each `ClaimCreate` object, saves
-    them to the database using the provided session, and then returns a list of the newly created
-    `Claim` objects. The net fee for each claim is calculated as the sum of the provider fees, member
-    co-pay, and member co-insurance, minus the allowed fees.
-    """
-    claimsResp = []
-    for claim in claims:
-        claim = Claim(service_dttm = claim.service_dttm,
-                      submitted_proc=claim.submitted_proc,
-                      group_id=claim.group_id,
-                      subscriber_id=claim.subscriber_id,
-                      provider_npi=claim.provider_npi,
-                      provider_fees=claim.provider_fees,
-                      allowed_fees=claim.allowed_fees,
-                      member_co_ins=claim.member_co_ins,
-                      member_co_pay=claim.member_co_pay,
-                      quadrant=claim.quadrant,
-                      net_fee=claim.provider_fees + claim.member_co_pay + claim.member_co_ins - claim.allowed_fees)
-        # The code snippet `session.add(claim)`, `await session.commit()`, `await
-        # session.refresh(claim)`, `claimsResp.append(claim)`, and
-        # `pq.push(ClaimTopProvider(claim.provider_npi, claim.net_fee))` in the `add_multiple_claims`
-        # function is performing the following tasks:
-        # 1. Adding the newly created `Claim` object to the session.
-        session.add(claim)
-         # 2. Committing the transaction to save the `Claim` object to the database.
-        await session.commit()
-        # 3. Refreshing the `Claim` object to reflect any changes made during the commit.
-        await session.refresh(claim)
-         # 4. Appending the newly created `Claim` object to the `claimsResp` list.
-        claimsResp.append(claim)
-         # 5. Pushing a `ClaimTopProvider` object with the provider NPI and net fee to the priority queue
-        pq.push(ClaimTopProvider(claim.provider_npi, claim.net_fee))
-      
-    return claimsResp
-
-@app.get("/top-provider", dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-# The `@cache(expire=60)` decorator in the FastAPI endpoint function `get_top_provider` is
-# implementing caching functionality for the corresponding endpoint. Here's what it does:
-# - The `cache(expire=60)` decorator is used to cache the response of the `get_top_provider` endpoint
-# for 60 seconds. This means that the response will be stored in the cache for 60 seconds, and if the
-# same request is made within that time frame, the cached response will be returned instead of
-# re-executing the endpoint logic.
-@cache(expire=60)
-async def get_top_provider(request: Request, response: Response, session: AsyncSession = Depends(get_session)):
-    """
-    This function retrieves the top 10 providers based on net fee either from cache or by querying the
-    database if the cache is empty.
-
-     The `dependencies=[Depends(RateLimiter(times=10, seconds=60))` part in the
-     FastAPI endpoint decorator is implementing rate limiting functionality for
-     the corresponding endpoint. Here's what it does:
-     - The `RateLimiter(times=10, seconds=60)` dependency is used to limit the rate of requests to the
-     endpoint. It allows a maximum of 10 requests per 60 seconds. If the rate limit is exceeded, the
-     endpoint will return a 429 Too Many Requests response.
+    :param mode: "sync" (the default, see `INGEST_MODE`) stores the claims before answering, "async"
+    reserves their ids from the `claim` sequence, queues them for the ingest worker (`python -m
+    app.worker`) and answers 202 with the batch id, the claim ids and their net fees. The progress of
+    the batch is then read from `/claims/batches/{batch_id}`. Claim ids can only be reserved on
+    postgres: on other databases "async" stores the claims like "sync".
+    :type mode: Optional[str]
+    :param response_mode: What the response holds (`CLAIMS_RESPONSE_MODE` by default): "full" every
+    stored claim, "ids" the id and net fee of every claim, in the order of the request, "none" only the
+    counts of claims, inserted claims and duplicates. The response is serialized with orjson.
+    :type response_mode: Optional[str]
+    :return: The function `add_multiple_claims` is an endpoint that receives a list of claims, validates
+    them and computes the net fee of every claim in a single vectorized pass, saves the whole batch to
+    the database in a single transaction using the provided session, and then returns the stored claims
+    with their generated ids. The net fee for each claim is calculated as the sum of the provider fees,
+    member co-pay, and member co-insurance, minus the allowed fees.
+    """
+    # A retry of a request sent with an `Idempotency-Key` header gets the response of the first attempt
+    # back, without the batch being validated nor written again.
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        fingerprint = request_fingerprint(await request.body())
+        try:
+            stored = await get_idempotent_response(session, idempotency_key, fingerprint, envs.IDEMPOTENCY_KEY_TTL)
+        except IdempotencyKeyReused as error:
+            raise HTTPException(status_code=422, detail=str(error))
+        if stored is not None:
+            return Response(content=stored.response, status_code=stored.status_code, media_type="application/json",
+                            headers={"Idempotent-Replayed": "true"})
+
+    # Every stage (validation, net_fee, db_write, aggregator_update) is exported to the
+    # `claims_ingest_stage_seconds` histogram and as an attribute of the request span.
+    claims = await read_claims_body(request)
+    await claims_rate_limit.hit(request, cost=len(claims))
+    CLAIMS_BATCH_SIZE.labels(source="claims").observe(len(claims))
+    trace.get_current_span().set_attribute("claims.batch_size", len(claims))
+    timer = StageTimer()
+    rows, errors = validate_claim_columns(claims, timer)
+    if errors:
+        timer.record()
+        raise RequestValidationError([
+            {**error, "loc": ["body", index, *error["loc"]]} for index in sorted(errors) for error in errors[index]
+        ])
+    response_mode = response_mode or envs.CLAIMS_RESPONSE_MODE
+    status_code = 200
+    mode = mode or envs.INGEST_MODE
+    if mode == "async" and (await session.connection()).dialect.name != "postgresql":
+        # claim ids can only be reserved from the postgres sequence, other databases store the batch now
+        mode = "sync"
+    if mode == "async":
+        status_code = 202
+        claimsResp = await enqueue_claim_rows(rows, session, response_mode)
+    else:
+        # The rows are written in one transaction: multi-row `INSERT ... ON CONFLICT DO NOTHING RETURNING`
+        # statements of `CLAIMS_INSERT_CHUNK_SIZE` rows, or a single `COPY` for batches of at least
+        # `CLAIMS_COPY_THRESHOLD` rows. A failing row rolls back the whole batch, so a request is either
+        # fully stored or not at all. Claims already stored (same content hash) keep their original id and
+        # are not counted again.
+        with timer.stage("db_write"):
+            claimsResp, inserted = await ingest_claims(session,
+                                                       rows,
+                                                       chunk_size=envs.CLAIMS_INSERT_CHUNK_SIZE,
+                                                       copy_threshold=envs.CLAIMS_COPY_THRESHOLD)
+        with timer.stage("aggregator_update"):
+            await on_claims_committed(inserted)
+        trace.get_current_span().set_attribute("claims.inserted", len(inserted))
+        claimsResp = claims_response(claimsResp, inserted, response_mode)
+    timer.record()
+
+    # returned as is, FastAPI would run the claims through `jsonable_encoder` before serializing them
+    if idempotency_key:
+        content = await save_idempotent_response(session, idempotency_key, fingerprint, status_code, claimsResp)
+        return Response(content=content, status_code=status_code, media_type="application/json")
+    return ORJSONResponse(claimsResp, status_code=status_code)
+
+
+@app.post("/claims/upload")
+async def upload_claims(request: Request, format: Optional[str] = None, session: AsyncSession = Depends(get_session)):
+    """
+    The function `upload_claims` ingests a claim file streamed as the request body, either CSV (a header
+    line then one claim per line, e.g. `claim_1234.csv`) or NDJSON (one JSON claim per line). The file
+    is never loaded in memory as a whole: lines are read as the body streams in, headers are matched to
+    the claim fields whatever their capitalization, and valid claims are stored and committed in chunks
+    of `UPLOAD_CHUNK_SIZE`. Invalid lines are skipped and reported.
+
+    :param request: The incoming request whose body is the claim file
+    :type request: Request
+    :param format: "csv" or "ndjson", taken from the `Content-Type` header (`text/csv`,
+    `application/x-ndjson`) when omitted
+    :type format: Optional[str]
+    :param session: The database session used to store the claims
+    :type session: AsyncSession
+    :return: The number of lines read, inserted and failed, and the errors of the failed lines.
+    """
+    try:
+        file_format = detect_format(request.headers.get("content-type"), format)
+    except ValueError as error:
+        raise HTTPException(status_code=415, detail=str(error))
+    return await ingest_upload(request.stream(),
+                               file_format,
+                               session,
+                               after_commit=on_claims_committed,
+                               chunk_size=envs.UPLOAD_CHUNK_SIZE,
+                               max_errors=envs.UPLOAD_MAX_ERRORS,
+                               copy_threshold=envs.CLAIMS_COPY_THRESHOLD)
+
+
+@app.get("/claims", response_class=ORJSONResponse)
+async def get_claims(provider_npi: Optional[str] = None,
+                     subscriber_id: Optional[str] = None,
+                     group_id: Optional[str] = None,
+                     service_dttm_from: Optional[datetime] = None,
+                     service_dttm_to: Optional[datetime] = None,
+                     after_id: Optional[int] = Query(None, ge=0),
+                     limit: int = Query(100, ge=1, le=envs.CLAIMS_QUERY_MAX_LIMIT),
+                     fields: Optional[str] = None,
+                     session: AsyncSession = Depends(get_read_session)):
+    """
+    The function `get_claims` looks up the stored claims of a provider, a subscriber or a group and/or
+    in a range of service dates, one page at a time in id order. The next page is requested with the
+    `next_after_id` of the response (keyset pagination), which is `null` on the last page.
+
+    :param provider_npi: Only return the claims of this provider
+    :type provider_npi: Optional[str]
+    :param subscriber_id: Only return the claims of this subscriber
+    :type subscriber_id: Optional[str]
+    :param group_id: Only return the claims of this group
+    :type group_id: Optional[str]
+    :param service_dttm_from: The first service date and time included
+    :type service_dttm_from: Optional[datetime]
+    :param service_dttm_to: The last service date and time included
+    :type service_dttm_to: Optional[datetime]
+    :param after_id: The `next_after_id` of the previous page
+    :type after_id: Optional[int]
+    :param limit: The maximum number of claims of the page, at most `CLAIMS_QUERY_MAX_LIMIT`
+    :type limit: int
+    :param fields: The comma separated columns returned, e.g. `id,provider_npi,net_fee`, every column
+    when omitted. `id` is always returned.
+    :type fields: Optional[str]
+    :param session: The database session used to read the claims, of the read replica unless it lags behind
+    :type session: AsyncSession
+    :return: `{"claims": [...], "next_after_id": ...}`
+    """
+    try:
+        columns = parse_fields(fields)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    filters = dimension_filters(provider_npi=provider_npi, subscriber_id=subscriber_id, group_id=group_id)
+    claims, next_after_id = await query_claims(session,
+                                               filters,
+                                               service_dttm_from=service_dttm_from,
+                                               service_dttm_to=service_dttm_to,
+                                               after_id=after_id,
+                                               limit=limit,
+                                               fields=columns)
+    return ORJSONResponse({"claims": claims, "next_after_id": next_after_id})
+
+
+@app.get("/claims/feed", response_class=StreamingResponse)
+async def get_claims_feed(cursor: str = Query("0", pattern=r"^([0-9]+-)?[0-9]+$"),
+                          limit: int = Query(1000, ge=1, le=envs.FEED_MAX_LIMIT),
+                          wait: float = Query(0, ge=0, le=envs.FEED_MAX_WAIT),
+                          session: AsyncSession = Depends(get_read_session)):
+    """
+    The function `get_claims_feed` is the change feed of the stored claims and their net fees, read by
+    the payments service. It streams, as NDJSON (one JSON claim per line), the first `limit` claims
+    following `cursor`, and returns the cursor of the next call in the `X-Next-Cursor` header: a
+    consumer starts from 0 and passes the last `X-Next-Cursor` it received.
+
+    Claims are ordered by the transaction which stored them, then by id, and a claim is only sent once
+    every older transaction has ended (see `feed_horizon`): a claim committed late, e.g. with an id
+    reserved by `/claims?mode=async`, comes after the cursor of the claims already sent instead of being
+    skipped. Pages are found through the `(xid, id)` index (keyset pagination, no offset scan) and
+    streamed with a server side cursor, so neither the database nor the worker ever hold more than a few
+    hundred rows.
+
+    :param cursor: The position of the last claim already consumed, as returned in `X-Next-Cursor`
+    :type cursor: str
+    :param limit: The maximum number of claims returned, at most `FEED_MAX_LIMIT`
+    :type limit: int
+    :param wait: The number of seconds to wait for new claims when there are none yet (long polling),
+    at most `FEED_MAX_WAIT`. The response is sent as soon as a claim is stored.
+    :type wait: float
+    :param session: The database session used to read the claims, of the read replica unless it lags behind
+    :type session: AsyncSession
+    :return: A streamed `application/x-ndjson` response, empty when no claim follows `cursor`.
+    """
+    position = parse_feed_cursor(cursor)
+    next_position = await wait_for_feed_cursor(session, position, limit, wait, poll_interval=envs.FEED_POLL_INTERVAL)
+    return StreamingResponse(stream_feed(session, position, next_position),
+                             media_type="application/x-ndjson",
+                             headers={"X-Next-Cursor": format_feed_cursor(next_position)})
+
+
+@app.get("/claims/batches/{batch_id}")
+async def get_claims_batch(batch_id: str):
+    """
+    The function `get_claims_batch` returns the status of a batch queued by `/claims?mode=async`:
+    `queued`, `retrying` (a write failed and will be tried again), `stored` or `failed` (moved to the
+    dead-letter list after `INGEST_MAX_ATTEMPTS` attempts), with the number of attempts and the last
+    error. Statuses are kept `INGEST_STATUS_TTL` seconds.
+    """
+    status = await get_batch_status(get_redis(), batch_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown batch: {batch_id}")
+    return status
+
+
+async def enqueue_claim_rows(rows: list[dict], session: AsyncSession, response_mode: str = "full") -> dict:
+    """
+    The function `enqueue_claim_rows` puts the validated rows not stored yet on the ingest queue, with
+    their ids reserved from the `claim` sequence in one query. The rows already stored (same content
+    hash, e.g. a retried request) are not queued again and keep the id of the stored claim. The response
+    holds the ids and net fees of every row, or with the "none" response mode only the counts of claims
+    and duplicates.
+
+    A claim sent again while its first request is still queued cannot be found yet: the worker stores it
+    once, and the status of the second batch counts it among its `duplicates`, its reserved id not being
+    used.
+    """
+    assign_content_hashes(rows)
+    stored = await fetch_claim_ids(session, [row["content_hash"] for row in rows])
+    queued = [row for row in rows if row["content_hash"] not in stored]
+    ids = await reserve_claim_ids(session, len(queued)) if queued else []
+    for claim_id, row in zip(ids, queued):
+        row["id"] = claim_id
+    for row in rows:
+        if row["content_hash"] in stored:
+            row["id"] = stored[row["content_hash"]]
+    batch_id = await enqueue_claims(get_redis(), queued, status_ttl=envs.INGEST_STATUS_TTL)
+    if response_mode == "none":
+        return {"batch_id": batch_id, "status": "queued", "count": len(rows), "duplicates": len(rows) - len(queued)}
+    return {"batch_id": batch_id,
+            "status": "queued",
+            "claims": [{"id": row["id"], "net_fee": row["net_fee"]} for row in rows]}
+
+
+def claims_response(rows: list[dict], inserted: list[dict], response_mode: str):
+    """
+    The function `claims_response` shapes the response of a stored batch for its `response_mode`:
+    the stored claims ("full"), their ids and net fees ("ids") or the counts only ("none").
+    """
+    if response_mode == "none":
+        return {"claims": len(rows), "inserted": len(inserted), "duplicates": len(rows) - len(inserted)}
+    if response_mode == "ids":
+        return [{"id": row["id"], "net_fee": row["net_fee"]} for row in rows]
+    # the `xid` of the inserted claims is internal, see `ingest_claims`
+    return [{key: value for key, value in row.items() if key != "xid"} for row in rows]
+
+
+async def read_claims_body(request: Request) -> list:
+    """
+    The function `read_claims_body` decodes the JSON body of a claims request, which must be a list.
+    """
+    try:
+        claims = await request.json()
+    except ValueError as error:
+        raise RequestValidationError([{"loc": ["body"], "msg": f"invalid JSON: {error}", "type": "value_error.jsondecode"}])
+    if not isinstance(claims, list):
+        raise RequestValidationError([{"loc": ["body"], "msg": "value is not a valid list", "type": "type_error.list"}])
+    return claims
+
+
+async def on_claims_committed(claims: list[dict]):
+    """
+    The function `on_claims_committed` is called with the claims of every committed batch and updates
+    the state derived from them. The ranking is only updated once the batch is committed, and the
+    cached ranking responses of every worker are invalidated when the batch stored new claims.
+    """
+    await ranking.push_claims(claims)
+    await approx_ranking.push_claims(claims)
+    if claims:
+        await top_cache.invalidate()
+
+@app.get("/top-provider", dependencies=[Depends(top_rate_limit)], response_class=ORJSONResponse)
+# The responses of `get_top_provider` are cached by `top_cache` for `TOP_CACHE_TTL` seconds, or until
+# the next committed batch of claims bumps the version of the rankings, see `cached_ranking`.
+async def get_top_provider(request: Request,
+                           response: Response,
+                           n: int = Query(10, ge=1, le=envs.TOP_N_MAX),
+                           group_id: Optional[str] = None,
+                           quadrant: Optional[str] = None,
+                           submitted_proc: Optional[str] = None,
+                           service_date_from: Optional[date] = None,
+                           service_date_to: Optional[date] = None,
+                           last_days: Optional[int] = Query(None, ge=1),
+                           mode: str = Query("exact", pattern="^(exact|approx)$"),
+                           session: AsyncSession = Depends(get_read_session),
+                           primary: AsyncSession = Depends(get_session)):
+    """
+    This function retrieves the top `n` providers (10 by default, at most `TOP_N_MAX`) based on net fee
+    either from cache or by querying the ranking backend if the cache holds no response for the current
+    version of the rankings. The `X-MyAPI-Cache` header tells whether the response was cached.
+
+    The ranking covers all time unless a service date window is given, either with
+    `service_date_from` / `service_date_to` (both included, each optional) or with `last_days` (the
+    last N days up to today). A windowed ranking merges the daily buckets of `provider_daily_totals`
+    and is cached, like the all time one, per window. The claims can also be restricted to a
+    `group_id`, a `quadrant` and/or a `submitted_proc`, see `get_top_by_dimension`.
+
+     The `dependencies=[Depends(top_rate_limit)]` part in the FastAPI endpoint decorator limits each
+     client to `TOP_RATE_LIMIT_TIMES` requests per `TOP_RATE_LIMIT_SECONDS` seconds (10 per 60 by
+     default) across the workers, see `RateLimiter`. If the rate limit is exceeded, the endpoint will
+     return a 429 Too Many Requests response with a `Retry-After` header.
     
     :param request: The `request` parameter in the `get_top_provider` function represents the incoming
     HTTP request made to the endpoint. It contains information about the request such as headers, query
@@ -156,41 +486,218 @@ async def get_top_provider(request: Request, response: Response, session: AsyncS
     response before sending it back. In your code snippet, you are not currently using the `response`
     parameter, but you can utilize
     :type response: Response
+    :param n: The number of providers returned
+    :type n: int
+    :param group_id: Only count the claims of this group
+    :type group_id: Optional[str]
+    :param quadrant: Only count the claims of this quadrant
+    :type quadrant: Optional[str]
+    :param submitted_proc: Only count the claims of this procedure
+    :type submitted_proc: Optional[str]
+    :param service_date_from: The first service date of the window
+    :type service_date_from: Optional[date]
+    :param service_date_to: The last service date of the window
+    :type service_date_to: Optional[date]
+    :param last_days: The number of days of a window ending today, exclusive with the dates above
+    :type last_days: Optional[int]
+    :param mode: "exact" (the default, for auditing) or "approx", the all time ranking of a Space-Saving
+    sketch, whose memory is fixed whatever the number of providers. Every approximate provider comes
+    with the `error` of its `net_fee` (its true total lies in `[net_fee - error, net_fee]`) and whether
+    it is `guaranteed` to be in the top `n`. It takes no filter nor window.
+    :type mode: str
     :param session: The `session` parameter in your FastAPI endpoint function `get_top_provider` is an
     instance of an asynchronous session that is used to interact with the database. In this case, it is
-    obtained using the `get_session` dependency
+    obtained using the `get_read_session` dependency, of the read replica unless it lags behind
     :type session: AsyncSession
-    :return: The code snippet provided is a FastAPI endpoint that retrieves the top 10 providers based
-    on their net fee from a database. If the priority queue (pq) is empty, it queries the database for
-    the top providers, stores the result in a priority queue, and returns the top providers. If the
-    priority queue is not empty, it directly returns the top providers from the cached priority queue.
-    """
-    if pq.is_empty():
-        print("Non-cache top n")
-        result = await session.execute(select(Claim.provider_npi, func.sum(Claim.net_fee).label('net_fee')).group_by(Claim.provider_npi).order_by(desc('net_fee')).limit(10))
-        claimsRes = []
-        for row in result:
-            claimsRes.append({"provider_npi": row["provider_npi"],"net_fee": row["net_fee"]})
-        await setTopPQ(claimsRes)
-        return claimsRes
+    :param primary: A session of the primary, which only loads the ranking backend
+    :type primary: AsyncSession
+    :return: The code snippet provided is a FastAPI endpoint that retrieves the top providers based
+    on their total net fee. The first call loads the totals of every provider from the database into
+    the ranking backend, which is then kept up to date by `/claims`, and the top providers are always
+    served from the ranking backend.
+    """
+    window = service_window(service_date_from, service_date_to, last_days)
+    filters = dimension_filters(group_id=group_id, quadrant=quadrant, submitted_proc=submitted_proc)
+    if mode == "approx":
+        if filters or window is not None:
+            raise HTTPException(status_code=400, detail="mode=approx only ranks all time without filters")
+        return await cached_ranking(request, lambda: rank_approx(n, primary))
+    return await cached_ranking(request,
+                                lambda: rank_top(RankDimension.provider_npi, filters, window, n, session, primary),
+                                window)
+
+
+@app.get("/top/{dimension}", dependencies=[Depends(top_rate_limit)],
+         response_class=ORJSONResponse)
+async def get_top_by_dimension(request: Request,
+                               response: Response,
+                               dimension: RankDimension,
+                               n: int = Query(10, ge=1, le=envs.TOP_N_MAX),
+                               group_id: Optional[str] = None,
+                               quadrant: Optional[str] = None,
+                               submitted_proc: Optional[str] = None,
+                               service_date_from: Optional[date] = None,
+                               service_date_to: Optional[date] = None,
+                               last_days: Optional[int] = Query(None, ge=1),
+                               session: AsyncSession = Depends(get_read_session),
+                               primary: AsyncSession = Depends(get_session)):
+    """
+    The function `get_top_by_dimension` ranks the providers, groups, quadrants or procedures by the
+    total net fee of their claims, e.g. `/top/group_id?quadrant=UR&n=20` returns the 20 groups with
+    the highest net fees in the upper right quadrant. It takes the same window and filter parameters
+    as `/top-provider`, rate limited and cached the same way.
+
+    All time rankings are served from the `claim_dimension_totals` rollup, which every batch of
+    `/claims` updates in its transaction, instead of grouping the whole `claim` table. Windowed
+    rankings with filters, or of another dimension than the provider, read the claims of the window
+    through the composite `(dimension, service_dttm)` indexes.
+
+    :param dimension: The dimension whose values are ranked: `provider_npi`, `group_id`, `quadrant`
+    or `submitted_proc`
+    :type dimension: RankDimension
+    :param n: The number of values returned
+    :type n: int
+    :return: A list of `{<dimension>: value, "net_fee": total}` dictionaries, best first.
+    """
+    window = service_window(service_date_from, service_date_to, last_days)
+    filters = dimension_filters(group_id=group_id, quadrant=quadrant, submitted_proc=submitted_proc)
+    return await cached_ranking(request, lambda: rank_top(dimension, filters, window, n, session, primary), window)
+
+
+@app.get("/providers/{provider_npi}/stats", response_class=ORJSONResponse)
+async def get_provider_stats(provider_npi: str = Path(pattern=r"^[0-9]{10}$"),
+                             session: AsyncSession = Depends(get_read_session)):
+    """
+    The function `get_provider_stats` returns the statistics of the net fees of the claims of a
+    provider: their count, mean, standard deviation, minimum, maximum and p50/p95/p99. They are read
+    from the `provider_stats` summaries, which every batch of `/claims` merges in its transaction, so
+    the cost of a request does not depend on the number of claims of the provider. The quantiles come
+    from a DDSketch and are within `relative_accuracy` (1%) of the exact ones.
+
+    :param provider_npi: The NPI of the provider
+    :type provider_npi: str
+    :return: A dictionary of the statistics, or a 404 if the provider has no claims.
+    """
+    stats = await fetch_provider_stats(session, provider_npi)
+    if stats is None:
+        raise HTTPException(status_code=404, detail=f"Unknown provider: {provider_npi}")
+    return ORJSONResponse(stats)
+
+
+# Query parameters of a ranking request resolved into its window of service dates by `service_window`.
+WINDOW_PARAMETERS = {"service_date_from", "service_date_to", "last_days"}
+
+
+def ranking_cache_key(path: str, query_items: list[tuple], window) -> str:
+    """
+    The function `ranking_cache_key` identifies a ranking response in `top_cache` by its path and its
+    sorted query parameters, the window parameters being replaced by the resolved `window`: a
+    `last_days` window cached yesterday is not served with yesterday's dates today.
+    """
+    items = [(name, value) for name, value in query_items if name not in WINDOW_PARAMETERS]
+    if window is not None:
+        items.append(("window", f"{window[0].isoformat()}:{window[1].isoformat()}"))
+    return path + "?" + urlencode(sorted(items))
+
+
+async def cached_ranking(request: Request, compute, window=None) -> ORJSONResponse:
+    """
+    The function `cached_ranking` serves a ranking request from `top_cache`, keyed by
+    `ranking_cache_key`, and computes it with `compute` on a miss. After an invalidation, a single
+    request per ranking computes it while the concurrent ones wait for its result.
+    """
+    key = ranking_cache_key(request.url.path, request.query_params.multi_items(), window)
+    top, result = await top_cache.get_or_compute(key, compute)
+    return ORJSONResponse(top, headers={"X-MyAPI-Cache": "Miss" if result == "miss" else "Hit"})
+
+
+async def rank_top(dimension: RankDimension, filters: dict, window, n: int, session: AsyncSession,
+                   primary: AsyncSession) -> list[dict]:
+    """
+    The function `rank_top` picks the cheapest source able to answer a ranking: the ranking backend for
+    the all time provider ranking, the daily buckets for an unfiltered windowed provider ranking, and
+    `fetch_top_by_dimension` for everything else. The queries go through `session`, a read session,
+    and the ranking backend is loaded through `primary`.
+    """
+    # Only reached when the response was not in the response cache. The ranking backend is a cache of
+    # the provider totals too: a miss loads it from the database.
+    span = trace.get_current_span()
+    start = time.perf_counter()
+    if dimension == RankDimension.provider_npi and not filters:
+        if window is not None:
+            source = "daily"
+            top = as_top_provider_dicts(await fetch_top_providers_in_window(session, *window, n=n))
+        else:
+            source = "ranking"
+            loaded = await ranking.is_loaded()
+            TOP_N_CACHE.labels(layer="ranking", result="hit" if loaded else "miss").inc()
+            span.set_attribute("top_n.ranking_cache_hit", loaded)
+            if not loaded:
+                # loaded from the primary: a lagging replica would miss the claims committed before the load
+                await ranking.load(primary)
+            top = as_top_provider_dicts(await ranking.get_top_n(n, session=session))
     else:
-        print("Cached top n")
-        return pq.get_top_n()
-    
+        source = "claims" if window is not None else "rollup"
+        top = [{dimension.value: value, "net_fee": net_fee}
+               for value, net_fee in await fetch_top_by_dimension(session, dimension, filters, n=n, window=window)]
+    elapsed = time.perf_counter() - start
+    TOP_N_SECONDS.labels(source=source).observe(elapsed)
+    span.set_attribute("top_n.source", source)
+    span.set_attribute("top_n.ms", round(elapsed * 1000, 3))
+    return top
 
 
-async def setTopPQ(claimsRes: []):
+async def rank_approx(n: int, primary: AsyncSession) -> list[dict]:
     """
-    The function `setTopPQ` takes a list of claims results and pushes them into a priority queue based
-    on provider NPI and net fee.
-    
-    :param claimsRes: A list of dictionaries containing information about claims. Each dictionary in the
-    list should have keys "provider_npi" and "net_fee" to represent the NPI (National Provider
-    Identifier) of a healthcare provider and the net fee associated with a claim, respectively
-    :type claimsRes: []
+    The function `rank_approx` ranks the providers with `approx_ranking`, loaded on first use, and
+    returns every provider with the error bound of its total. The bound of every error, which grows
+    with the total net fee of the sketches merged, is exported as `top_n_sketch_error_bound`.
+    """
+    start = time.perf_counter()
+    loaded = await approx_ranking.is_loaded()
+    TOP_N_CACHE.labels(layer="sketch", result="hit" if loaded else "miss").inc()
+    if not loaded:
+        await approx_ranking.load(primary)
+    sketch = await approx_ranking.merged_sketch()
+    TOP_N_SKETCH_ERROR_BOUND.set(sketch.error_bound())
+    top = [{"provider_npi": provider_npi, "net_fee": estimate, "error": error, "guaranteed": guaranteed}
+           for provider_npi, estimate, error, guaranteed in sketch.get_top_n(n)]
+    TOP_N_SECONDS.labels(source="sketch").observe(time.perf_counter() - start)
+    trace.get_current_span().set_attribute("top_n.source", "sketch")
+    return top
+
+
+def dimension_filters(**values) -> dict:
+    """
+    The function `dimension_filters` keeps the filter parameters of a request that were given.
+    """
+    return {name: value for name, value in values.items() if value is not None}
+
+
+def service_window(service_date_from: Optional[date], service_date_to: Optional[date], last_days: Optional[int]):
+    """
+    The function `service_window` turns the window parameters of `/top-provider` into a
+    `(start, end)` tuple of dates, or `None` when no window is requested.
+    """
+    if last_days is not None:
+        if service_date_from is not None or service_date_to is not None:
+            raise HTTPException(status_code=400, detail="last_days cannot be combined with service_date_from/service_date_to")
+        today = datetime.utcnow().date()
+        return today - timedelta(days=last_days - 1), today
+    if service_date_from is None and service_date_to is None:
+        return None
+    start, end = service_date_from or date.min, service_date_to or date.max
+    if start > end:
+        raise HTTPException(status_code=400, detail="service_date_from must not be after service_date_to")
+    return start, end
+
+
+def as_top_provider_dicts(top: list) -> list[dict]:
+    """
+    The function `as_top_provider_dicts` converts `ClaimTopProvider` objects to plain dictionaries,
+    which the response cache can serialize to JSON.
     """
-    for claim in claimsRes:
-        pq.push(ClaimTopProvider(claim["provider_npi"], claim["net_fee"]))
+    return [{"provider_npi": provider.provider_npi, "net_fee": provider.net_fee} for provider in top]
 
 
 
@@ -0,0 +1,43 @@
+from typing import NamedTuple
+
+
+class CommitWatermark(NamedTuple):
+    """
+    The class `CommitWatermark` tells which claims are counted by totals read from the database. On
+    postgres it is the snapshot of the statement which read them (`pg_current_snapshot()`): every
+    transaction below `xmin` had ended, and so had the ones below `xmax` except the `running` ones, so a
+    claim is counted when the transaction which stored it (its `xid`) had committed. Claim ids do not
+    tell it, an id being taken before its transaction commits. Other dialects serialize their writes
+    and the watermark is the highest claim id, `max_id`.
+    """
+    xmin: int = 0
+    xmax: int = 0
+    running: frozenset = frozenset()
+    max_id: int = 0
+
+    @classmethod
+    def parse(cls, value) -> "CommitWatermark":
+        """
+        The function `parse` builds a watermark from a snapshot written `xmin:xmax:xip,...` by postgres,
+        or from the highest claim id elsewhere, as read from the database or written by `dumps`.
+        """
+        if isinstance(value, str) and ":" in value:
+            xmin, xmax, running = value.split(":")
+            return cls(int(xmin), int(xmax), frozenset(int(xid) for xid in running.split(",") if xid))
+        return cls(max_id=int(value or 0))
+
+    @property
+    def snapshot(self) -> str:
+        return f"{self.xmin}:{self.xmax}:{','.join(str(xid) for xid in sorted(self.running))}"
+
+    def dumps(self) -> str:
+        return self.snapshot if self.xmax else str(self.max_id)
+
+    def counts(self, xid: int, claim_id: int) -> bool:
+        """
+        The function `counts` returns whether the claim `claim_id` stored by the transaction `xid` is
+        counted by the totals of this watermark.
+        """
+        if self.xmax:
+            return xid < self.xmin or (xid < self.xmax and xid not in self.running)
+        return claim_id <= self.max_id
@@ -0,0 +1,85 @@
+import math
+
+
+class DDSketch:
+    def __init__(self, relative_accuracy=0.01, min_value=0.01, counts=None):
+        """
+        The function initializes a DDSketch of a distribution of values: every value is counted in a
+        logarithmic bucket, so that any quantile is returned within `relative_accuracy` of the true value
+        of that rank, whatever the number of values. Net fees from a cent to a billion take at most ~1200
+        buckets per sign, and in practice a few dozen.
+
+        Buckets are numbered in the order of their values: `0` holds the values whose magnitude is below
+        `min_value`, `1, 2, ...` the positive values and `-1, -2, ...` the negative ones. Two sketches with
+        the same parameters merge by adding their counts per bucket, e.g. the ones of several workers, or
+        the rows of a table summed with `INSERT ... ON CONFLICT`.
+
+        :param relative_accuracy: The relative error of the quantiles
+        :param min_value: The magnitude below which values are counted as 0
+        :param counts: The number of values per bucket, e.g. read back from the database
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # index of the bucket of `min_value`, bucket 1 is the first one above it
+        self.offset = math.ceil(math.log(min_value) / self.log_gamma) - 1
+        self.counts = dict(counts or {})
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def bucket(self, value):
+        """
+        The function `bucket` returns the bucket of a value, the bucket `i` of the positive values
+        holding `(gamma ** (i + offset - 1), gamma ** (i + offset)]`.
+        """
+        magnitude = abs(value)
+        if magnitude < self.min_value:
+            return 0
+        index = max(math.ceil(math.log(magnitude) / self.log_gamma) - self.offset, 1)
+        return index if value > 0 else -index
+
+    def value(self, bucket):
+        """
+        The function `value` returns the value representing a bucket, within `relative_accuracy` of every
+        value of the bucket.
+        """
+        if bucket == 0:
+            return 0.0
+        magnitude = 2 * self.gamma ** (abs(bucket) + self.offset) / (self.gamma + 1)
+        return magnitude if bucket > 0 else -magnitude
+
+    def add(self, value, count=1):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def merge(self, other):
+        if (other.relative_accuracy, other.min_value) != (self.relative_accuracy, self.min_value):
+            raise ValueError("cannot merge sketches with different parameters")
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        return self
+
+    def quantiles(self, qs):
+        """
+        The function `quantiles` returns the values at the quantiles `qs` (between 0 and 1) in one pass
+        over the sorted buckets, or `None` for each when the sketch is empty.
+        """
+        total = len(self)
+        if total == 0:
+            return [None] * len(qs)
+        ranks = sorted((q * (total - 1), position) for position, q in enumerate(qs))
+        result = [None] * len(qs)
+        seen = 0
+        buckets = iter(sorted(self.counts.items()))
+        bucket = None
+        for rank, position in ranks:
+            while seen <= rank:
+                bucket, count = next(buckets)
+                seen += count
+            result[position] = self.value(bucket)
+        return result
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
@@ -1,6 +1,8 @@
+from enum import Enum
+from sqlalchemy import Index, text
 from sqlmodel import SQLModel, Field
 from typing import Optional
-from datetime import datetime
+from datetime import date, datetime
 
 class ClaimBase(SQLModel):
     service_dttm: datetime = Field(default_factory=datetime.utcnow)
@@ -16,7 +18,19 @@ class ClaimBase(SQLModel):
     net_fee: Optional[float] = 0.0
 
 class Claim(ClaimBase, table=True):
+    # On postgres `claim` is partitioned by month of `service_dttm` and its primary key is (id,
+    # service_dttm), the ids still being unique since they come from a single sequence.
+    __table_args__ = (Index("ix_claim_content_hash", "content_hash", "service_dttm", unique=True),
+                      Index("ix_claim_xid_id", "xid", "id"))
+
     id: int = Field(default=None, nullable=False, primary_key=True)
+    # sha256 of the claim fields and of its occurrence in its batch, see `claim_content_hashes`. It
+    # covers the service date, so the hash is unique per service date like it is overall.
+    content_hash: Optional[str] = Field(default=None, max_length=64)
+    # On postgres the id of the transaction which stored the claim (`pg_current_xact_id()`, the default of
+    # the column), which orders the claim feed by commit safe positions. 0 elsewhere and for the claims
+    # stored before the column was added.
+    xid: Optional[int] = Field(default=None, sa_column_kwargs={"server_default": text("0")})
 
 class ClaimCreate(ClaimBase):
     pass
@@ -28,4 +42,74 @@ class ClaimTopProvider:
 
     # comparator for sorting
     def __lt__(self, other):
-        return self.net_fee < other.net_fee
\ No newline at end of file
+        return self.net_fee < other.net_fee
+
+class ProviderTotal(SQLModel, table=True):
+    __tablename__ = "provider_totals"
+
+    provider_npi: str = Field(primary_key=True, max_length=10)
+    net_fee_sum: float = Field(default=0.0, index=True)
+    claim_count: int = Field(default=0)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ProviderDailyTotal(SQLModel, table=True):
+    __tablename__ = "provider_daily_totals"
+
+    service_date: date = Field(primary_key=True)
+    provider_npi: str = Field(primary_key=True, max_length=10)
+    net_fee_sum: float = Field(default=0.0)
+    claim_count: int = Field(default=0)
+
+
+class ClaimDimensionTotal(SQLModel, table=True):
+    __tablename__ = "claim_dimension_totals"
+
+    provider_npi: str = Field(primary_key=True, max_length=10)
+    group_id: str = Field(primary_key=True)
+    # claims without quadrant are stored with an empty quadrant, primary key columns cannot be null
+    quadrant: str = Field(primary_key=True)
+    submitted_proc: str = Field(primary_key=True)
+    net_fee_sum: float = Field(default=0.0)
+    claim_count: int = Field(default=0)
+
+
+class ProviderStats(SQLModel, table=True):
+    __tablename__ = "provider_stats"
+
+    provider_npi: str = Field(primary_key=True, max_length=10)
+    claim_count: int = Field(default=0)
+    # running moments of the net fees: their mean and the sum of their squared deviations from it
+    net_fee_mean: float = Field(default=0.0)
+    net_fee_m2: float = Field(default=0.0)
+    net_fee_min: float
+    net_fee_max: float
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ProviderFeeBucket(SQLModel, table=True):
+    __tablename__ = "provider_fee_buckets"
+
+    provider_npi: str = Field(primary_key=True, max_length=10)
+    # bucket of the `DDSketch` of the net fees of the provider
+    bucket: int = Field(primary_key=True)
+    claim_count: int = Field(default=0)
+
+
+class RankDimension(str, Enum):
+    provider_npi = "provider_npi"
+    group_id = "group_id"
+    quadrant = "quadrant"
+    submitted_proc = "submitted_proc"
+
+
+class IdempotencyKey(SQLModel, table=True):
+    __tablename__ = "idempotency_keys"
+
+    key: str = Field(primary_key=True, max_length=255)
+    # sha256 of the request body, a key cannot be reused for another request
+    request_hash: str = Field(max_length=64)
+    status_code: int
+    # the JSON response returned again to the retries of the request
+    response: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
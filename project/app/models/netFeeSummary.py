@@ -0,0 +1,70 @@
+import math
+from .ddSketch import DDSketch
+
+
+class NetFeeSummary:
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=None, maximum=None, sketch=None):
+        """
+        The function initializes the summary of the net fees of a provider: the running moments of
+        Welford (count, mean and `m2`, the sum of the squared deviations from the mean), the extremes,
+        and a `DDSketch` for the quantiles. Summaries merge exactly, moments included, so they can be
+        built per batch, per worker or per chunk of the table and combined in any order.
+        """
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+        self.sketch = sketch if sketch is not None else DDSketch()
+
+    @classmethod
+    def of(cls, values):
+        """
+        The function `of` summarizes a list of net fees, with the moments computed in two passes.
+        """
+        summary = cls()
+        if not values:
+            return summary
+        summary.count = len(values)
+        summary.mean = math.fsum(values) / summary.count
+        summary.m2 = math.fsum((value - summary.mean) ** 2 for value in values)
+        summary.minimum, summary.maximum = min(values), max(values)
+        for value in values:
+            summary.sketch.add(value)
+        return summary
+
+    def merge(self, other):
+        """
+        The function `merge` adds the net fees of another summary to this one, combining the moments with
+        the parallel formula of Chan et al.
+        """
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def as_dict(self):
+        """
+        The function `as_dict` returns the statistics served by `/providers/{provider_npi}/stats`. The
+        quantiles are clamped to the exact extremes.
+        """
+        quantiles = self.sketch.quantiles([0.5, 0.95, 0.99])
+        if self.count:
+            quantiles = [min(max(value, self.minimum), self.maximum) for value in quantiles]
+        return {
+            "count": self.count,
+            "mean": self.mean if self.count else None,
+            "stddev": math.sqrt(self.m2 / self.count) if self.count else None,
+            "min": self.minimum,
+            "max": self.maximum,
+            "p50": quantiles[0],
+            "p95": quantiles[1],
+            "p99": quantiles[2],
+        }
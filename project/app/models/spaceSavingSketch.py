@@ -0,0 +1,232 @@
+import heapq
+import struct
+import zlib
+from operator import itemgetter
+
+
+class SpaceSavingSketch:
+    def __init__(self, capacity=10000):
+        """
+        The function initializes a weighted Space-Saving sketch of the net fee totals of the providers:
+        at most `capacity` counters are kept whatever the number of providers, so its memory is fixed.
+
+        Every counter holds an estimate of the total of its provider and the error of that estimate:
+        the true total lies in `[estimate - error, estimate]`. A provider without counter takes the
+        counter with the lowest estimate, inheriting it as its error, so no total is ever above
+        `min_estimate` without having a counter, and every error is at most `total_weight / capacity`.
+        These bounds hold for non negative net fees: a negative net fee lowers the counter of a tracked
+        provider and is dropped for the others.
+
+        :param capacity: The number of counters, i.e. the memory budget of the sketch
+        """
+        self.capacity = capacity
+        # `heap` is a min-heap of provider NPIs ordered by their estimate, `positions` maps every NPI
+        # to its index in `heap` so that its counter can be moved in O(log k).
+        self.heap = []
+        self.estimates = {}
+        self.errors = {}
+        self.positions = {}
+        # sum of the net fees counted, the bound of the errors is `total_weight / capacity`
+        self.total_weight = 0.0
+        # load state, see `begin_load` and `end_load`
+        self.loaded = False
+        self.watermark = None
+        self._pending = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    @property
+    def loading(self):
+        return self._pending is not None
+
+    def push(self, provider_npi, net_fee, position=None):
+        """
+        The function `push` adds the net fee of one claim to the estimate of its provider in O(log k).
+        Claims pushed during a load are buffered with their `(xid, id)` position, see `begin_load`.
+        """
+        if self._pending is not None:
+            self._pending.append((position, provider_npi, net_fee))
+            return
+        self._add(provider_npi, net_fee)
+
+    def min_estimate(self):
+        """
+        The function `min_estimate` returns the lowest estimate of a full sketch, an upper bound of the
+        total of every provider without counter, and 0 while counters are left.
+        """
+        return self.estimates[self.heap[0]] if len(self.heap) >= self.capacity else 0.0
+
+    def error_bound(self):
+        return self.total_weight / self.capacity
+
+    def get_top_n(self, n):
+        """
+        The function `get_top_n` returns the `n` providers with the highest estimates, best first, as
+        `(provider_npi, estimate, error, guaranteed)` tuples. `guaranteed` is true when the provider is
+        certainly among the top `n`: its lowest possible total is above the highest possible total of
+        every provider outside the returned ones.
+        """
+        ranked = heapq.nlargest(n + 1, self.estimates.items(), key=itemgetter(1))
+        # highest possible total of a provider outside the top n, tracked or not
+        outside = max(ranked[n][1] if len(ranked) > n else 0.0, self.min_estimate())
+        return [(key, estimate, self.errors[key], estimate - self.errors[key] >= outside)
+                for key, estimate in ranked[:n]]
+
+    def merge(self, other):
+        """
+        The function `merge` returns the sketch of the union of the claims of two sketches, e.g. of two
+        workers or nodes that ingested disjoint claims. A provider missing from a full sketch is counted
+        with its `min_estimate`, both as estimate and error, and the `capacity` highest merged counters
+        are kept, so the bounds of the merged sketch hold like the ones of its inputs.
+        """
+        merged = SpaceSavingSketch(max(self.capacity, other.capacity))
+        floors = (self.min_estimate(), other.min_estimate())
+        counters = []
+        for key in self.estimates.keys() | other.estimates.keys():
+            estimate, error = 0.0, 0.0
+            for sketch, floor in zip((self, other), floors):
+                if key in sketch.estimates:
+                    estimate += sketch.estimates[key]
+                    error += sketch.errors[key]
+                else:
+                    estimate += floor
+                    error += floor
+            counters.append((key, estimate, error))
+        merged._set_counters(heapq.nlargest(merged.capacity, counters, key=itemgetter(1)))
+        merged.total_weight = self.total_weight + other.total_weight
+        merged.loaded = self.loaded and other.loaded
+        return merged
+
+    def to_bytes(self):
+        """
+        The function `to_bytes` serializes the sketch, e.g. to be merged on another worker or node, as a
+        zlib compressed header followed by every counter: NPI, estimate and error.
+        """
+        parts = [struct.pack("<4sIdI", b"SSK2", self.capacity, self.total_weight, len(self.heap))]
+        for key in self.heap:
+            encoded = key.encode()
+            parts.append(struct.pack(f"<B{len(encoded)}sdd", len(encoded), encoded, self.estimates[key], self.errors[key]))
+        return zlib.compress(b"".join(parts), 1)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = zlib.decompress(data)
+        magic, capacity, total_weight, count = struct.unpack_from("<4sIdI", data)
+        if magic != b"SSK2":
+            raise ValueError(f"invalid sketch: {magic!r}")
+        sketch = cls(capacity)
+        offset = struct.calcsize("<4sIdI")
+        counters = []
+        for _ in range(count):
+            length = data[offset]
+            key, estimate, error = struct.unpack_from(f"<{length}sdd", data, offset + 1)
+            counters.append((key.decode(), estimate, error))
+            offset += 1 + length + 16
+        sketch._set_counters(counters)
+        sketch.total_weight = total_weight
+        return sketch
+
+    def begin_load(self):
+        """
+        The function `begin_load` empties the sketch before it is loaded from the provider totals with
+        `load_totals`. Claims pushed until `end_load` or `abort_load` is called are buffered.
+        """
+        self._set_counters([])
+        self.total_weight = 0.0
+        self.loaded = False
+        self._pending = []
+
+    def load_totals(self, totals):
+        """
+        The function `load_totals` counts a chunk of `(provider_npi, total net fee)` pairs, so that the
+        totals can be streamed in without holding them all in memory.
+        """
+        for provider_npi, net_fee in totals:
+            self._add(provider_npi, net_fee)
+
+    def end_load(self, watermark=None):
+        """
+        The function `end_load` replays the claims buffered since `begin_load` that the `CommitWatermark`
+        of the loaded totals does not count, the other ones being already part of them.
+        """
+        pending = self._pending or []
+        self._pending = None
+        for position, provider_npi, net_fee in pending:
+            if position is None or watermark is None or not watermark.counts(*position):
+                self._add(provider_npi, net_fee)
+        self.watermark = watermark
+        self.loaded = True
+
+    def abort_load(self):
+        pending = self._pending or []
+        self._pending = None
+        for _, provider_npi, net_fee in pending:
+            self._add(provider_npi, net_fee)
+
+    def _add(self, key, value):
+        position = self.positions.get(key)
+        if position is not None:
+            self.estimates[key] += value
+            self.total_weight += value
+            if value >= 0:
+                self._sift_down(position)
+            else:
+                self._sift_up(position)
+            return
+        if value < 0:
+            return
+        self.total_weight += value
+        if len(self.heap) < self.capacity:
+            self.estimates[key] = value
+            self.errors[key] = 0.0
+            self.positions[key] = len(self.heap)
+            self.heap.append(key)
+            self._sift_up(len(self.heap) - 1)
+            return
+        # the provider takes the counter with the lowest estimate, which bounds what it may have missed
+        evicted = self.heap[0]
+        floor = self.estimates.pop(evicted)
+        del self.errors[evicted]
+        del self.positions[evicted]
+        self.heap[0] = key
+        self.positions[key] = 0
+        self.estimates[key] = floor + value
+        self.errors[key] = floor
+        self._sift_down(0)
+
+    def _set_counters(self, counters):
+        self.heap = [key for key, _, _ in counters]
+        self.estimates = {key: estimate for key, estimate, _ in counters}
+        self.errors = {key: error for key, _, error in counters}
+        self.positions = {key: index for index, key in enumerate(self.heap)}
+        for index in reversed(range(len(self.heap) // 2)):
+            self._sift_down(index)
+
+    def _swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.positions[heap[i]] = i
+        self.positions[heap[j]] = j
+
+    def _sift_up(self, index):
+        estimates, heap = self.estimates, self.heap
+        while index > 0:
+            parent = (index - 1) // 2
+            if estimates[heap[index]] >= estimates[heap[parent]]:
+                break
+            self._swap(index, parent)
+            index = parent
+
+    def _sift_down(self, index):
+        estimates, heap = self.estimates, self.heap
+        size = len(heap)
+        while True:
+            smallest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and estimates[heap[child]] < estimates[heap[smallest]]:
+                    smallest = child
+            if smallest == index:
+                break
+            self._swap(index, smallest)
+            index = smallest
@@ -1,43 +1,88 @@
 import heapq
+import sys
+from operator import itemgetter
+from .models import ClaimTopProvider
 
 class TopNPriorityQueue:
-    def __init__(self, n):
+    def __init__(self, n, capacity=None):
         """
-        The function initializes a class instance with an empty heap, a set for unique elements, and a
-        specified value for n.
-        
-        :param n: The parameter `n` in the `__init__` method represents the size or capacity of the heap
-        data structure that is being initialized. This parameter is used to determine the maximum number
-        of elements that can be stored in the heap
+        The function initializes an indexed max-heap of running net fee sums keyed by provider NPI.
+
+        :param n: The parameter `n` in the `__init__` method is the default number of elements returned
+        by `get_top_n`
+        :param capacity: The maximum number of distinct providers kept in memory. When it is exceeded the
+        providers with the lowest totals are evicted, `None` keeps every provider
         """
-        self.heap = []
-        self.unique_elements = set()
         self.n = n
+        self.capacity = capacity
+        # `heap` holds provider NPIs ordered by their total, `positions` maps every NPI to its index in
+        # `heap` so a provider can be found and moved in O(log P) when one of its claims comes in.
+        self.heap = []
+        self.totals = {}
+        self.positions = {}
+        # highest total ever evicted because of `capacity` (`None` until the first eviction, and possibly
+        # negative like net fees), an upper bound of the total of an evicted provider, and so of what a
+        # provider coming back after its eviction misses from its total. The providers added since the
+        # first eviction are `partial`: they may be such a provider.
+        self.evicted_max = None
+        self.partial = set()
+        # load state, see `begin_load` and `load`
+        self.loaded = False
+        self.watermark = None
+        self._pending = None
+
+    def push(self, element, position=None):
+        """
+        This Python function adds the net fee of an element to the running total of its provider and
+        moves the provider to its new place in the heap (increase-key or decrease-key) in O(log P).
+
+        :param element: A `ClaimTopProvider` holding the `provider_npi` and the `net_fee` of one claim
+        :param position: The `(xid, id)` of the claim, the transaction which stored it and its id, used to
+        discard claims already counted by a concurrent `load`
+        """
+        if self._pending is not None:
+            self._pending.append((position, element.provider_npi, element.net_fee))
+            return
+        self._add(element.provider_npi, element.net_fee)
 
-    def push(self, element):
+    def get_top_n(self, n=None):
         """
-        This Python function pushes elements onto a heap while ensuring uniqueness based on a specific
-        attribute.
-        
-        :param element: It is a method named `push` that adds elements to a heap while maintaining
-        uniqueness based on the `provider_npi` attribute of the elements.
-        The method uses a heap (`self.heap`) to store elements and a set
-        (`self.unique_elements`) to keep track
+        The function `get_top_n` returns the top n providers in descending order of their total. The
+        heap is walked best-first from the root with a heap of candidates, so at most 2n entries are
+        visited and the walk takes O(n log n) whatever the number of providers.
+        :return: A list of `ClaimTopProvider` with the provider NPI and its total net fee.
         """
-        if element.provider_npi not in self.unique_elements:
-            heapq.heappush(self.heap, element)
-            # non-duplicate keys
-            self.unique_elements.add(element.provider_npi)
-            if len(self.heap) > self.n:
-                removed_element = heapq.heappop(self.heap)
-                self.unique_elements.remove(removed_element.provider_npi)
+        n = self.n if n is None else n
+        top = []
+        if not self.heap or n <= 0:
+            return top
+        candidates = [(-self.totals[self.heap[0]], 0)]
+        while candidates and len(top) < n:
+            total, index = heapq.heappop(candidates)
+            top.append(ClaimTopProvider(self.heap[index], -total))
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(self.heap):
+                    heapq.heappush(candidates, (-self.totals[self.heap[child]], child))
+        return top
 
-    def get_top_n(self):
+    def get_exact_top_n(self, n=None):
         """
-        The function `get_top_n` returns the top n elements from a heap in descending order.
-        :return: A sorted list of elements in the heap in descending order.
+        The function `get_exact_top_n` returns `get_top_n(n)` when the evictions cannot have made it wrong,
+        and `None` otherwise: when one of the top n providers is `partial`, or when a provider outside of
+        them could be above the n-th one: an evicted provider, whose total is at most `evicted_max`, or a
+        provider held below them, which misses at most `evicted_max` from its total when it is partial.
+        Without eviction the queue is exact.
         """
-        return sorted(self.heap, reverse=True)
+        n = self.n if n is None else n
+        top = self.get_top_n(n + 1)
+        if self.evicted_max is None:
+            return top[:n]
+        if len(top) < n or any(element.provider_npi in self.partial for element in top[:n]):
+            return None
+        outside = self.evicted_max
+        if len(top) > n:
+            outside = max(outside, top[n].net_fee + max(self.evicted_max, 0.0))
+        return top[:n] if n == 0 or top[n - 1].net_fee >= outside else None
 
     def is_empty(self):
         """
@@ -47,3 +92,123 @@ class TopNPriorityQueue:
         otherwise.
         """
         return (len(self.heap) == 0)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def memory_bytes(self):
+        """
+        The function `memory_bytes` estimates the memory used by the queue: its three containers plus one
+        NPI string, one float total and one int position per provider. The size of a key is taken from
+        the root, so the estimate is O(1) and can be read at every scrape of `/metrics`.
+        """
+        size = (sys.getsizeof(self.heap) + sys.getsizeof(self.totals) + sys.getsizeof(self.positions)
+                + sys.getsizeof(self.partial))
+        if self.heap:
+            size += len(self.heap) * (sys.getsizeof(self.heap[0]) + sys.getsizeof(0.0) + sys.getsizeof(len(self.heap)))
+        return size
+
+    def begin_load(self):
+        """
+        The function `begin_load` marks the start of a load of the totals from the database. Claims
+        pushed until `load` or `abort_load` is called are buffered instead of being applied.
+        """
+        self._pending = []
+
+    def load(self, totals, watermark=None):
+        """
+        The function `load` replaces the whole state with the given totals in O(P), then replays the
+        claims buffered since `begin_load` that `watermark` does not count, the other ones being already
+        part of `totals`.
+
+        :param totals: An iterable of `(provider_npi, total net fee)` pairs
+        :param watermark: The `CommitWatermark` of `totals`, `None` replays every buffered claim
+        """
+        pending = self._pending or []
+        self._pending = None
+        self.totals = dict(totals)
+        self.evicted_max = None
+        self.partial = set()
+        if self.capacity is not None and len(self.totals) > self.capacity:
+            self._trim(self.capacity)
+        else:
+            self._heapify()
+        for position, provider_npi, net_fee in pending:
+            if position is None or watermark is None or not watermark.counts(*position):
+                self._add(provider_npi, net_fee)
+        self.watermark = watermark
+        self.loaded = True
+
+    def abort_load(self):
+        """
+        The function `abort_load` cancels a load started by `begin_load` and applies the buffered claims.
+        """
+        pending = self._pending or []
+        self._pending = None
+        for _, provider_npi, net_fee in pending:
+            self._add(provider_npi, net_fee)
+
+    def _add(self, key, value):
+        position = self.positions.get(key)
+        if position is None:
+            if self.evicted_max is not None:
+                self.partial.add(key)
+            self.totals[key] = value
+            self.positions[key] = len(self.heap)
+            self.heap.append(key)
+            self._sift_up(len(self.heap) - 1)
+            if self.capacity is not None and len(self.heap) > self.capacity:
+                # evict in bulk so that the O(P) rebuild is amortized over many new providers
+                self._trim(max(1, int(self.capacity * 0.9)))
+            return
+        self.totals[key] += value
+        if value >= 0:
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
+
+    def _trim(self, size):
+        ranked = heapq.nlargest(size + 1, self.totals.items(), key=itemgetter(1))
+        self.totals = dict(ranked[:size])
+        if len(ranked) > size:
+            kept = {key for key in self.partial if key in self.totals}
+            # an evicted partial provider may miss the previous `evicted_max` on top of its total
+            missed = max(self.evicted_max, 0.0) if len(kept) < len(self.partial) else 0.0
+            evicted = ranked[size][1] + missed
+            self.evicted_max = evicted if self.evicted_max is None else max(self.evicted_max, evicted)
+            self.partial = kept
+        self._heapify()
+
+    def _heapify(self):
+        self.heap = list(self.totals)
+        self.positions = {key: index for index, key in enumerate(self.heap)}
+        for index in reversed(range(len(self.heap) // 2)):
+            self._sift_down(index)
+
+    def _swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.positions[heap[i]] = i
+        self.positions[heap[j]] = j
+
+    def _sift_up(self, index):
+        totals, heap = self.totals, self.heap
+        while index > 0:
+            parent = (index - 1) // 2
+            if totals[heap[index]] <= totals[heap[parent]]:
+                break
+            self._swap(index, parent)
+            index = parent
+
+    def _sift_down(self, index):
+        totals, heap = self.totals, self.heap
+        size = len(heap)
+        while True:
+            largest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and totals[heap[child]] > totals[heap[largest]]:
+                    largest = child
+            if largest == index:
+                break
+            self._swap(index, largest)
+            index = largest
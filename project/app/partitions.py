@@ -0,0 +1,29 @@
+import asyncio
+import sys
+from datetime import date
+from .config.db_config import async_session
+from .config.env_config import envs
+from .services.claim_partitions import detach_claim_partition, maintain_claim_partitions
+
+
+async def main(args: list[str]) -> None:
+    """
+    The function `main` manages the monthly partitions of `claim`:
+
+        python -m app.partitions maintain              # create the missing partitions
+        python -m app.partitions detach 2018-03        # detach the partition of March 2018
+        python -m app.partitions detach 2018-03 --archive
+    """
+    async with async_session() as session:
+        if args[:1] == ["maintain"]:
+            created = await maintain_claim_partitions(session, envs.CLAIM_PARTITIONS_AHEAD)
+            print(f"Created {created} partitions")
+        elif args[:1] == ["detach"] and len(args) >= 2:
+            month = date.fromisoformat(f"{args[1]}-01")
+            print(f"Detached {await detach_claim_partition(session, month, archive='--archive' in args)}")
+        else:
+            print(main.__doc__)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))  # pragma: no cover
@@ -0,0 +1,21 @@
+import asyncio
+import sys
+from .config.db_config import async_session
+from .services.provider_stats import rebuild_provider_stats
+
+
+async def main(args: list[str]) -> None:
+    """
+    The function `main` manages the net fee statistics of the providers:
+
+        python -m app.provider_stats rebuild           # recompute them from the claims
+    """
+    async with async_session() as session:
+        if args[:1] == ["rebuild"]:
+            print(f"Rebuilt the statistics from {await rebuild_provider_stats(session)} claims")
+        else:
+            print(main.__doc__)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))  # pragma: no cover
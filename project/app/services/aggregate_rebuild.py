@@ -0,0 +1,82 @@
+from sqlalchemy import Column, MetaData, Table, delete, insert, select, text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.commitWatermark import CommitWatermark
+from ..models.models import Claim
+from .ranking import UNCOUNTED_CLAIMS, watermark_query
+
+# Suffix of the staging tables the aggregates are rebuilt into before being swapped in.
+STAGING_SUFFIX = "_rebuild"
+
+# Columns of the claims committed during a rebuild, added to the swapped in aggregates like a batch.
+DELTA_COLUMNS = ["provider_npi", "service_dttm", "group_id", "quadrant", "submitted_proc", "net_fee"]
+
+
+def staging_table(table: Table) -> Table:
+    """
+    The function `staging_table` returns a table with the columns and the primary key of `table`, named
+    after it with `STAGING_SUFFIX`. Its other indexes are not copied, their names being unique per schema.
+    """
+    columns = (Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+               for column in table.columns)
+    return Table(f"{table.name}{STAGING_SUFFIX}", MetaData(), *columns)
+
+
+async def rebuild_from_claims(session: AsyncSession, tables: list[Table], fill, apply_claims):
+    """
+    The function `rebuild_from_claims` recomputes aggregate `tables` from the `claim` table without
+    holding up the ingest for the whole rebuild, in two transactions:
+
+    - `fill(session, staging)` fills a staging copy of every table (`staging` maps the name of a table to
+      its copy) from the claims of a single snapshot, every statement of the transaction reading the same
+      one (`REPEATABLE READ` on postgres). `claim` is not locked: batches keep being stored and counted
+      by the live tables meanwhile.
+    - `claim` is then locked in `SHARE` mode, the rows of the live tables are replaced by the ones of
+      their staging copies, and `apply_claims(session, rows)` adds the claims the snapshot did not count
+      (see `CommitWatermark`), like the claims of a batch. The batches of `/claims` only wait for this
+      swap, instead of being counted twice or missed, and the rankings read the previous rows until the
+      commit.
+
+    :param session: A session without a transaction begun
+    :type session: AsyncSession
+    :param tables: The aggregate tables rebuilt
+    :type tables: list[Table]
+    :param fill: A coroutine function filling the staging tables and returning the result of the rebuild
+    :param apply_claims: A coroutine function adding claim rows of `DELTA_COLUMNS` to the live tables
+    :return: What `fill` returned.
+    """
+    dialect_name = session.bind.dialect.name
+    staging = {table.name: staging_table(table) for table in tables}
+    try:
+        if dialect_name == "postgresql":
+            await session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        connection = await session.connection()
+        for table in staging.values():
+            await connection.run_sync(table.drop, checkfirst=True)
+            await connection.run_sync(table.create)
+        current = watermark_query(dialect_name)
+        watermark = CommitWatermark.parse((await connection.execute(select(current.c.watermark))).scalar())
+        rebuilt = await fill(session, staging)
+        await session.commit()
+
+        connection = await session.connection()
+        if dialect_name == "postgresql":
+            await connection.execute(text("LOCK TABLE claim IN SHARE MODE"))
+        for table in tables:
+            # DELETE rather than TRUNCATE, whose exclusive lock would block the rankings
+            await connection.execute(delete(table))
+            columns = [column.name for column in table.columns]
+            await connection.execute(insert(table).from_select(columns, select(*(staging[table.name].c[column]
+                                                                                  for column in columns))))
+            await connection.run_sync(staging[table.name].drop)
+        if watermark.xmax:
+            uncounted = UNCOUNTED_CLAIMS.bindparams(xmin=watermark.xmin, snapshot=watermark.snapshot)
+        else:
+            uncounted = Claim.id > watermark.max_id
+        result = await connection.execute(select(*(Claim.__table__.c[column] for column in DELTA_COLUMNS))
+                                          .where(uncounted))
+        await apply_claims(session, [dict(row._mapping) for row in result])
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    return rebuilt
@@ -0,0 +1,319 @@
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import NamedTuple
+from sqlalchemy import insert, literal, select
+from sqlalchemy.sql import func
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.models import Claim, ClaimDimensionTotal, ProviderDailyTotal, ProviderFeeBucket, ProviderStats, ProviderTotal
+from .aggregate_rebuild import rebuild_from_claims
+from .claim_columns import validate_claim_columns
+from .claim_ingest import (assign_content_hashes, insert_claim_rows, upsert_claim_dimension_totals,
+                           upsert_provider_daily_totals, upsert_provider_stats, upsert_provider_totals)
+from .claim_partitions import ensure_claim_partitions
+from .claim_upload import CsvRecordSplitter, normalize_record, parse_line
+from .provider_stats import recompute_provider_stats
+
+logger = logging.getLogger(__name__)
+
+FILE_FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+
+def file_format_of(path: str) -> str:
+    """
+    The function `file_format_of` returns "csv" or "ndjson" from the extension of a claim file. It
+    raises a `ValueError` for any other extension.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FILE_FORMATS:
+        raise ValueError(f"Unsupported claim file: {path}")
+    return FILE_FORMATS[extension]
+
+
+class SkippedRecord(NamedTuple):
+    """
+    The class `SkippedRecord` stands in a chunk for a record of `line_count` lines which could not be
+    split from the file, with its `error`.
+    """
+    line_count: int
+    error: str
+
+
+def read_chunks(path: str, file_format: str, chunk_size: int):
+    """
+    The generator `read_chunks` reads a claim file and yields its records in chunks of `chunk_size` as
+    `(index, first_line_number, header, lines)` tuples, where `header` holds the cells of the header
+    line of a CSV file. The lines of a CSV record whose quoted cells span several lines are kept together
+    as one item, split by a `CsvRecordSplitter` like `iter_csv_rows` does for `/claims/upload`, and a
+    record it cannot split is a `SkippedRecord`. A file read again is cut in the same chunks, which a
+    checkpoint refers to by their index.
+    """
+    header = None
+    chunk, first_line_number, index = [], 1, 0
+
+    def records(claims):
+        if file_format != "csv":
+            yield from ((line_number, [line], None) for line_number, line in enumerate(claims, 1))
+            return
+        splitter = CsvRecordSplitter()
+        for line in claims:
+            yield from splitter.feed(line)
+        yield from splitter.close()
+
+    with open(path, encoding="utf-8-sig", newline="\n") as claims:
+        for line_number, lines, error in records(claims):
+            if error is not None:
+                line = SkippedRecord(1, error)
+            else:
+                line = "".join(lines).rstrip("\r\n")
+                if file_format == "csv" and header is None:
+                    if line.strip():
+                        header = next(csv.reader([line]))
+                    continue
+            if not chunk:
+                first_line_number = line_number
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield index, first_line_number, header, chunk
+                chunk, index = [], index + 1
+    if chunk:
+        yield index, first_line_number, header, chunk
+
+
+def parse_claim_lines(lines: list, file_format: str, header: list, first_line_number: int) -> tuple:
+    """
+    The function `parse_claim_lines` parses, normalizes and validates a chunk of lines like
+    `/claims/upload` does, with the rules of `ClaimBase` and the net fee formula applied by
+    `validate_claim_columns`, and computes the content hashes of the valid claims, identical claims
+    collapsing like in an upload (see `claim_content_hashes`). It runs in the
+    processes of the pool of the bulk loader, so its arguments and results are plain picklable values.
+
+    :return: A tuple `(rows, errors, lines)` with the column dictionaries of the valid claims, the
+    `(line_number, errors)` of the invalid lines and the number of non blank lines.
+    """
+    records, line_numbers, errors = [], [], []
+    count = 0
+    next_line_number = first_line_number
+    for line in lines:
+        if isinstance(line, SkippedRecord):
+            count += 1
+            errors.append((next_line_number, [{"loc": [], "msg": line.error, "type": "value_error.format"}]))
+            next_line_number += line.line_count
+            continue
+        # a CSV record may span several lines of the file
+        line_number, next_line_number = next_line_number, next_line_number + line.count("\n") + 1
+        if not line.strip():
+            continue
+        count += 1
+        record, error = parse_line(line, file_format, header)
+        if error is not None:
+            errors.append((line_number, [{"loc": [], "msg": error, "type": "value_error.format"}]))
+            continue
+        records.append(normalize_record(record))
+        line_numbers.append(line_number)
+    rows, invalid = validate_claim_columns(records)
+    errors.extend((line_numbers[index], invalid[index]) for index in invalid)
+    errors.sort(key=lambda error: error[0])
+    return assign_content_hashes(rows, count_occurrences=False), errors, count
+
+
+class LoadCheckpoint:
+    """
+    The class `LoadCheckpoint` records in a JSON file the chunks of a claim file whose claims are
+    committed, so that an interrupted load resumes with the other ones. The checkpoint is replaced
+    atomically after every chunk. A chunk committed just before an interruption, but not recorded yet,
+    is loaded again harmlessly: its claims have the same content hashes and are skipped.
+    """
+
+    def __init__(self, path: str, source: str, chunk_size: int):
+        """
+        :param path: The path of the checkpoint file
+        :param source: The path of the claim file, which is loaded again from the start if it changed
+        :param chunk_size: The number of lines per chunk, the one of an existing checkpoint prevails since
+        its chunk indexes depend on it
+        """
+        stat = os.stat(source)
+        self.path = path
+        self.source = {"file": os.path.abspath(source), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        self.chunk_size = chunk_size
+        # chunks below `done_below` are all committed, `done` holds the ones committed after a gap
+        self.done_below = 0
+        self.done = set()
+        self.report = {"lines": 0, "inserted": 0, "duplicates": 0, "failed": 0}
+        try:
+            with open(path) as checkpoint:
+                state = json.load(checkpoint)
+        except FileNotFoundError:
+            return
+        if state["source"] != self.source:
+            logger.warning("%s changed since its checkpoint, loading it from the start", source)
+            return
+        self.chunk_size = state["chunk_size"]
+        self.done_below = state["done_below"]
+        self.done = set(state["done"])
+        self.report = state["report"]
+
+    def is_done(self, index: int) -> bool:
+        return index < self.done_below or index in self.done
+
+    def mark_done(self, index: int, counts: dict) -> None:
+        self.done.add(index)
+        while self.done_below in self.done:
+            self.done.remove(self.done_below)
+            self.done_below += 1
+        for key, count in counts.items():
+            self.report[key] += count
+        self.save()
+
+    def save(self) -> None:
+        state = {"source": self.source, "chunk_size": self.chunk_size, "done_below": self.done_below,
+                 "done": sorted(self.done), "report": self.report}
+        partial = f"{self.path}.tmp"
+        with open(partial, "w") as checkpoint:
+            json.dump(state, checkpoint)
+        os.replace(partial, self.path)
+
+
+def checkpoint_path(checkpoint_dir: str, source: str) -> str:
+    """
+    The function `checkpoint_path` returns the path of the checkpoint of a claim file in
+    `checkpoint_dir`, named after the file and a digest of its absolute path.
+    """
+    digest = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:12]
+    return os.path.join(checkpoint_dir, f"{os.path.basename(source)}.{digest}.json")
+
+
+async def write_claim_rows(session: AsyncSession, rows: list[dict], partitions: set) -> int:
+    """
+    The function `write_claim_rows` commits the claims of a chunk whose content hash is not stored yet,
+    streamed with `COPY` on postgres, and returns how many it inserted. The partitions of their months
+    missing from `partitions`, the months already seen by the load, are created first. The aggregate
+    tables are not updated, see `rebuild_claim_aggregates`.
+    """
+    if not rows:
+        return 0
+    months = {row["service_dttm"].date().replace(day=1) for row in rows} - partitions
+    if months:
+        await ensure_claim_partitions(session, months)
+        partitions |= months
+    try:
+        ids = await insert_claim_rows(session, rows, copy_threshold=1)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    return len(ids)
+
+
+async def load_claim_file(path: str, session_factory, pool, checkpoint: LoadCheckpoint, file_format: str = None,
+                          connections: int = 4, prefetch: int = 8, errors_path: str = None) -> dict:
+    """
+    The function `load_claim_file` loads a CSV or NDJSON claim file into the `claim` table. Its chunks
+    are parsed and validated in parallel by the processes of `pool` and written by `connections`
+    concurrent sessions, each chunk in its own transaction. The chunks recorded by `checkpoint` are
+    skipped, the other ones are recorded once committed.
+
+    :param path: The path of the claim file
+    :type path: str
+    :param session_factory: Creates the sessions writing the chunks, e.g. a `sessionmaker`
+    :param pool: The executor parsing the chunks, e.g. a `ProcessPoolExecutor`
+    :param checkpoint: The checkpoint of the file
+    :type checkpoint: LoadCheckpoint
+    :param file_format: "csv" or "ndjson", from the extension of the file by default
+    :type file_format: str
+    :param connections: The number of chunks written concurrently
+    :type connections: int
+    :param prefetch: The number of chunks parsed ahead of the writers, which bounds the memory used
+    :type prefetch: int
+    :param errors_path: A file the line errors are appended to, as NDJSON, if given
+    :type errors_path: str
+    :return: The report of the file, with the number of lines read, inserted, already stored
+    (`duplicates`) and failed, including the chunks loaded before an interruption.
+    """
+    file_format = file_format or file_format_of(path)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=prefetch)
+    partitions = set()
+
+    async def produce():
+        for index, first_line_number, header, lines in read_chunks(path, file_format, checkpoint.chunk_size):
+            if checkpoint.is_done(index):
+                continue
+            parsed = loop.run_in_executor(pool, parse_claim_lines, lines, file_format, header, first_line_number)
+            await queue.put((index, parsed))
+        for _ in range(connections):
+            await queue.put(None)
+
+    async def write():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, parsed = item
+            rows, errors, lines = await parsed
+            async with session_factory() as session:
+                inserted = await write_claim_rows(session, rows, partitions)
+            if errors and errors_path is not None:
+                with open(errors_path, "a") as error_log:
+                    error_log.writelines(json.dumps({"file": path, "line": line_number, "errors": detail}) + "\n"
+                                         for line_number, detail in errors)
+            checkpoint.mark_done(index, {"lines": lines, "inserted": inserted, "duplicates": len(rows) - inserted,
+                                         "failed": len(errors)})
+
+    tasks = [asyncio.ensure_future(produce()), *(asyncio.ensure_future(write()) for _ in range(connections))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return checkpoint.report
+
+
+async def rebuild_claim_aggregates(session: AsyncSession) -> int:
+    """
+    The function `rebuild_claim_aggregates` recomputes the `provider_totals`, `provider_daily_totals`
+    and `claim_dimension_totals` aggregates and the `provider_stats` summaries from the `claim` table,
+    once at the end of a bulk load instead of per chunk. They are rebuilt into staging tables and swapped
+    in by `rebuild_from_claims`, which only locks `claim` for the swap.
+
+    :return: The number of providers.
+    """
+    tables = [ProviderTotal.__table__, ProviderDailyTotal.__table__, ClaimDimensionTotal.__table__,
+              ProviderStats.__table__, ProviderFeeBucket.__table__]
+
+    async def fill(session: AsyncSession, staging: dict) -> int:
+        connection = await session.connection()
+        result = await connection.execute(insert(staging["provider_totals"]).from_select(
+            ["provider_npi", "net_fee_sum", "claim_count", "updated_at"],
+            select(Claim.provider_npi, func.sum(Claim.net_fee), func.count(), literal(datetime.utcnow()))
+            .group_by(Claim.provider_npi),
+        ))
+        service_date = func.date(Claim.service_dttm)
+        await connection.execute(insert(staging["provider_daily_totals"]).from_select(
+            ["service_date", "provider_npi", "net_fee_sum", "claim_count"],
+            select(service_date, Claim.provider_npi, func.sum(Claim.net_fee), func.count())
+            .group_by(service_date, Claim.provider_npi),
+        ))
+        quadrant = func.coalesce(Claim.quadrant, "")
+        await connection.execute(insert(staging["claim_dimension_totals"]).from_select(
+            ["provider_npi", "group_id", "quadrant", "submitted_proc", "net_fee_sum", "claim_count"],
+            select(Claim.provider_npi, Claim.group_id, quadrant, Claim.submitted_proc, func.sum(Claim.net_fee),
+                   func.count())
+            .group_by(Claim.provider_npi, Claim.group_id, quadrant, Claim.submitted_proc),
+        ))
+        await recompute_provider_stats(session, stats_table=staging["provider_stats"],
+                                       buckets_table=staging["provider_fee_buckets"])
+        return result.rowcount
+
+    async def apply_claims(session: AsyncSession, rows: list[dict]) -> None:
+        await upsert_provider_totals(session, rows)
+        await upsert_provider_daily_totals(session, rows)
+        await upsert_claim_dimension_totals(session, rows)
+        await upsert_provider_stats(session, rows)
+
+    return await rebuild_from_claims(session, tables, fill, apply_claims)
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import re
+import time
+from typing import Optional
+from sqlalchemy import text, tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.models import Claim
+
+# Columns of the claims sent by the feed, `id` first.
+FEED_COLUMNS = [column.name for column in Claim.__table__.columns if column.name != "xid"]
+
+# A feed cursor is the position `(xid, id)` of the last claim consumed, written `<xid>-<id>`. A plain id is
+# the cursor of the feeds read before the claims had an xid, all stored with xid 0.
+FEED_CURSOR = re.compile(r"^(?:([0-9]+)-)?([0-9]+)$")
+
+# The oldest transaction still running: every claim stored by an older one is committed (or rolled back).
+FEED_HORIZON_QUERY = text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+
+
+def parse_feed_cursor(value: str) -> tuple[int, int]:
+    """
+    The function `parse_feed_cursor` reads a cursor of `/claims/feed` into its `(xid, id)` position. It
+    raises a `ValueError` when the cursor is malformed.
+    """
+    match = FEED_CURSOR.match(value)
+    if match is None:
+        raise ValueError(f"invalid feed cursor: {value}")
+    return int(match.group(1) or 0), int(match.group(2))
+
+
+def format_feed_cursor(cursor: tuple[int, int]) -> str:
+    return f"{cursor[0]}-{cursor[1]}"
+
+
+async def feed_horizon(session: AsyncSession) -> Optional[int]:
+    """
+    The function `feed_horizon` returns the xid below which the feed can be read: the xmin of the current
+    snapshot, the oldest transaction still running. Claims are ordered by the xid of the transaction
+    which stored them, and a transaction still running may commit claims with lower ids than claims
+    already committed (ids are reserved by `/claims?mode=async`, concurrent batches take them in any
+    order), so a claim is only sent once no running transaction can commit a claim before it. It returns
+    `None` on other dialects than postgres, whose writes are serialized.
+    """
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        return None
+    return (await connection.execute(FEED_HORIZON_QUERY)).scalar()
+
+
+async def next_feed_cursor(session: AsyncSession, cursor: tuple[int, int], limit: int,
+                           horizon: Optional[int] = None) -> tuple[int, int]:
+    """
+    The function `next_feed_cursor` returns the position of the last claim of the next page, i.e. of the
+    `limit`-th claim after `cursor` in `(xid, id)` order stored by a transaction below `horizon`, or
+    `cursor` when there is none. It only walks the `(xid, id)` index, so the page can be streamed
+    afterwards with its bounds known up front.
+    """
+    position = tuple_(Claim.xid, Claim.id)
+    page = select(Claim.xid, Claim.id).where(position > tuple_(*cursor))
+    if horizon is not None:
+        page = page.where(Claim.xid < horizon)
+    page = page.order_by(Claim.xid, Claim.id).limit(limit).subquery()
+    result = await session.execute(select(page.c.xid, page.c.id).order_by(page.c.xid.desc(), page.c.id.desc()).limit(1))
+    last = result.first()
+    return tuple(last) if last else cursor
+
+
+async def wait_for_feed_cursor(session: AsyncSession, cursor: tuple[int, int], limit: int, wait: float,
+                               poll_interval: float = 0.5) -> tuple[int, int]:
+    """
+    The function `wait_for_feed_cursor` is `next_feed_cursor`, below the current `feed_horizon`, with
+    long polling: when no claim follows `cursor` it checks again every `poll_interval` seconds for up to
+    `wait` seconds. The connection is given back to the pool between two checks.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        next_cursor = await next_feed_cursor(session, cursor, limit, await feed_horizon(session))
+        if next_cursor > cursor or time.monotonic() >= deadline:
+            return next_cursor
+        await session.close()
+        await asyncio.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+
+def claim_json(row) -> str:
+    claim = dict(zip(FEED_COLUMNS, row))
+    claim["service_dttm"] = claim["service_dttm"].isoformat()
+    return json.dumps(claim)
+
+
+async def stream_feed(session: AsyncSession, cursor: tuple[int, int], end: tuple[int, int], partition_size: int = 500):
+    """
+    The generator `stream_feed` yields the claims positioned after `cursor` and up to `end` included as
+    NDJSON, in `(xid, id)` order. The rows are read with a server side cursor and sent `partition_size`
+    at a time, so the memory used does not depend on the size of the page.
+    """
+    if end <= cursor:
+        return
+    position = tuple_(Claim.xid, Claim.id)
+    statement = (select(*(Claim.__table__.c[column] for column in FEED_COLUMNS))
+                 .where(position > tuple_(*cursor), position <= tuple_(*end))
+                 .order_by(Claim.xid, Claim.id))
+    result = await session.stream(statement)
+    async for partition in result.partitions(partition_size):
+        yield "".join(claim_json(row) + "\n" for row in partition)
@@ -0,0 +1,436 @@
+import hashlib
+import json
+from datetime import datetime
+from sqlalchemy import case, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.models import (Claim, ClaimCreate, ClaimDimensionTotal, ProviderDailyTotal, ProviderFeeBucket,
+                             ProviderStats, ProviderTotal)
+from ..models.netFeeSummary import NetFeeSummary
+
+# Columns written for every claim, in the order used by the multi-row INSERT and by COPY.
+CLAIM_COLUMNS = [
+    "service_dttm",
+    "submitted_proc",
+    "group_id",
+    "subscriber_id",
+    "provider_npi",
+    "provider_fees",
+    "allowed_fees",
+    "member_co_ins",
+    "member_co_pay",
+    "quadrant",
+    "net_fee",
+]
+
+# Columns written by the INSERT statements and by COPY, `id` aside.
+INSERT_COLUMNS = [*CLAIM_COLUMNS, "content_hash"]
+
+# Fields identifying a claim in its content hash, besides `service_dttm`.
+HASHED_COLUMNS = [column for column in CLAIM_COLUMNS if column not in ("service_dttm", "net_fee")]
+
+
+def compute_net_fee(provider_fees: float, member_co_pay: float, member_co_ins: float, allowed_fees: float) -> float:
+    """
+    The function `compute_net_fee` applies the net fee formula of the claim process:
+    "net fee" = "provider fees" + "member coinsurance" + "member copay" - "Allowed fees".
+    """
+    return provider_fees + member_co_pay + member_co_ins - allowed_fees
+
+
+def build_claim_rows(claims: list[ClaimCreate]) -> list[dict]:
+    """
+    The function `build_claim_rows` turns validated `ClaimCreate` objects into plain column dictionaries
+    with the `net_fee` already computed, ready to be written in bulk without creating ORM objects.
+
+    :param claims: The list of validated claims received by the `/claims` endpoint
+    :type claims: list[ClaimCreate]
+    :return: A list of dictionaries keyed by the `claim` table columns (without `id`).
+    """
+    rows = []
+    for claim in claims:
+        row = claim.dict(include=set(CLAIM_COLUMNS))
+        row["net_fee"] = compute_net_fee(claim.provider_fees, claim.member_co_pay, claim.member_co_ins, claim.allowed_fees)
+        rows.append(row)
+    return rows
+
+
+def chunked(rows: list, chunk_size: int):
+    """
+    The generator `chunked` yields consecutive slices of `rows` holding at most `chunk_size` items.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+
+def claim_content_hashes(rows: list[dict], count_occurrences: bool = True) -> list[str]:
+    """
+    The function `claim_content_hashes` computes the content hash of every row of a batch: the sha256 of
+    its claim fields (not its id nor its net fee, which derives from them) and of its occurrence among
+    the identical claims of the batch. The same batch sent again gets the same hashes, while identical
+    claims sent together remain distinct claims.
+
+    Without `count_occurrences` every claim is hashed as a first occurrence, so identical claims collapse
+    into one. Claim files are hashed that way: they are stored chunk by chunk, and counting the
+    occurrences per chunk would make the claims kept depend on where the chunks are cut.
+    """
+    hashes = []
+    occurrences = {}
+    for row in rows:
+        fields = json.dumps([row["service_dttm"].isoformat(), *(row[column] for column in HASHED_COLUMNS)])
+        occurrence = occurrences.get(fields, 0)
+        if count_occurrences:
+            occurrences[fields] = occurrence + 1
+        hashes.append(hashlib.sha256(f"{fields}#{occurrence}".encode()).hexdigest())
+    return hashes
+
+
+def assign_content_hashes(rows: list[dict], count_occurrences: bool = True) -> list[dict]:
+    """
+    The function `assign_content_hashes` sets the `content_hash` of the rows of a batch, see
+    `claim_content_hashes`.
+    """
+    for row, content_hash in zip(rows, claim_content_hashes(rows, count_occurrences)):
+        row["content_hash"] = content_hash
+    return rows
+
+
+async def insert_claim_rows(session: AsyncSession, rows: list[dict], chunk_size: int = 1000, copy_threshold: int = None) -> dict:
+    """
+    The function `insert_claim_rows` writes the rows of a batch whose `content_hash` is not stored yet,
+    inside the transaction of `session`, and returns the ids of the rows it inserted keyed by their
+    content hash. Rows already stored are skipped, and so are the rows of the batch hashed like an
+    earlier one. It does not commit.
+
+    On postgres each chunk of `chunk_size` rows is sent as one multi-row `INSERT ... ON CONFLICT
+    (content_hash, service_dttm) DO NOTHING RETURNING id, content_hash` (the unique indexes of the
+    partitioned `claim` table include its partition key), and batches of at least `copy_threshold` rows
+    are streamed with `COPY` into a temporary table and moved to `claim` with a
+    single `INSERT ... SELECT ... ON CONFLICT DO NOTHING`. Other dialects look the hashes up first and
+    insert the new rows with a single ORM flush. Rows may carry an `id` reserved beforehand with
+    `reserve_claim_ids`, in which case it is written as is.
+
+    :param session: The session whose transaction receives the rows
+    :type session: AsyncSession
+    :param rows: Claim column dictionaries with their `content_hash`
+    :type rows: list[dict]
+    :param chunk_size: The maximum number of rows sent in one INSERT statement
+    :type chunk_size: int
+    :param copy_threshold: The batch size from which COPY is used, `None` disables COPY
+    :type copy_threshold: int
+    :return: The ids of the inserted claims keyed by content hash.
+    """
+    if not rows:
+        return {}
+    unique = {}
+    for row in rows:
+        unique.setdefault(row["content_hash"], row)
+    rows = list(unique.values())
+    connection = await session.connection()
+    dialect = connection.dialect
+    if dialect.name != "postgresql":
+        return await _flush_claim_rows(session, rows)
+    if copy_threshold is not None and len(rows) >= copy_threshold and dialect.driver == "asyncpg":
+        return await _copy_claim_rows(connection, rows)
+
+    inserted = {}
+    table = Claim.__table__
+    for chunk in chunked(rows, chunk_size):
+        statement = (postgresql.insert(table).values(chunk)
+                     .on_conflict_do_nothing(index_elements=[table.c.content_hash, table.c.service_dttm])
+                     .returning(table.c.id, table.c.content_hash))
+        result = await connection.execute(statement)
+        inserted.update((row.content_hash, row.id) for row in result)
+    return inserted
+
+
+async def reserve_claim_ids(session: AsyncSession, count: int) -> list[int]:
+    """
+    The function `reserve_claim_ids` takes `count` ids from the `claim` id sequence in a single round
+    trip, so that claims can be given their ids before being written. The sequence is not
+    transactional: the ids stay reserved even if the transaction is rolled back. Postgres only.
+    """
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        raise NotImplementedError(f"Reserving claim ids is not supported for {connection.dialect.name}")
+    result = await connection.execute(
+        text("SELECT nextval(pg_get_serial_sequence('claim', 'id')) FROM generate_series(1, :n)"),
+        {"n": count},
+    )
+    return result.scalars().all()
+
+
+async def fetch_claim_ids(session: AsyncSession, content_hashes: list[str]) -> dict:
+    """
+    The function `fetch_claim_ids` returns the ids of the stored claims with the given content hashes,
+    keyed by content hash.
+    """
+    ids = {}
+    for chunk in chunked(content_hashes, 1000):
+        result = await session.execute(select(Claim.content_hash, Claim.id).where(Claim.content_hash.in_(chunk)))
+        ids.update((row.content_hash, row.id) for row in result)
+    return ids
+
+
+async def _flush_claim_rows(session: AsyncSession, rows: list[dict]) -> dict:
+    """
+    The function `_flush_claim_rows` inserts the rows whose content hash is not stored yet through the
+    ORM with one flush, which lets dialects without `INSERT ... RETURNING` support (e.g. sqlite) report
+    the generated ids.
+    """
+    stored = await fetch_claim_ids(session, [row["content_hash"] for row in rows])
+    claims = [Claim(**row) for row in rows if row["content_hash"] not in stored]
+    session.add_all(claims)
+    await session.flush()
+    return {claim.content_hash: claim.id for claim in claims}
+
+
+async def _copy_claim_rows(connection, rows: list[dict]) -> dict:
+    """
+    The function `_copy_claim_rows` streams the rows with asyncpg's binary `COPY` into a temporary
+    table dropped at commit, then moves the ones whose content hash is not stored yet to `claim` in one
+    statement, which takes the ids of the rows without one from the `claim` sequence. Everything runs on
+    the connection of the current transaction, so it is rolled back together with the rest of the batch.
+    """
+    await connection.execute(text("CREATE TEMP TABLE claim_incoming (LIKE claim INCLUDING DEFAULTS) ON COMMIT DROP"))
+    columns = ["id", *INSERT_COLUMNS] if "id" in rows[0] else INSERT_COLUMNS
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.connection.driver_connection.copy_records_to_table(
+        "claim_incoming", records=[tuple(row[column] for column in columns) for row in rows], columns=columns
+    )
+    column_list = ", ".join(["id", *INSERT_COLUMNS])
+    result = await connection.execute(text(
+        f"INSERT INTO claim ({column_list}) SELECT {column_list} FROM claim_incoming "
+        "ON CONFLICT (content_hash, service_dttm) DO NOTHING RETURNING id, content_hash"
+    ))
+    return {row.content_hash: row.id for row in result}
+
+
+def upsert_statement(dialect_name: str, table):
+    """
+    The function `upsert_statement` returns an `INSERT` construct of `table` supporting
+    `on_conflict_do_update` / `on_conflict_do_nothing` for the given dialect (postgres or sqlite).
+    """
+    if dialect_name == "postgresql":
+        return postgresql.insert(table)
+    if dialect_name == "sqlite":
+        return sqlite.insert(table)
+    raise NotImplementedError(f"INSERT ... ON CONFLICT is not supported for {dialect_name}")
+
+
+async def upsert_sums(session: AsyncSession, table, key_columns: list[str], sums: dict, chunk_size: int = 1000,
+                      extra_values: dict = None) -> None:
+    """
+    The function `upsert_sums` adds per key net fee sums and claim counts to an aggregate table with
+    `INSERT ... ON CONFLICT DO UPDATE`, in the transaction of `session`. The keys are written in sorted
+    order, so that concurrent batches lock their rows in the same order.
+
+    :param session: The session whose transaction stores the claims of the batch
+    :type session: AsyncSession
+    :param table: The aggregate table, with `net_fee_sum` and `claim_count` columns
+    :param key_columns: The columns of the primary key of `table`
+    :type key_columns: list[str]
+    :param sums: Maps a tuple of key values to a `(net_fee_sum, claim_count)` tuple
+    :type sums: dict
+    :param extra_values: Other columns set on insert and on update (e.g. `updated_at`)
+    :type extra_values: dict
+    """
+    if not sums:
+        return
+    connection = await session.connection()
+    extra_values = extra_values or {}
+    values = [{**dict(zip(key_columns, key)), "net_fee_sum": net_fee_sum, "claim_count": claim_count, **extra_values}
+              for key, (net_fee_sum, claim_count) in sorted(sums.items())]
+    for chunk in chunked(values, chunk_size):
+        statement = upsert_statement(connection.dialect.name, table).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[column] for column in key_columns],
+            set_={
+                "net_fee_sum": table.c.net_fee_sum + statement.excluded.net_fee_sum,
+                "claim_count": table.c.claim_count + statement.excluded.claim_count,
+                **{column: statement.excluded[column] for column in extra_values},
+            },
+        )
+        await connection.execute(statement)
+
+
+def sum_by(rows: list[dict], key) -> dict:
+    """
+    The function `sum_by` sums the net fees and counts the claims of `rows` per `key(row)`.
+    """
+    sums = {}
+    for row in rows:
+        row_key = key(row)
+        net_fee_sum, claim_count = sums.get(row_key, (0.0, 0))
+        sums[row_key] = (net_fee_sum + row["net_fee"], claim_count + 1)
+    return sums
+
+
+async def upsert_provider_totals(session: AsyncSession, rows: list[dict], chunk_size: int = 1000) -> None:
+    """
+    The function `upsert_provider_totals` adds the net fees and the number of claims of a batch to the
+    `provider_totals` table, summed per provider first.
+    """
+    sums = sum_by(rows, lambda row: (row["provider_npi"],))
+    await upsert_sums(session, ProviderTotal.__table__, ["provider_npi"], sums, chunk_size,
+                      extra_values={"updated_at": datetime.utcnow()})
+
+
+async def upsert_provider_daily_totals(session: AsyncSession, rows: list[dict], chunk_size: int = 1000) -> None:
+    """
+    The function `upsert_provider_daily_totals` adds the net fees and the number of claims of a batch
+    to the `provider_daily_totals` buckets, summed per service day and provider first.
+    """
+    sums = sum_by(rows, lambda row: (row["service_dttm"].date(), row["provider_npi"]))
+    await upsert_sums(session, ProviderDailyTotal.__table__, ["service_date", "provider_npi"], sums, chunk_size)
+
+
+async def upsert_claim_dimension_totals(session: AsyncSession, rows: list[dict], chunk_size: int = 1000) -> None:
+    """
+    The function `upsert_claim_dimension_totals` adds the net fees and the number of claims of a batch
+    to the `claim_dimension_totals` rollup, summed per provider, group, quadrant and procedure first.
+    """
+    sums = sum_by(rows, lambda row: (row["provider_npi"], row["group_id"], row["quadrant"] or "", row["submitted_proc"]))
+    await upsert_sums(session, ClaimDimensionTotal.__table__, ["provider_npi", "group_id", "quadrant", "submitted_proc"],
+                      sums, chunk_size)
+
+
+def summarize_by_provider(rows: list[dict]) -> dict:
+    """
+    The function `summarize_by_provider` builds the `NetFeeSummary` of the net fees of `rows` per provider.
+    """
+    net_fees = {}
+    for row in rows:
+        net_fees.setdefault(row["provider_npi"], []).append(row["net_fee"])
+    return {provider_npi: NetFeeSummary.of(values) for provider_npi, values in net_fees.items()}
+
+
+async def upsert_provider_summaries(session: AsyncSession, summaries: dict, chunk_size: int = 1000,
+                                    stats_table=ProviderStats.__table__,
+                                    buckets_table=ProviderFeeBucket.__table__) -> None:
+    """
+    The function `upsert_provider_summaries` merges per provider `NetFeeSummary` objects into the
+    `provider_stats` and `provider_fee_buckets` tables with `INSERT ... ON CONFLICT DO UPDATE`, in the
+    transaction of `session`. The moments are merged by the database with the parallel formula of Chan et
+    al. and the buckets of the sketches by adding their counts, so that concurrent batches of any worker
+    merge exactly, in sorted key order.
+
+    :param session: The session whose transaction stores the claims of the batch
+    :type session: AsyncSession
+    :param summaries: Maps a provider NPI to the `NetFeeSummary` of its new net fees
+    :type summaries: dict
+    :param stats_table: The table of the summaries, a staging copy of `provider_stats` during a rebuild
+    :param buckets_table: The table of the buckets, a staging copy of `provider_fee_buckets` during a rebuild
+    """
+    summaries = {provider_npi: summary for provider_npi, summary in summaries.items() if summary.count}
+    if not summaries:
+        return
+    connection = await session.connection()
+    updated_at = datetime.utcnow()
+    table = stats_table
+    values = [{"provider_npi": provider_npi, "claim_count": summary.count, "net_fee_mean": summary.mean,
+               "net_fee_m2": summary.m2, "net_fee_min": summary.minimum, "net_fee_max": summary.maximum,
+               "updated_at": updated_at}
+              for provider_npi, summary in sorted(summaries.items())]
+    for chunk in chunked(values, chunk_size):
+        statement = upsert_statement(connection.dialect.name, table).values(chunk)
+        stored, new = table.c, statement.excluded
+        # every SET expression reads the values stored before the update
+        delta = new.net_fee_mean - stored.net_fee_mean
+        claim_count = stored.claim_count + new.claim_count
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.provider_npi],
+            set_={
+                "claim_count": claim_count,
+                "net_fee_mean": stored.net_fee_mean + delta * new.claim_count / claim_count,
+                "net_fee_m2": stored.net_fee_m2 + new.net_fee_m2
+                + delta * delta * stored.claim_count * new.claim_count / claim_count,
+                "net_fee_min": case((new.net_fee_min < stored.net_fee_min, new.net_fee_min), else_=stored.net_fee_min),
+                "net_fee_max": case((new.net_fee_max > stored.net_fee_max, new.net_fee_max), else_=stored.net_fee_max),
+                "updated_at": new.updated_at,
+            },
+        )
+        await connection.execute(statement)
+
+    table = buckets_table
+    values = [{"provider_npi": provider_npi, "bucket": bucket, "claim_count": count}
+              for provider_npi, summary in sorted(summaries.items())
+              for bucket, count in sorted(summary.sketch.counts.items())]
+    for chunk in chunked(values, chunk_size):
+        statement = upsert_statement(connection.dialect.name, table).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.provider_npi, table.c.bucket],
+            set_={"claim_count": table.c.claim_count + statement.excluded.claim_count},
+        )
+        await connection.execute(statement)
+
+
+async def upsert_provider_stats(session: AsyncSession, rows: list[dict], chunk_size: int = 1000) -> None:
+    """
+    The function `upsert_provider_stats` merges the net fees of a batch into the `provider_stats` and
+    `provider_fee_buckets` tables, summarized per provider first.
+    """
+    await upsert_provider_summaries(session, summarize_by_provider(rows), chunk_size)
+
+
+async def fetch_transaction_id(session: AsyncSession):
+    """
+    The function `fetch_transaction_id` returns the id of the transaction of `session`, the `xid` its
+    claims are stored with on postgres, so that the rankings can tell whether totals read from the
+    database already count them (see `CommitWatermark`). It returns `None` on other dialects.
+    """
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        return None
+    return (await connection.execute(text("SELECT pg_current_xact_id()::text::bigint"))).scalar()
+
+
+async def ingest_claims(session: AsyncSession, rows: list[dict], chunk_size: int = 1000,
+                        copy_threshold: int = None) -> tuple[list[dict], list[dict]]:
+    """
+    The function `ingest_claims` stores a whole batch of claim rows in one transaction: either every row
+    is committed or, on any error, the transaction is rolled back and the error is raised again.
+
+    Ingestion is idempotent: every row gets a `content_hash` (see `claim_content_hashes`) and the rows
+    whose hash is already stored are not inserted again but given the id of the stored claim, so a
+    retried batch returns its original ids. Only the newly inserted rows are added to the
+    `provider_totals`, `provider_daily_totals` and `claim_dimension_totals` aggregates and to the
+    `provider_stats` summaries, in the same transaction.
+
+    :param session: The database session used for the batch
+    :type session: AsyncSession
+    :param rows: Claim column dictionaries as built by `build_claim_rows`, hashed as one batch unless
+    they already have their `content_hash`
+    :type rows: list[dict]
+    :return: A tuple `(rows, inserted)`: the same rows, each completed with its `id` and `content_hash`,
+    and the ones among them that were newly inserted, also completed with their `xid`.
+    """
+    if any("content_hash" not in row for row in rows):
+        assign_content_hashes(rows)
+    # rows hashed alike in the batch (see `count_occurrences`) are stored once, as the first of them
+    unique = {}
+    for row in rows:
+        unique.setdefault(row["content_hash"], row)
+    try:
+        ids = await insert_claim_rows(session, list(unique.values()), chunk_size=chunk_size,
+                                      copy_threshold=copy_threshold)
+        missing = [content_hash for content_hash in unique if content_hash not in ids]
+        stored = await fetch_claim_ids(session, missing) if missing else {}
+        inserted = [row for content_hash, row in unique.items() if content_hash in ids]
+        xid = await fetch_transaction_id(session) if inserted else None
+        await upsert_provider_totals(session, inserted, chunk_size=chunk_size)
+        await upsert_provider_daily_totals(session, inserted, chunk_size=chunk_size)
+        await upsert_claim_dimension_totals(session, inserted, chunk_size=chunk_size)
+        await upsert_provider_stats(session, inserted, chunk_size=chunk_size)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    for row in rows:
+        row["id"] = ids.get(row["content_hash"]) or stored[row["content_hash"]]
+    for row in inserted:
+        row["xid"] = xid if xid is not None else row.get("xid", 0)
+    return rows, inserted
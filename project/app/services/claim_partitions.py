@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from datetime import date
+from sqlalchemy import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# Schema the partitions are moved to by `detach_claim_partition(..., archive=True)`.
+ARCHIVE_SCHEMA = "archive"
+
+
+def partition_name(month: date) -> str:
+    """
+    The function `partition_name` returns the name of the partition of `claim` holding the claims of the
+    month of `month`, as created by the `create_claim_partition` database function.
+    """
+    return f"claim_y{month.year:04d}m{month.month:02d}"
+
+
+async def maintain_claim_partitions(session: AsyncSession, months_ahead: int = 3) -> int:
+    """
+    The function `maintain_claim_partitions` creates the monthly partitions of `claim` for the current
+    month and the next `months_ahead` ones, and for every month whose claims went to the default
+    partition, moving those claims. It commits and returns the number of partitions created. Only the
+    postgres `claim` table is partitioned: other dialects have nothing to maintain.
+    """
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        return 0
+    result = await connection.execute(text("SELECT maintain_claim_partitions(:months_ahead)"),
+                                      {"months_ahead": months_ahead})
+    created = result.scalar()
+    await session.commit()
+    return created
+
+
+async def ensure_claim_partitions(session: AsyncSession, months: set) -> int:
+    """
+    The function `ensure_claim_partitions` creates the missing partitions of the given months (any date
+    of each month) before their claims are written, so that a backfill of past months does not fill
+    the default partition. It commits and returns the number of partitions created. Postgres only:
+    other dialects have nothing to create.
+    """
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        return 0
+    created = 0
+    for month in sorted(months):
+        result = await connection.execute(text("SELECT create_claim_partition(:month)"), {"month": month})
+        created += bool(result.scalar())
+    await session.commit()
+    return created
+
+
+async def detach_claim_partition(session: AsyncSession, month: date, archive: bool = False) -> str:
+    """
+    The function `detach_claim_partition` detaches the partition of a month from `claim`, and with
+    `archive` moves it to the `archive` schema, where it can be dumped and dropped. Its claims are no
+    longer read by the API, but stay counted by the rollup tables (`provider_totals`, ...). Postgres only.
+
+    :param session: The session used to alter the tables, committed
+    :type session: AsyncSession
+    :param month: Any date of the month of the partition
+    :type month: date
+    :param archive: Whether to move the detached partition to the `archive` schema
+    :type archive: bool
+    :return: The qualified name of the detached table.
+    """
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        raise NotImplementedError(f"Partitions are not supported for {connection.dialect.name}")
+    name = partition_name(month)
+    attached = await connection.execute(text(
+        "SELECT 1 FROM pg_inherits WHERE inhparent = 'claim'::regclass AND inhrelid = to_regclass(:name)"
+    ), {"name": name})
+    if attached.scalar() is None:
+        raise ValueError(f"claim has no partition {name}")
+    await connection.execute(text(f'ALTER TABLE claim DETACH PARTITION "{name}"'))
+    qualified = name
+    if archive:
+        await connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+        await connection.execute(text(f'ALTER TABLE "{name}" SET SCHEMA {ARCHIVE_SCHEMA}'))
+        qualified = f"{ARCHIVE_SCHEMA}.{name}"
+    await session.commit()
+    return qualified
+
+
+async def run_partition_maintenance(session_factory, interval: float, months_ahead: int) -> None:
+    """
+    The function `run_partition_maintenance` calls `maintain_claim_partitions` now and then every
+    `interval` seconds until it is cancelled. The database function serializes the workers with an
+    advisory lock, so every worker may run it.
+    """
+    while True:
+        try:
+            async with session_factory() as session:
+                await maintain_claim_partitions(session, months_ahead)
+        except Exception:
+            logger.exception("Could not maintain the claim partitions")
+        await asyncio.sleep(interval)
@@ -0,0 +1,66 @@
+from datetime import datetime
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.models import Claim
+
+# Columns a caller of GET /claims may ask for, `id` is always returned since it is the pagination key.
+QUERY_FIELDS = [column.name for column in Claim.__table__.columns if column.name != "xid"]
+
+
+def parse_fields(fields: str = None) -> list[str]:
+    """
+    The function `parse_fields` turns the comma separated `fields` parameter of GET /claims into the
+    list of columns to read, `id` first, or every column when it is empty. It raises a `ValueError`
+    naming the unknown fields.
+    """
+    if not fields:
+        return QUERY_FIELDS
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in QUERY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return ["id", *dict.fromkeys(field for field in requested if field != "id")]
+
+
+async def query_claims(session: AsyncSession, filters: dict = None, service_dttm_from: datetime = None,
+                       service_dttm_to: datetime = None, after_id: int = None, limit: int = 100,
+                       fields: list[str] = None) -> tuple[list[dict], int]:
+    """
+    The function `query_claims` returns a page of the claims matching the filters, in id order, using
+    keyset pagination: the page starts after the claim `after_id` instead of skipping rows with an
+    `OFFSET`, so every page is a range scan of the `(column, id)` indexes whatever its position.
+
+    :param session: The session used to read the claims
+    :type session: AsyncSession
+    :param filters: Maps `provider_npi`, `subscriber_id` and `group_id` to the value the claims must have
+    :type filters: dict
+    :param service_dttm_from: The first service date and time included
+    :type service_dttm_from: datetime
+    :param service_dttm_to: The last service date and time included
+    :type service_dttm_to: datetime
+    :param after_id: The id of the last claim of the previous page
+    :type after_id: int
+    :param limit: The maximum number of claims of the page
+    :type limit: int
+    :param fields: The columns read, as returned by `parse_fields`
+    :type fields: list[str]
+    :return: A tuple `(claims, next_after_id)` where `next_after_id` is the `after_id` of the next page,
+    or `None` on the last page.
+    """
+    fields = fields or QUERY_FIELDS
+    conditions = [Claim.__table__.c[column] == value for column, value in (filters or {}).items()]
+    if service_dttm_from is not None:
+        conditions.append(Claim.service_dttm >= service_dttm_from)
+    if service_dttm_to is not None:
+        conditions.append(Claim.service_dttm <= service_dttm_to)
+    if after_id is not None:
+        conditions.append(Claim.id > after_id)
+    # one more row than asked tells whether there is a next page
+    result = await session.execute(select(*(Claim.__table__.c[field] for field in fields))
+                                   .where(*conditions)
+                                   .order_by(Claim.id)
+                                   .limit(limit + 1))
+    claims = [dict(zip(fields, row)) for row in result]
+    if len(claims) > limit:
+        return claims[:limit], claims[limit - 1]["id"]
+    return claims, None
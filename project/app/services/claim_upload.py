@@ -0,0 +1,370 @@
+import codecs
+import csv
+import json
+import re
+from collections import deque
+from datetime import datetime
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..config.metrics_config import CLAIMS_BATCH_SIZE
+from .claim_columns import validate_claim_columns
+from .claim_ingest import assign_content_hashes, ingest_claims
+
+# Claim files do not agree on the capitalization nor on the wording of their headers
+# (e.g. "Plan/Group #", "member coinsurance", "Provider NPI"). Headers are lower cased, every run of
+# non alphanumeric characters is replaced by "_", and the result is looked up in `HEADER_ALIASES`.
+HEADER_ALIASES = {
+    "service_date": "service_dttm",
+    "service_dttm": "service_dttm",
+    "service_datetime": "service_dttm",
+    "submitted_procedure": "submitted_proc",
+    "submitted_proc": "submitted_proc",
+    "quadrant": "quadrant",
+    "plan_group": "group_id",
+    "group": "group_id",
+    "group_id": "group_id",
+    "subscriber": "subscriber_id",
+    "subscriber_id": "subscriber_id",
+    "provider_npi": "provider_npi",
+    "npi": "provider_npi",
+    "provider_fees": "provider_fees",
+    "allowed_fees": "allowed_fees",
+    "member_coinsurance": "member_co_ins",
+    "member_co_ins": "member_co_ins",
+    "member_copay": "member_co_pay",
+    "member_co_pay": "member_co_pay",
+}
+
+FEE_FIELDS = {"provider_fees", "allowed_fees", "member_co_ins", "member_co_pay"}
+
+# date formats found in claim exports besides the ISO 8601 ones pydantic already understands
+SERVICE_DATE_FORMATS = ["%m/%d/%y %H:%M", "%m/%d/%Y %H:%M", "%m/%d/%y", "%m/%d/%Y"]
+
+# The most lines a record of a CSV file may span, its quoted cells holding line breaks.
+MAX_CSV_RECORD_LINES = 100
+
+CSV_CONTENT_TYPES = {"text/csv", "application/csv"}
+NDJSON_CONTENT_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines"}
+
+
+def normalize_header(name: str) -> str:
+    """
+    The function `normalize_header` maps a header of a claim file to the `ClaimBase` field it holds,
+    whatever its capitalization. Unknown headers are returned normalized so they can be reported.
+    """
+    key = re.sub(r"[^0-9a-z]+", "_", name.strip().lower()).strip("_")
+    return HEADER_ALIASES.get(key, key)
+
+
+def normalize_record(record: dict) -> dict:
+    """
+    The function `normalize_record` renames the keys of a raw claim record with `normalize_header` and
+    cleans its values: blank cells become `None`, currency symbols and thousands separators are removed
+    from the fees and US formatted service dates are parsed.
+    """
+    claim = {}
+    for name, value in record.items():
+        field = normalize_header(name)
+        if isinstance(value, str):
+            value = value.strip()
+            if value == "":
+                value = None
+            elif field in FEE_FIELDS:
+                value = value.replace("$", "").replace(",", "")
+            elif field == "service_dttm":
+                value = parse_service_date(value)
+        claim[field] = value
+    return claim
+
+
+def parse_service_date(value: str):
+    for date_format in SERVICE_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return value
+
+
+def detect_format(content_type: str, requested: str = None) -> str:
+    """
+    The function `detect_format` returns "csv" or "ndjson" from the requested format or, when none is
+    given, from the `Content-Type` of the upload. It raises a `ValueError` for anything else.
+    """
+    if requested:
+        if requested not in ("csv", "ndjson"):
+            raise ValueError(f"Unsupported format: {requested}")
+        return requested
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in CSV_CONTENT_TYPES:
+        return "csv"
+    if media_type in NDJSON_CONTENT_TYPES:
+        return "ndjson"
+    raise ValueError(f"Unsupported content type: {media_type or 'none'}")
+
+
+async def iter_lines(stream, keepends: bool = False):
+    """
+    The generator `iter_lines` decodes an async stream of UTF-8 byte chunks (an optional BOM is dropped)
+    and yields its lines one at a time, so only the current chunk and line are held in memory. With
+    `keepends` the lines keep their line break, as `csv.reader` expects them.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line + "\n" if keepends else line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer if keepends else buffer.rstrip("\r")
+
+
+def ends_in_quoted_cell(line: str, quoted: bool = False) -> bool:
+    """
+    The function `ends_in_quoted_cell` returns whether a CSV `line` ends within a quoted cell, so that its
+    record goes on with the next line, given whether it starts within one. Like `csv.reader`, a quote
+    only opens a quoted cell at the start of a field, a doubled quote within a quoted cell is an escaped
+    one and a quote anywhere else is kept as is (e.g. `5" tooth`).
+    """
+    if not quoted and '"' not in line:
+        return False
+    position = 0
+    if not quoted and line.startswith('"'):
+        quoted, position = True, 1
+    while True:
+        if quoted:
+            end = line.find('"', position)
+            if end < 0:
+                return True
+            if line.startswith('"', end + 1):
+                position = end + 2
+                continue
+            quoted, position = False, end + 1
+        separator = line.find(",", position)
+        if separator < 0:
+            return False
+        position = separator + 1
+        if line.startswith('"', position):
+            quoted, position = True, position + 1
+
+
+class CsvRecordSplitter:
+    """
+    The class `CsvRecordSplitter` groups the lines of a CSV file, given one at a time to `feed`, into
+    records: a record goes on with the next line while a quoted cell is open (see `ends_in_quoted_cell`),
+    for up to `max_lines` lines. The quote of a longer record, or of a record still open at the end of
+    the file (see `close`), is likely a stray one: its first line is reported as an unterminated quoted
+    cell and the next ones are split again, so a single line is lost and the lines held stay bounded.
+    """
+
+    def __init__(self, max_lines: int = MAX_CSV_RECORD_LINES):
+        self.max_lines = max_lines
+        self.line_number = 0
+        self.first_line_number = 1
+        self.lines = []
+        self.quoted = False
+
+    def feed(self, line: str):
+        """
+        The generator `feed` adds the next `line` of the file, its line break kept, and yields the
+        records it ends as `(first_line_number, lines, error)` tuples where exactly one of `lines` and
+        `error` is set.
+        """
+        yield from self._split(deque([line]))
+
+    def close(self):
+        """
+        The generator `close` yields the records left at the end of the file, see `feed`.
+        """
+        yield from self._split(deque(), final=True)
+
+    def _split(self, pending: deque, final: bool = False):
+        while pending or (final and self.lines):
+            if pending:
+                line = pending.popleft()
+                self.line_number += 1
+                if not self.lines:
+                    self.first_line_number = self.line_number
+                self.lines.append(line)
+                self.quoted = ends_in_quoted_cell(line, self.quoted)
+                if not self.quoted:
+                    lines, self.lines = self.lines, []
+                    yield self.first_line_number, lines, None
+                    continue
+                if len(self.lines) <= self.max_lines:
+                    continue
+            lines, self.lines, self.quoted = self.lines, [], False
+            self.line_number = self.first_line_number
+            pending.extendleft(reversed(lines[1:]))
+            yield self.first_line_number, None, "unterminated quoted cell"
+
+
+class LineFeed:
+    """
+    The class `LineFeed` is the input of a `csv.reader` which lines are appended to as they are decoded.
+    It runs dry instead of ending, so the reader must only be advanced once a whole record was appended,
+    see `iter_csv_rows`.
+    """
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def iter_csv_rows(stream, max_record_lines: int = MAX_CSV_RECORD_LINES):
+    """
+    The generator `iter_csv_rows` decodes an async stream of UTF-8 byte chunks of a CSV file and yields
+    its records as `(line_number, cells, error)` tuples, where `line_number` is the first line of the
+    record and exactly one of `cells` and `error` is set. The lines are fed to a single `csv.reader`, so a
+    quoted cell may span up to `max_record_lines` lines; the reader is only advanced once
+    `CsvRecordSplitter` has a whole record. Blank lines are skipped.
+    """
+    feed = LineFeed()
+    reader = csv.reader(feed)
+    splitter = CsvRecordSplitter(max_record_lines)
+
+    def parse(records):
+        for line_number, lines, error in records:
+            if error is not None:
+                yield line_number, None, error
+                continue
+            feed.lines.extend(lines)
+            try:
+                cells = next(reader)
+            except csv.Error as error:
+                # e.g. a cell longer than `csv.field_size_limit()`
+                yield line_number, None, f"invalid CSV: {error}"
+                continue
+            finally:
+                feed.lines.clear()
+            if len(cells) > 1 or any(cell.strip() for cell in cells):
+                yield line_number, cells, None
+
+    async for line in iter_lines(stream, keepends=True):
+        for row in parse(splitter.feed(line)):
+            yield row
+    for row in parse(splitter.close()):
+        yield row
+
+
+def parse_cells(cells: list, header: list) -> tuple:
+    """
+    The function `parse_cells` maps the cells of a CSV record to the `header` cells and returns a
+    `(record, error)` tuple where exactly one of `record` and `error` is set.
+    """
+    if len(cells) != len(header):
+        return None, f"expected {len(header)} columns, got {len(cells)}"
+    return dict(zip(header, cells)), None
+
+
+def parse_line(line: str, file_format: str, header: list = None) -> tuple:
+    """
+    The function `parse_line` parses one record of a CSV (given its `header` cells), which may span
+    several lines, or one line of an NDJSON claim file and returns a `(record, error)` tuple where
+    exactly one of `record` and `error` is set.
+    """
+    if file_format == "ndjson":
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            return None, f"invalid JSON: {error}"
+        if not isinstance(record, dict):
+            return None, "a line must hold a JSON object"
+        return record, None
+    try:
+        cells = next(csv.reader(line.splitlines(keepends=True)))
+    except csv.Error as error:
+        # e.g. a cell longer than `csv.field_size_limit()`
+        return None, f"invalid CSV: {error}"
+    return parse_cells(cells, header)
+
+
+async def iter_records(stream, file_format: str):
+    """
+    The generator `iter_records` parses the raw bytes of a CSV (header record first, one claim per
+    record, see `iter_csv_rows`) or NDJSON upload and yields `(line_number, record, error)` tuples where
+    exactly one of `record` and `error` is set. Blank lines are skipped.
+    """
+    if file_format == "csv":
+        header = None
+        async for line_number, cells, error in iter_csv_rows(stream):
+            if error is not None:
+                yield line_number, None, error
+            elif header is None:
+                header = cells
+            else:
+                yield line_number, *parse_cells(cells, header)
+        return
+    line_number = 0
+    async for line in iter_lines(stream):
+        line_number += 1
+        if line.strip():
+            yield line_number, *parse_line(line, file_format)
+
+
+async def ingest_upload(stream, file_format: str, session: AsyncSession, after_commit=None,
+                        chunk_size: int = 1000, max_errors: int = 1000, copy_threshold: int = None) -> dict:
+    """
+    The function `ingest_upload` streams a CSV or NDJSON claim file into the database. Lines are
+    parsed and normalized one at a time, then validated with `validate_claim_columns` and written and
+    committed in chunks of `chunk_size`, so memory stays bounded whatever the size of the file. Invalid
+    lines are skipped and reported.
+
+    :param stream: An async iterator of the raw bytes of the file, e.g. `request.stream()`
+    :param file_format: "csv" or "ndjson"
+    :type file_format: str
+    :param session: The session used to store the claims, committed once per chunk
+    :type session: AsyncSession
+    :param after_commit: An optional coroutine function called with the newly stored claims of every chunk
+    :param chunk_size: The number of claims written and committed together
+    :type chunk_size: int
+    :param max_errors: The maximum number of line errors kept in the report, the count is always exact
+    :type max_errors: int
+    :return: A report with the number of lines read, inserted, already stored (`duplicates`, e.g. when a
+    file is uploaded again or repeats a claim) and failed, and the line errors.
+    """
+    report = {"lines": 0, "inserted": 0, "duplicates": 0, "failed": 0, "errors": [], "errors_truncated": False}
+
+    def add_error(line_number, detail):
+        report["failed"] += 1
+        if len(report["errors"]) < max_errors:
+            report["errors"].append({"line": line_number, "errors": detail})
+        else:
+            report["errors_truncated"] = True
+
+    async def flush(chunk):
+        CLAIMS_BATCH_SIZE.labels(source="upload").observe(len(chunk))
+        rows, errors = validate_claim_columns([record for _, record in chunk])
+        for index in sorted(errors):
+            add_error(chunk[index][0], errors[index])
+        if not rows:
+            return
+        # identical claims of a file collapse whatever its chunks, see `claim_content_hashes`
+        assign_content_hashes(rows, count_occurrences=False)
+        rows, inserted = await ingest_claims(session, rows, chunk_size=chunk_size, copy_threshold=copy_threshold)
+        report["inserted"] += len(inserted)
+        report["duplicates"] += len(rows) - len(inserted)
+        if after_commit is not None:
+            await after_commit(inserted)
+
+    chunk = []
+    async for line_number, record, error in iter_records(stream, file_format):
+        report["lines"] += 1
+        if error is not None:
+            add_error(line_number, [{"loc": [], "msg": error, "type": "value_error.format"}])
+            continue
+        chunk.append((line_number, normalize_record(record)))
+        if len(chunk) >= chunk_size:
+            await flush(chunk)
+            chunk = []
+    if chunk:
+        await flush(chunk)
+    return report
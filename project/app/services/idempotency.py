@@ -0,0 +1,44 @@
+import hashlib
+from datetime import datetime, timedelta
+import orjson
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.models import IdempotencyKey
+from .claim_ingest import upsert_statement
+
+
+class IdempotencyKeyReused(ValueError):
+    """Raised when an idempotency key is sent again with a different request body."""
+
+
+def request_fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+async def get_idempotent_response(session: AsyncSession, key: str, fingerprint: str, ttl: int) -> IdempotencyKey:
+    """
+    The function `get_idempotent_response` returns the response stored for an idempotency key less than
+    `ttl` seconds ago, or `None`. It raises `IdempotencyKeyReused` when the key was sent with another
+    request body.
+    """
+    stored = await session.get(IdempotencyKey, key)
+    if stored is None or stored.created_at < datetime.utcnow() - timedelta(seconds=ttl):
+        return None
+    if stored.request_hash != fingerprint:
+        raise IdempotencyKeyReused(f"Idempotency-Key {key} was already used with another request")
+    return stored
+
+
+async def save_idempotent_response(session: AsyncSession, key: str, fingerprint: str, status_code: int, response) -> str:
+    """
+    The function `save_idempotent_response` stores the response of a request under its idempotency key,
+    replacing an expired one, and commits. It returns the response serialized to JSON with orjson.
+    """
+    content = orjson.dumps(response).decode()
+    values = {"key": key, "request_hash": fingerprint, "status_code": status_code, "response": content,
+              "created_at": datetime.utcnow()}
+    connection = await session.connection()
+    table = IdempotencyKey.__table__
+    statement = upsert_statement(connection.dialect.name, table).values(values)
+    await connection.execute(statement.on_conflict_do_update(index_elements=[table.c.key], set_=values))
+    await session.commit()
+    return content
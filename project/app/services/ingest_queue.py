@@ -0,0 +1,257 @@
+import json
+import uuid
+from datetime import datetime
+from ..config.metrics_config import CLAIMS_BATCH_SIZE
+from .claim_ingest import assign_content_hashes, ingest_claims
+from .response_cache import bump_ranking_version
+
+# Batches waiting to be written, pushed on the left and consumed from the right.
+QUEUE_KEY = "ingest:queue"
+# Batches given up after `max_attempts`, with their last error.
+DEAD_LETTER_KEY = "ingest:dead"
+# Per worker list of the batches being written, moved back to the queue if the worker dies.
+PROCESSING_KEY = "ingest:processing:{worker}"
+# Hash holding the status of a batch: queued, retrying, stored or failed.
+STATUS_KEY = "ingest:batch:{batch_id}"
+
+
+def encode_batch(batch_id: str, rows: list[dict], attempts: int = 0, error: str = None, unranked: bool = False) -> str:
+    """
+    The function `encode_batch` serializes a queued batch to JSON, service dates as ISO 8601 strings.
+    `unranked` marks a batch whose claims a previous attempt committed without counting them in the ranking.
+    """
+    return json.dumps({
+        "batch_id": batch_id,
+        "attempts": attempts,
+        "error": error,
+        "unranked": unranked,
+        "rows": [{**row, "service_dttm": row["service_dttm"].isoformat()} for row in rows],
+    })
+
+
+def decode_batch(payload: str) -> dict:
+    batch = json.loads(payload)
+    batch.setdefault("unranked", False)
+    for row in batch["rows"]:
+        row["service_dttm"] = datetime.fromisoformat(row["service_dttm"])
+    return batch
+
+
+async def enqueue_claims(redis_connection, rows: list[dict], status_ttl: int = 86400) -> str:
+    """
+    The function `enqueue_claims` puts a validated batch of claim rows, whose ids were reserved with
+    `reserve_claim_ids`, on the ingest queue and records its status, in one Redis transaction.
+
+    :param redis_connection: An asyncio Redis client
+    :param rows: Claim column dictionaries, each with its `id`
+    :type rows: list[dict]
+    :param status_ttl: The number of seconds the status of the batch is kept
+    :type status_ttl: int
+    :return: The id of the batch, to be passed to `get_batch_status`.
+    """
+    batch_id = uuid.uuid4().hex
+    status_key = STATUS_KEY.format(batch_id=batch_id)
+    async with redis_connection.pipeline(transaction=True) as pipe:
+        pipe.hset(status_key, mapping={"status": "queued", "claims": len(rows), "attempts": 0,
+                                       "updated_at": datetime.utcnow().isoformat()})
+        pipe.expire(status_key, status_ttl)
+        pipe.lpush(QUEUE_KEY, encode_batch(batch_id, rows))
+        await pipe.execute()
+    return batch_id
+
+
+async def get_batch_status(redis_connection, batch_id: str) -> dict:
+    """
+    The function `get_batch_status` returns the status of a queued batch, or `None` when the batch is
+    unknown or its status expired.
+    """
+    status = await redis_connection.hgetall(STATUS_KEY.format(batch_id=batch_id))
+    if not status:
+        return None
+    return {"batch_id": batch_id, **status, "claims": int(status["claims"]), "attempts": int(status["attempts"]),
+            "duplicates": int(status.get("duplicates", 0))}
+
+
+async def requeue_dead_letters(redis_connection) -> int:
+    """
+    The function `requeue_dead_letters` moves every dead-lettered batch back to the ingest queue, with
+    its attempts reset, and returns the number of batches moved.
+    """
+    moved = 0
+    while (payload := await redis_connection.rpop(DEAD_LETTER_KEY)) is not None:
+        batch = decode_batch(payload)
+        async with redis_connection.pipeline(transaction=True) as pipe:
+            pipe.lpush(QUEUE_KEY, encode_batch(batch["batch_id"], batch["rows"], unranked=batch["unranked"]))
+            pipe.hset(STATUS_KEY.format(batch_id=batch["batch_id"]),
+                      mapping={"status": "queued", "attempts": 0, "updated_at": datetime.utcnow().isoformat()})
+            await pipe.execute()
+        moved += 1
+    return moved
+
+
+class IngestWorker:
+    """
+    The class `IngestWorker` writes the batches queued by `/claims?mode=async` to the database. Every
+    iteration takes all the batches waiting in the queue, up to `max_claims` claims, and stores them
+    with a single `ingest_claims` call, so that many small requests become one bulk insert. The more
+    the queue fills up while a write runs, the larger the next one.
+
+    A failing group is written again batch by batch to isolate the failing batch, which goes back to
+    the queue until it has been tried `max_attempts` times and is then moved to the dead-letter list.
+    Batches being written are kept in a per worker processing list, and moved back to the queue when
+    the worker starts again after a crash.
+    """
+
+    def __init__(self, redis_connection, session_factory, ranking=None, approx_ranking=None, name: str = "worker",
+                 max_claims: int = 10000, max_attempts: int = 5, block_timeout: int = 5, status_ttl: int = 86400):
+        """
+        :param redis_connection: An asyncio Redis client
+        :param session_factory: A callable returning a new `AsyncSession`
+        :param ranking: The `RankingBackend` updated with the stored claims, if any
+        :param approx_ranking: The shared `SketchRanking` of `/top-provider?mode=approx` updated with the stored
+        claims, if any
+        :param name: The name of the worker, unique among the running workers
+        :param max_claims: The maximum number of claims written together
+        :param max_attempts: The number of times a batch is tried before being dead-lettered
+        :param block_timeout: The number of seconds to wait for a batch before checking again
+        """
+        self.redis = redis_connection
+        self.session_factory = session_factory
+        self.ranking = ranking
+        self.approx_ranking = approx_ranking
+        self.processing_key = PROCESSING_KEY.format(worker=name)
+        self.max_claims = max_claims
+        self.max_attempts = max_attempts
+        self.block_timeout = block_timeout
+        self.status_ttl = status_ttl
+
+    async def recover(self) -> int:
+        """
+        The function `recover` moves the batches left in the processing list of this worker by a
+        previous run back to the queue, counting that run as an attempt. The run may have died between
+        their commit and the ranking, so they are marked `unranked` (see `store`).
+        """
+        recovered = 0
+        while (payload := await self.redis.lindex(self.processing_key, -1)) is not None:
+            batch = decode_batch(payload)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.rpush(QUEUE_KEY, encode_batch(batch["batch_id"], batch["rows"], batch["attempts"] + 1,
+                                                   unranked=True))
+                pipe.rpop(self.processing_key)
+                await pipe.execute()
+            recovered += 1
+        return recovered
+
+    async def next_batches(self) -> list[str]:
+        """
+        The function `next_batches` waits for a batch, then takes the other batches already queued, up
+        to `max_claims` claims. The batches are moved atomically to the processing list.
+        """
+        payload = await self.redis.blmove(QUEUE_KEY, self.processing_key, self.block_timeout, "RIGHT", "LEFT")
+        if payload is None:
+            return []
+        payloads = [payload]
+        claims = len(json.loads(payload)["rows"])
+        while claims < self.max_claims:
+            payload = await self.redis.lmove(QUEUE_KEY, self.processing_key, "RIGHT", "LEFT")
+            if payload is None:
+                break
+            payloads.append(payload)
+            claims += len(json.loads(payload)["rows"])
+        return payloads
+
+    async def run_once(self) -> int:
+        """
+        The function `run_once` writes the next group of batches and returns the number of batches
+        handled, 0 when the queue stayed empty for `block_timeout` seconds.
+        """
+        payloads = await self.next_batches()
+        if not payloads:
+            return 0
+        batches = [decode_batch(payload) for payload in payloads]
+        try:
+            await self.store(batches)
+        except Exception as error:
+            if len(batches) == 1:
+                await self.fail(batches[0], error)
+            else:
+                for batch in batches:
+                    try:
+                        await self.store([batch])
+                    except Exception as batch_error:
+                        await self.fail(batch, batch_error)
+        await self.redis.delete(self.processing_key)
+        return len(batches)
+
+    async def run(self) -> None:
+        await self.recover()
+        while True:
+            await self.run_once()
+
+    async def store(self, batches: list[dict]) -> None:
+        """
+        The function `store` writes the claims of `batches` in one transaction and marks them stored. The
+        claims already stored, by a previous attempt or by another batch, are skipped by `ingest_claims`
+        and counted as the `duplicates` of their batch. New claims are counted by the rankings and
+        invalidate the cached ranking responses of the API workers.
+
+        Stored again, the claims of a batch committed by a failed attempt are all duplicates, which the
+        ranking would never count. A batch whose claims were committed but could not be pushed to the
+        ranking is therefore marked `unranked`, and storing it again unloads the ranking, which the next
+        `/top-provider` loads from the database with every committed claim.
+        """
+        rows = []
+        for batch in batches:
+            # hashed per batch, when `/claims` did not hash the whole request already, so that a batch is
+            # deduplicated the same way whatever it is written with
+            if any("content_hash" not in row for row in batch["rows"]):
+                assign_content_hashes(batch["rows"])
+            rows.extend(batch["rows"])
+        CLAIMS_BATCH_SIZE.labels(source="worker").observe(len(rows))
+        async with self.session_factory() as session:
+            _, inserted = await ingest_claims(session, rows)
+        if self.approx_ranking is not None:
+            await self.approx_ranking.push_claims(inserted)
+        if self.ranking is not None:
+            try:
+                await self.ranking.push_claims(inserted)
+            except Exception:
+                for batch in batches:
+                    batch["unranked"] = True
+                raise
+            if any(batch["unranked"] for batch in batches):
+                await self.ranking.unload()
+        if inserted:
+            await bump_ranking_version(self.redis)
+        inserted_rows = {id(row) for row in inserted}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for batch in batches:
+                duplicates = sum(id(row) not in inserted_rows for row in batch["rows"])
+                self.set_status(pipe, batch, "stored", duplicates=duplicates)
+            await pipe.execute()
+
+    async def fail(self, batch: dict, error: Exception) -> None:
+        """
+        The function `fail` sends a batch whose write failed back to the queue, or to the dead-letter
+        list once it has been tried `max_attempts` times, and records the error in its status.
+        """
+        attempts = batch["attempts"] + 1
+        message = f"{type(error).__name__}: {error}"[:1000]
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if attempts < self.max_attempts:
+                pipe.lpush(QUEUE_KEY, encode_batch(batch["batch_id"], batch["rows"], attempts,
+                                                   unranked=batch["unranked"]))
+                self.set_status(pipe, batch, "retrying", attempts=attempts, error=message)
+            else:
+                pipe.lpush(DEAD_LETTER_KEY, encode_batch(batch["batch_id"], batch["rows"], attempts, message,
+                                                         batch["unranked"]))
+                self.set_status(pipe, batch, "failed", attempts=attempts, error=message)
+            await pipe.execute()
+
+    def set_status(self, pipe, batch: dict, status: str, attempts: int = None, error: str = "",
+                   duplicates: int = 0) -> None:
+        status_key = STATUS_KEY.format(batch_id=batch["batch_id"])
+        pipe.hset(status_key, mapping={"status": status, "claims": len(batch["rows"]), "error": error,
+                                       "attempts": batch["attempts"] if attempts is None else attempts,
+                                       "duplicates": duplicates, "updated_at": datetime.utcnow().isoformat()})
+        pipe.expire(status_key, self.status_ttl)
@@ -0,0 +1,77 @@
+from sqlalchemy import delete, tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.ddSketch import DDSketch
+from ..models.models import Claim, ProviderFeeBucket, ProviderStats
+from ..models.netFeeSummary import NetFeeSummary
+from .aggregate_rebuild import rebuild_from_claims
+from .claim_ingest import summarize_by_provider, upsert_provider_stats, upsert_provider_summaries
+
+
+async def fetch_provider_stats(session: AsyncSession, provider_npi: str):
+    """
+    The function `fetch_provider_stats` reads the net fee statistics of a provider from its
+    `provider_stats` row and its `provider_fee_buckets` rows, two primary key lookups whatever the
+    number of claims of the provider.
+
+    :param session: The database session
+    :type session: AsyncSession
+    :param provider_npi: The NPI of the provider
+    :type provider_npi: str
+    :return: The count, mean, standard deviation, extremes and p50/p95/p99 of the net fees of the
+    provider, or `None` if it has no claims.
+    """
+    stats = (await session.execute(select(ProviderStats).where(ProviderStats.provider_npi == provider_npi))).scalar_one_or_none()
+    if stats is None:
+        return None
+    buckets = await session.execute(select(ProviderFeeBucket.bucket, ProviderFeeBucket.claim_count)
+                                    .where(ProviderFeeBucket.provider_npi == provider_npi))
+    sketch = DDSketch(counts=dict(buckets.all()))
+    summary = NetFeeSummary(stats.claim_count, stats.net_fee_mean, stats.net_fee_m2, stats.net_fee_min,
+                            stats.net_fee_max, sketch)
+    return {"provider_npi": provider_npi, **summary.as_dict(), "relative_accuracy": sketch.relative_accuracy}
+
+
+async def recompute_provider_stats(session: AsyncSession, page_size: int = 50000, chunk_size: int = 1000,
+                                   stats_table=ProviderStats.__table__,
+                                   buckets_table=ProviderFeeBucket.__table__) -> int:
+    """
+    The function `recompute_provider_stats` replaces the `provider_stats` summaries with the ones of the
+    claims of the `claim` table, in the transaction of `session`. The claims are read in pages of
+    `page_size` ordered by provider and id (the `ix_claim_provider_npi_id` index), and the summaries of
+    every page are merged into the tables as the ones of a batch, so a provider spread over two pages
+    is merged like any two batches. It does not commit. `stats_table` and `buckets_table` are the staging
+    copies written by `rebuild_from_claims`, the live tables by default.
+
+    :return: The number of claims read.
+    """
+    await session.execute(delete(stats_table))
+    await session.execute(delete(buckets_table))
+    query = select(Claim.provider_npi, Claim.id, Claim.net_fee).order_by(Claim.provider_npi, Claim.id).limit(page_size)
+    claims = 0
+    last = None
+    while True:
+        page_query = query if last is None else query.where(tuple_(Claim.provider_npi, Claim.id) > last)
+        page = (await session.execute(page_query)).all()
+        if not page:
+            return claims
+        rows = [{"provider_npi": provider_npi, "net_fee": net_fee} for provider_npi, _, net_fee in page]
+        await upsert_provider_summaries(session, summarize_by_provider(rows), chunk_size, stats_table, buckets_table)
+        claims += len(page)
+        last = tuple(page[-1][:2])
+
+
+async def rebuild_provider_stats(session: AsyncSession, page_size: int = 50000) -> int:
+    """
+    The function `rebuild_provider_stats` recomputes the `provider_stats` summaries with
+    `recompute_provider_stats`, e.g. after upgrading to the revision creating them. They are rebuilt into
+    staging tables and swapped in by `rebuild_from_claims`, which only locks `claim` for the swap.
+
+    :return: The number of claims read.
+    """
+    async def fill(session: AsyncSession, staging: dict) -> int:
+        return await recompute_provider_stats(session, page_size, stats_table=staging["provider_stats"],
+                                              buckets_table=staging["provider_fee_buckets"])
+
+    return await rebuild_from_claims(session, [ProviderStats.__table__, ProviderFeeBucket.__table__], fill,
+                                     upsert_provider_stats)
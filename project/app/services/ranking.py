@@ -0,0 +1,626 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from redis.exceptions import WatchError
+from sqlalchemy import literal_column, text, true
+from sqlalchemy.sql import func
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from datetime import date, datetime, time, timedelta
+from ..models.commitWatermark import CommitWatermark
+from ..models.models import Claim, ClaimDimensionTotal, ClaimTopProvider, ProviderDailyTotal, ProviderTotal, RankDimension
+from ..models.spaceSavingSketch import SpaceSavingSketch
+from ..models.topNPriorityQueue import TopNPriorityQueue
+
+logger = logging.getLogger(__name__)
+
+
+# Claims not counted by the snapshot of a `CommitWatermark`, on postgres.
+UNCOUNTED_CLAIMS = text("claim.xid >= :xmin AND NOT pg_visible_in_snapshot(claim.xid::text::xid8, "
+                        "CAST(:snapshot AS pg_snapshot))")
+
+
+def watermark_query(dialect_name: str):
+    """
+    The function `watermark_query` returns a one row subquery of the `CommitWatermark` of the statement
+    it is part of, to be parsed by `CommitWatermark.parse`: its snapshot on postgres, the highest claim
+    id elsewhere. It is outer joined to the totals so that an empty table still has a watermark.
+    """
+    if dialect_name == "postgresql":
+        return select(literal_column("pg_current_snapshot()::text").label("watermark")).subquery()
+    return select(func.coalesce(func.max(Claim.id), 0).label("watermark")).subquery()
+
+
+async def provider_totals_statement(session: AsyncSession):
+    """
+    The function `provider_totals_statement` selects the total net fee of every provider from the
+    `provider_totals` table along with the watermark of the statement, as `(watermark, provider_npi,
+    net_fee_sum)` rows with a null provider when there is no total.
+    """
+    watermark = watermark_query((await session.connection()).dialect.name)
+    return (select(watermark.c.watermark, ProviderTotal.provider_npi, ProviderTotal.net_fee_sum)
+            .select_from(watermark.outerjoin(ProviderTotal, true())))
+
+
+async def fetch_provider_totals(session: AsyncSession) -> tuple[list[tuple], CommitWatermark]:
+    """
+    The function `fetch_provider_totals` reads the total net fee of every provider from the
+    `provider_totals` table, along with their `CommitWatermark`. Both come from a single statement, so
+    the watermark counts exactly the claims of the totals, which are updated in the transaction of the
+    claims.
+
+    :param session: The session used to query the `provider_totals` table
+    :type session: AsyncSession
+    :return: A tuple `(totals, watermark)` where `totals` is a list of `(provider_npi, net_fee)`.
+    """
+    result = await session.execute(await provider_totals_statement(session))
+    rows = result.all()
+    totals = [(row.provider_npi, row.net_fee_sum) for row in rows if row.provider_npi is not None]
+    return totals, CommitWatermark.parse(rows[0].watermark)
+
+
+async def fetch_provider_totals_since(session: AsyncSession,
+                                      watermark: CommitWatermark) -> tuple[list[tuple], CommitWatermark]:
+    """
+    The function `fetch_provider_totals_since` sums the net fees of the claims not counted by
+    `watermark` per provider, to bring a snapshot up to date. On postgres they are found through the
+    `(xid, id)` index, from the oldest transaction the watermark saw running, so that claims committed
+    after the watermark with a lower id are not missed; elsewhere it is a range scan of the primary key.
+
+    :return: A tuple `(totals, watermark)` with the totals of the new claims and the watermark counting
+    them.
+    """
+    dialect_name = (await session.connection()).dialect.name
+    if dialect_name == "postgresql":
+        uncounted = UNCOUNTED_CLAIMS.bindparams(xmin=watermark.xmin, snapshot=watermark.snapshot)
+    else:
+        uncounted = Claim.id > watermark.max_id
+    new_claims = (select(Claim.provider_npi, func.sum(Claim.net_fee).label("net_fee"))
+                  .where(uncounted)
+                  .group_by(Claim.provider_npi)
+                  .subquery())
+    current = watermark_query(dialect_name)
+    result = await session.execute(select(current.c.watermark, new_claims.c.provider_npi, new_claims.c.net_fee)
+                                   .select_from(current.outerjoin(new_claims, true())))
+    rows = result.all()
+    totals = [(row.provider_npi, row.net_fee) for row in rows if row.provider_npi is not None]
+    return totals, CommitWatermark.parse(rows[0].watermark)
+
+
+async def fetch_top_provider_totals(session: AsyncSession, n: int = 10) -> list[ClaimTopProvider]:
+    """
+    The function `fetch_top_provider_totals` reads the top `n` providers from the `provider_totals`
+    table, an index scan of `n` rows on `ix_provider_totals_net_fee_sum` whatever the number of claims.
+    """
+    result = await session.execute(select(ProviderTotal.provider_npi, ProviderTotal.net_fee_sum)
+                                   .order_by(ProviderTotal.net_fee_sum.desc()).limit(n))
+    return [ClaimTopProvider(row.provider_npi, row.net_fee_sum) for row in result]
+
+
+async def fetch_top_providers_in_window(session: AsyncSession, start: date, end: date, n: int = 10) -> list[ClaimTopProvider]:
+    """
+    The function `fetch_top_providers_in_window` ranks the providers by the net fees of the claims with
+    a service date between `start` and `end` (both included). It merges the daily buckets of
+    `provider_daily_totals` in that range, found through the primary key, and never reads `claim`.
+    """
+    net_fee = func.sum(ProviderDailyTotal.net_fee_sum).label('net_fee')
+    result = await session.execute(select(ProviderDailyTotal.provider_npi, net_fee)
+                                   .where(ProviderDailyTotal.service_date >= start, ProviderDailyTotal.service_date <= end)
+                                   .group_by(ProviderDailyTotal.provider_npi)
+                                   .order_by(net_fee.desc())
+                                   .limit(n))
+    return [ClaimTopProvider(row.provider_npi, row.net_fee) for row in result]
+
+
+async def fetch_top_by_dimension(session: AsyncSession, dimension: RankDimension, filters: dict = None, n: int = 10,
+                                 window: tuple[date, date] = None) -> list[tuple]:
+    """
+    The function `fetch_top_by_dimension` ranks the values of a claim dimension (provider, group,
+    quadrant or procedure) by total net fee, keeping only the claims matching `filters`.
+
+    All time rankings merge the rows of the `claim_dimension_totals` rollup, kept up to date by every
+    batch, so their cost depends on the number of distinct keys and not on the number of claims. The
+    rollup has no service date, so windowed rankings fall back to `claim`, read through the composite
+    `(dimension, service_dttm)` indexes when filtered.
+
+    :param session: The session used to query the rollup or the claims
+    :type session: AsyncSession
+    :param dimension: The dimension whose values are ranked
+    :type dimension: RankDimension
+    :param filters: Maps dimension names to the value the claims must have, e.g. `{"group_id": "GRP-1"}`
+    :type filters: dict
+    :param n: The number of values returned
+    :type n: int
+    :param window: An optional `(start, end)` tuple of service dates, both included
+    :type window: tuple[date, date]
+    :return: A list of `(value, net_fee)` tuples, best first. Claims without quadrant rank as `None`.
+    """
+    filters = filters or {}
+    if window is None:
+        table = ClaimDimensionTotal
+        net_fee = func.sum(ClaimDimensionTotal.net_fee_sum).label('net_fee')
+        conditions = [getattr(table, name) == (value or "" if name == RankDimension.quadrant else value)
+                      for name, value in filters.items()]
+    else:
+        table = Claim
+        net_fee = func.sum(Claim.net_fee).label('net_fee')
+        start, end = window
+        conditions = [getattr(table, name) == value for name, value in filters.items()]
+        if start > date.min:
+            conditions.append(Claim.service_dttm >= datetime.combine(start, time.min))
+        if end < date.max:
+            conditions.append(Claim.service_dttm < datetime.combine(end + timedelta(days=1), time.min))
+    dimension = RankDimension(dimension)
+    column = getattr(table, dimension.value)
+    result = await session.execute(select(column.label('value'), net_fee)
+                                   .where(*conditions)
+                                   .group_by(column)
+                                   .order_by(net_fee.desc())
+                                   .limit(n))
+    if dimension == RankDimension.quadrant:
+        return [(row.value or None, row.net_fee) for row in result]
+    return [(row.value, row.net_fee) for row in result]
+
+
+def claim_position(claim: dict) -> tuple[int, int]:
+    """
+    The function `claim_position` returns the `(xid, id)` of a stored claim, its `xid` being set by
+    `ingest_claims`, to be checked against a `CommitWatermark`.
+    """
+    return claim.get("xid", 0), claim["id"]
+
+
+class RankingBackend:
+    """
+    The class `RankingBackend` is the interface of the stores ranking providers by total net fee.
+    `push_claims` is called by `/claims` once a batch is committed, `/top-provider` calls `load` the
+    first time `is_loaded` is false and then reads `get_top_n`, passing its database session for the
+    backends reading from the database.
+    """
+
+    async def push_claims(self, claims: list[dict]) -> None:
+        raise NotImplementedError
+
+    async def get_top_n(self, n: int = 10, session: AsyncSession = None) -> list[ClaimTopProvider]:
+        raise NotImplementedError
+
+    async def is_loaded(self) -> bool:
+        raise NotImplementedError
+
+    async def load(self, session: AsyncSession) -> None:
+        raise NotImplementedError
+
+    async def unload(self) -> None:
+        """
+        The function `unload` makes the next ranking load the totals from the database again, e.g. after
+        they were rebuilt by a bulk load. Backends reading the database directly have nothing to unload.
+        """
+
+
+class InProcessRanking(RankingBackend):
+    """
+    The class `InProcessRanking` ranks the providers with a `TopNPriorityQueue` living in the worker.
+    Every worker only sees the claims it ingested itself once its queue is loaded. Once the queue has
+    evicted providers, the rankings it cannot vouch for are read from the database.
+    """
+
+    def __init__(self, pq: TopNPriorityQueue):
+        self.pq = pq
+        self.lock = asyncio.Lock()
+
+    async def push_claims(self, claims: list[dict]) -> None:
+        for claim in claims:
+            self.pq.push(ClaimTopProvider(claim["provider_npi"], claim["net_fee"]), position=claim_position(claim))
+
+    async def get_top_n(self, n: int = 10, session: AsyncSession = None) -> list[ClaimTopProvider]:
+        """
+        The function `get_top_n` reads the top `n` providers from the queue, unless the providers evicted
+        because of its capacity could make them wrong (see `TopNPriorityQueue.get_exact_top_n`): they are
+        then read from the `provider_totals` table through `session`.
+        """
+        top = self.pq.get_exact_top_n(n)
+        if top is None and session is not None:
+            return await fetch_top_provider_totals(session, n)
+        return top if top is not None else self.pq.get_top_n(n)
+
+    async def is_loaded(self) -> bool:
+        return self.pq.loaded
+
+    async def load(self, session: AsyncSession) -> None:
+        """
+        The function `load` loads the provider totals into the priority queue. Claims ingested by this
+        worker while the query runs are buffered by the queue and only applied if the query did not
+        already count them.
+        """
+        async with self.lock:
+            if self.pq.loaded:
+                return
+            self.pq.begin_load()
+            try:
+                totals, watermark = await fetch_provider_totals(session)
+            except Exception:
+                self.pq.abort_load()
+                raise
+            self.pq.load(totals, watermark)
+
+    async def unload(self) -> None:
+        async with self.lock:
+            self.pq.loaded = False
+
+    async def load_snapshot(self, session: AsyncSession, totals: list[tuple], watermark: CommitWatermark) -> None:
+        """
+        The function `load_snapshot` loads the provider totals of a snapshot taken at `watermark`, plus
+        the claims committed since, read by `fetch_provider_totals_since`.
+        """
+        async with self.lock:
+            if self.pq.loaded:
+                return
+            self.pq.begin_load()
+            try:
+                new_totals, watermark = await fetch_provider_totals_since(session, watermark)
+            except Exception:
+                self.pq.abort_load()
+                raise
+            merged = dict(totals)
+            for provider_npi, net_fee in new_totals:
+                merged[provider_npi] = merged.get(provider_npi, 0.0) + net_fee
+            self.pq.load(merged.items(), watermark)
+
+
+class RedisRanking(RankingBackend):
+    """
+    The class `RedisRanking` ranks the providers in a Redis sorted set shared by all the workers: the
+    member is the provider NPI and the score its total net fee.
+    """
+
+    def __init__(self, redis_connection, key: str = "ranking:providers", load_timeout: int = 60):
+        """
+        :param redis_connection: An asyncio Redis client
+        :param key: The key of the sorted set, `<key>:loaded` marks it as seeded from the database
+        :param load_timeout: The number of seconds a worker may hold the seeding lock
+        """
+        self.redis = redis_connection
+        self.key = key
+        self.loaded_key = f"{key}:loaded"
+        self.lock_key = f"{key}:lock"
+        # claims pushed while the sorted set is seeded, as `[xid, id, provider_npi, net_fee]` JSON arrays
+        self.log_key = f"{key}:log"
+        self.load_timeout = load_timeout
+
+    async def push_claims(self, claims: list[dict]) -> None:
+        """
+        The function `push_claims` sums the net fees of the batch per provider and sends one `ZINCRBY`
+        per provider in a single transaction. While a worker seeds the sorted set (see `load`), the
+        claims are also logged with their position, for the seeding to count the ones its totals miss.
+        """
+        increments = {}
+        for claim in claims:
+            increments[claim["provider_npi"]] = increments.get(claim["provider_npi"], 0.0) + claim["net_fee"]
+        if not increments:
+            return
+        # claims pushed before the lock is taken are committed before the totals are read, and counted by them
+        seeding = await self.redis.exists(self.lock_key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for provider_npi, net_fee in increments.items():
+                pipe.zincrby(self.key, net_fee, provider_npi)
+            if seeding:
+                pipe.rpush(self.log_key, *(json.dumps([*claim_position(claim), claim["provider_npi"], claim["net_fee"]])
+                                           for claim in claims))
+                pipe.expire(self.log_key, self.load_timeout)
+            await pipe.execute()
+
+    async def get_top_n(self, n: int = 10, session: AsyncSession = None) -> list[ClaimTopProvider]:
+        top = await self.redis.zrevrange(self.key, 0, n - 1, withscores=True)
+        return [ClaimTopProvider(provider_npi, net_fee) for provider_npi, net_fee in top]
+
+    async def is_loaded(self) -> bool:
+        return bool(await self.redis.exists(self.loaded_key))
+
+    async def unload(self) -> None:
+        """
+        The function `unload` marks the sorted set as not seeded, e.g. after the totals were rebuilt by a
+        bulk load, so that the next ranking seeds it again from the database.
+        """
+        await self.redis.delete(self.loaded_key)
+
+    async def load(self, session: AsyncSession, chunk_size: int = 10000) -> None:
+        """
+        The function `load` seeds the sorted set from the database once for all the workers. The worker
+        taking the lock seeds it (see `seed`), the other ones wait for the seeding to finish, and take
+        over once the lock expired if it failed. It raises a `TimeoutError` when the sorted set is still
+        not seeded after twice `load_timeout` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 2 * self.load_timeout
+        while not await self.is_loaded():
+            token = uuid.uuid4().hex
+            if await self.redis.set(self.lock_key, token, nx=True, ex=self.load_timeout):
+                await self.seed(session, token, chunk_size)
+                return
+            if loop.time() >= deadline:
+                raise TimeoutError("the ranking sorted set was not seeded")
+            await asyncio.sleep(0.1)
+
+    async def seed(self, session: AsyncSession, token: str, chunk_size: int = 10000) -> None:
+        """
+        The function `seed` builds the sorted set from the provider totals into a staging key, while
+        holding the lock `token`. The claims pushed since the lock was taken that the `CommitWatermark` of
+        the totals does not count are then added from the log, and the staging key is renamed into place,
+        in one transaction retried until no claim is logged meanwhile. No increment is lost, and the
+        rankings read the previous sorted set until the rename. A worker whose lock expired meanwhile
+        gives up with a `TimeoutError`, another one seeding the sorted set.
+        """
+        staging_key = f"{self.key}:staging:{token}"
+        try:
+            totals, watermark = await fetch_provider_totals(session)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.delete(staging_key)
+                for start in range(0, len(totals), chunk_size):
+                    pipe.zadd(staging_key, dict(totals[start:start + chunk_size]))
+                await pipe.execute()
+            async with self.redis.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        await pipe.watch(self.lock_key, self.log_key)
+                        if await pipe.get(self.lock_key) not in (token, token.encode()):
+                            raise TimeoutError("the lock seeding the ranking sorted set expired")
+                        increments = {}
+                        for entry in await pipe.lrange(self.log_key, 0, -1):
+                            xid, claim_id, provider_npi, net_fee = json.loads(entry)
+                            if not watermark.counts(xid, claim_id):
+                                increments[provider_npi] = increments.get(provider_npi, 0.0) + net_fee
+                        pipe.multi()
+                        for provider_npi, net_fee in increments.items():
+                            pipe.zincrby(staging_key, net_fee, provider_npi)
+                        if totals or increments:
+                            pipe.rename(staging_key, self.key)
+                        else:
+                            pipe.delete(self.key)
+                        pipe.set(self.loaded_key, "1")
+                        pipe.delete(self.lock_key)
+                        await pipe.execute()
+                        return
+                    except WatchError:
+                        continue
+        except Exception:
+            await self.redis.delete(staging_key)
+            if await self.redis.get(self.lock_key) in (token, token.encode()):
+                await self.redis.delete(self.lock_key)
+            raise
+
+
+class DatabaseRanking(RankingBackend):
+    """
+    The class `DatabaseRanking` serves the ranking straight from the `provider_totals` table, which
+    `/claims` keeps up to date in the transaction of every batch. It is exact for every worker at the
+    cost of one index scan of `n` rows per call.
+    """
+
+    async def push_claims(self, claims: list[dict]) -> None:
+        pass
+
+    async def get_top_n(self, n: int = 10, session: AsyncSession = None) -> list[ClaimTopProvider]:
+        return await fetch_top_provider_totals(session, n)
+
+    async def is_loaded(self) -> bool:
+        return True
+
+    async def load(self, session: AsyncSession) -> None:
+        pass
+
+
+class SketchRanking(RankingBackend):
+    """
+    The class `SketchRanking` ranks the providers approximately with a `SpaceSavingSketch` living in the
+    worker, in a fixed memory whatever the number of providers. It is loaded by streaming the
+    `provider_totals` table through the sketch, then tracks the claims ingested by the worker like
+    `InProcessRanking`. Claims are only counted once the sketch is used.
+
+    Given a Redis client (one that does not decode the responses), the sketch is shared by all the
+    workers instead: the provider totals are streamed once, by the first worker, into a base sketch
+    stored in Redis with its watermark, and the sketch of every worker only counts the claims it
+    ingested that the base does not count. Every worker publishes its sketch with `publish`, the
+    ranking merges the base with the sketches of all the workers, and a worker shutting down folds its
+    sketch into the base with `retire`.
+    """
+
+    def __init__(self, sketch: SpaceSavingSketch, partition_size: int = 10000, redis_connection=None,
+                 key: str = "ranking:sketch", load_timeout: int = 60, name: str = None):
+        """
+        :param sketch: The sketch of the worker
+        :param partition_size: The number of provider totals streamed through the sketch at a time
+        :param redis_connection: An asyncio Redis client sharing the sketch between the workers, `None`
+        keeps it in the worker
+        :param key: The hash holding the base sketch and its watermark, `<key>:workers` maps every worker
+        to its sketch
+        :param load_timeout: The number of seconds a worker may hold the lock seeding the base sketch
+        :param name: The name the sketch of the worker is published under, its host and pid by default
+        """
+        self.sketch = sketch
+        self.partition_size = partition_size
+        self.lock = asyncio.Lock()
+        self.redis = redis_connection
+        self.key = key
+        self.workers_key = f"{key}:workers"
+        self.lock_key = f"{key}:lock"
+        self.load_timeout = load_timeout
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        # number of claims counted by the sketch of the worker, and when it was last published
+        self.version = 0
+        self.published_version = 0
+
+    async def push_claims(self, claims: list[dict]) -> None:
+        if not (self.sketch.loaded or self.sketch.loading):
+            return
+        for claim in claims:
+            self.sketch.push(claim["provider_npi"], claim["net_fee"], position=claim_position(claim))
+        self.version += len(claims)
+
+    async def get_top_n(self, n: int = 10, session: AsyncSession = None) -> list[ClaimTopProvider]:
+        return [ClaimTopProvider(key, estimate) for key, estimate, _, _ in await self.get_top_n_with_errors(n)]
+
+    async def get_top_n_with_errors(self, n: int = 10) -> list[tuple]:
+        """Returns `(provider_npi, estimate, error, guaranteed)` tuples, see `SpaceSavingSketch.get_top_n`."""
+        return (await self.merged_sketch()).get_top_n(n)
+
+    async def merged_sketch(self) -> SpaceSavingSketch:
+        """
+        The function `merged_sketch` returns the sketch the ranking is read from: the sketch of the worker,
+        merged with the base sketch and the published sketches of the other workers when it is shared.
+        The bounds of a merged sketch hold for the claims of all of them, see `SpaceSavingSketch.merge`.
+        """
+        if self.redis is None:
+            return self.sketch
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(self.key, "sketch")
+            pipe.hgetall(self.workers_key)
+            base, workers = await pipe.execute()
+        merged = self.sketch
+        if base is not None:
+            merged = merged.merge(SpaceSavingSketch.from_bytes(base))
+        for name, data in workers.items():
+            if name.decode() != self.name:
+                merged = merged.merge(SpaceSavingSketch.from_bytes(data))
+        return merged
+
+    async def is_loaded(self) -> bool:
+        return self.sketch.loaded
+
+    async def load(self, session: AsyncSession) -> None:
+        """
+        The function `load` streams the provider totals through the sketch, `partition_size` rows at a
+        time, so loading takes the memory of the sketch only. Their watermark is read by the same
+        statement, see `fetch_provider_totals`. A shared sketch is emptied instead, and only counts the
+        claims that the base sketch does not count, see `load_base`.
+        """
+        async with self.lock:
+            if self.sketch.loaded:
+                return
+            self.sketch.begin_load()
+            try:
+                if self.redis is not None:
+                    watermark = await self.load_base(session)
+                else:
+                    watermark = await self.stream_totals(session, self.sketch)
+            except Exception:
+                self.sketch.abort_load()
+                raise
+            self.sketch.end_load(watermark)
+
+    async def unload(self) -> None:
+        """
+        The function `unload` empties the sketch of the worker until it is loaded again, and removes it
+        from the published ones. The base sketch is deleted by `reset_shared` beforehand.
+        """
+        async with self.lock:
+            self.sketch.begin_load()
+            self.sketch.abort_load()
+            self.version = self.published_version = 0
+            if self.redis is not None:
+                await self.redis.hdel(self.workers_key, self.name)
+
+    async def reset_shared(self) -> None:
+        """
+        The function `reset_shared` deletes the base sketch and the published sketches of every worker,
+        e.g. after the totals were rebuilt: the next load seeds the base from the database again.
+        """
+        await self.redis.delete(self.key, self.workers_key)
+
+    async def stream_totals(self, session: AsyncSession, sketch: SpaceSavingSketch) -> CommitWatermark:
+        watermark = None
+        result = await session.stream(await provider_totals_statement(session))
+        async for partition in result.partitions(self.partition_size):
+            sketch.load_totals((row.provider_npi, row.net_fee_sum) for row in partition if row.provider_npi is not None)
+            watermark = watermark or CommitWatermark.parse(partition[0].watermark)
+        return watermark
+
+    async def load_base(self, session: AsyncSession) -> CommitWatermark:
+        """
+        The function `load_base` returns the watermark of the base sketch, after seeding it from the
+        provider totals when there is none yet. Only the worker taking the lock seeds it, the other ones
+        wait for it and raise a `TimeoutError` after `load_timeout` seconds.
+        """
+        watermark = await self.redis.hget(self.key, "watermark")
+        if watermark is not None:
+            return CommitWatermark.parse(watermark.decode())
+        if not await self.redis.set(self.lock_key, self.name, nx=True, ex=self.load_timeout):
+            for _ in range(self.load_timeout * 10):
+                await asyncio.sleep(0.1)
+                watermark = await self.redis.hget(self.key, "watermark")
+                if watermark is not None:
+                    return CommitWatermark.parse(watermark.decode())
+            raise TimeoutError("the base ranking sketch was not seeded")
+        try:
+            base = SpaceSavingSketch(self.sketch.capacity)
+            watermark = await self.stream_totals(session, base)
+            await self.redis.hset(self.key, mapping={"sketch": base.to_bytes(), "watermark": watermark.dumps()})
+        finally:
+            await self.redis.delete(self.lock_key)
+        return watermark
+
+    async def publish(self) -> None:
+        """
+        The function `publish` stores the sketch of the worker in Redis, when it counted claims since it
+        was last published, for the other workers to merge.
+        """
+        if self.redis is None or not self.sketch.loaded or self.published_version == self.version:
+            return
+        version = self.version
+        await self.redis.hset(self.workers_key, self.name, self.sketch.to_bytes())
+        self.published_version = version
+
+    async def retire(self) -> None:
+        """
+        The function `retire` folds the sketch of the worker into the base sketch and removes it from the
+        published ones, in one transaction, so that the sketches of stopped workers do not pile up.
+        """
+        if self.redis is None or not self.sketch.loaded:
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(self.key)
+                    base = await pipe.hget(self.key, "sketch")
+                    if base is None:
+                        return
+                    pipe.multi()
+                    pipe.hset(self.key, "sketch", SpaceSavingSketch.from_bytes(base).merge(self.sketch).to_bytes())
+                    pipe.hdel(self.workers_key, self.name)
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    async def run(self, session_factory, interval: float) -> None:
+        """
+        The function `run` loads a shared sketch as soon as the worker starts, so that every claim it
+        ingests is counted, then publishes it every `interval` seconds until it is cancelled. Claims
+        counted since the last publication are lost if the worker dies without `retire`.
+        """
+        while True:
+            try:
+                if not self.sketch.loaded:
+                    async with session_factory() as session:
+                        await self.load(session)
+                await self.publish()
+            except Exception:
+                logger.exception("Could not share the ranking sketch")
+            await asyncio.sleep(interval)
+
+
+def create_ranking_backend(name: str, pq: TopNPriorityQueue, redis_connection) -> RankingBackend:
+    """
+    The function `create_ranking_backend` builds the ranking backend selected by the `RANKING_BACKEND`
+    setting: `memory` for the in-process priority queue, `redis` for the shared sorted set or
+    `database` for the `provider_totals` table.
+    """
+    if name == "memory":
+        return InProcessRanking(pq)
+    if name == "database":
+        return DatabaseRanking()
+    if name == "redis":
+        return RedisRanking(redis_connection)
+    raise ValueError(f"Unknown ranking backend: {name}")
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.commitWatermark import CommitWatermark
+from .ranking import InProcessRanking, fetch_provider_totals
+
+logger = logging.getLogger(__name__)
+
+# Header of a snapshot: magic, format version, watermark (xmin, xmax, highest claim id, number of
+# running transactions), number of providers. The ids of the running transactions follow as int64.
+SNAPSHOT_HEADER = struct.Struct("<4sBqqqII")
+SNAPSHOT_MAGIC = b"TOPN"
+# version 1 had a highest claim id instead of a watermark
+SNAPSHOT_VERSION = 2
+
+
+def encode_snapshot(totals: list[tuple], watermark: CommitWatermark) -> bytes:
+    """
+    The function `encode_snapshot` packs the provider totals in a compact binary format: a header, then
+    every NPI as a length prefixed UTF-8 string and every total as a float64, the whole compressed with
+    zlib. A million providers take about 10 MB before compression.
+
+    :param totals: A list of `(provider_npi, net_fee)`
+    :type totals: list[tuple]
+    :param watermark: The watermark of the claims counted by `totals`
+    :type watermark: CommitWatermark
+    :return: The snapshot, to be read back with `decode_snapshot`.
+    """
+    running = sorted(watermark.running)
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, watermark.xmin, watermark.xmax,
+                                  watermark.max_id, len(running), len(totals)),
+             struct.pack(f"<{len(running)}q", *running)]
+    for provider_npi, net_fee in totals:
+        key = provider_npi.encode()
+        parts.append(struct.pack(f"<B{len(key)}sd", len(key), key, net_fee))
+    return zlib.compress(b"".join(parts), 1)
+
+
+def decode_snapshot(data: bytes) -> tuple[list[tuple], CommitWatermark]:
+    """
+    The function `decode_snapshot` unpacks a snapshot of `encode_snapshot` and returns `(totals,
+    watermark)`. It raises `ValueError` when the data is not a snapshot of this format.
+    """
+    try:
+        data = zlib.decompress(data)
+        magic, version, xmin, xmax, max_id, running, count = SNAPSHOT_HEADER.unpack_from(data)
+    except (zlib.error, struct.error) as error:
+        raise ValueError(f"invalid ranking snapshot: {error}")
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"invalid ranking snapshot: {magic!r} version {version}")
+    watermark = CommitWatermark(xmin, xmax, frozenset(struct.unpack_from(f"<{running}q", data, SNAPSHOT_HEADER.size)),
+                                max_id)
+    totals = []
+    offset = SNAPSHOT_HEADER.size + 8 * running
+    for _ in range(count):
+        length = data[offset]
+        key, net_fee = struct.unpack_from(f"<{length}sd", data, offset + 1)
+        totals.append((key.decode(), net_fee))
+        offset += 1 + length + 8
+    return totals, watermark
+
+
+class RedisSnapshotStore:
+    """
+    The class `RedisSnapshotStore` keeps the ranking snapshot in a Redis key shared by all the workers.
+    It needs a client that does not decode the responses.
+    """
+
+    def __init__(self, redis_connection, key: str = "ranking:snapshot"):
+        self.redis = redis_connection
+        self.key = key
+        self.lock_key = f"{key}:lock"
+
+    async def save(self, data: bytes) -> None:
+        await self.redis.set(self.key, data)
+
+    async def load(self) -> bytes:
+        return await self.redis.get(self.key)
+
+    async def claim_turn(self, interval: float) -> bool:
+        """Only one worker per `interval` seconds takes the snapshot."""
+        return bool(await self.redis.set(self.lock_key, os.getpid(), nx=True, px=int(interval * 1000)))
+
+
+class FileSnapshotStore:
+    """
+    The class `FileSnapshotStore` keeps the ranking snapshot in a local file, replaced atomically, for
+    deployments whose workers share a disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def save(self, data: bytes) -> None:
+        partial = f"{self.path}.{os.getpid()}.tmp"
+        with open(partial, "wb") as snapshot:
+            snapshot.write(data)
+        os.replace(partial, self.path)
+
+    async def load(self) -> bytes:
+        try:
+            with open(self.path, "rb") as snapshot:
+                return snapshot.read()
+        except FileNotFoundError:
+            return None
+
+    async def claim_turn(self, interval: float) -> bool:
+        """A worker takes the snapshot unless another one wrote it less than `interval` seconds ago."""
+        try:
+            return time.time() - os.path.getmtime(self.path) >= interval * 0.9
+        except OSError:
+            return True
+
+
+def create_snapshot_store(setting: str, binary_redis):
+    """
+    The function `create_snapshot_store` returns the snapshot store selected by `RANKING_SNAPSHOT`:
+    "redis", "off" (`None`), or the path of a file.
+    """
+    if setting == "off":
+        return None
+    if setting == "redis":
+        return RedisSnapshotStore(binary_redis)
+    return FileSnapshotStore(setting)
+
+
+async def take_snapshot(session: AsyncSession, store) -> int:
+    """
+    The function `take_snapshot` saves the totals of `provider_totals` and their watermark, read in one
+    statement by `fetch_provider_totals`, and returns the number of providers saved.
+    """
+    totals, watermark = await fetch_provider_totals(session)
+    await store.save(encode_snapshot(totals, watermark))
+    return len(totals)
+
+
+async def restore_snapshot(ranking: InProcessRanking, session: AsyncSession, store) -> bool:
+    """
+    The function `restore_snapshot` loads the last snapshot into an in-process ranking and brings it up
+    to date with the claims committed since, instead of reading every provider total. It returns false
+    when there is no snapshot, leaving the ranking to be loaded by the first `/top-provider`.
+    """
+    data = await store.load()
+    if data is None:
+        return False
+    totals, watermark = decode_snapshot(data)
+    await ranking.load_snapshot(session, totals, watermark)
+    return True
+
+
+async def run_snapshots(store, session_factory, interval: float) -> None:
+    """
+    The function `run_snapshots` takes a snapshot every `interval` seconds, in a single worker at a time,
+    until it is cancelled. A failed snapshot is logged and tried again at the next interval.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await store.claim_turn(interval):
+                async with session_factory() as session:
+                    await take_snapshot(session, store)
+        except Exception:
+            logger.exception("Could not take the ranking snapshot")
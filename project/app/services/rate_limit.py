@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import math
+import time
+from fastapi import HTTPException, Request
+from redis.exceptions import RedisError
+from ..config.metrics_config import RATE_LIMIT_DECISIONS, RATE_LIMIT_SYNC_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Redis key counting the usage of a client of a route during one window, shared by all the workers.
+USAGE_KEY = "ratelimit:{route}:{client}:{window}"
+
+
+class LimitState:
+    """
+    The class `LimitState` is the in-process state of one client of one route: a token bucket holding up
+    to `times` tokens and refilled at `times / seconds` tokens per second, and the usage of the current
+    fixed window of `seconds`, as last read from Redis (`remote`) plus what this worker used since
+    (`pending`).
+    """
+
+    __slots__ = ("tokens", "updated_at", "window", "remote", "pending")
+
+    def __init__(self, times: int, now: float, window: int):
+        self.tokens = float(times)
+        self.updated_at = now
+        self.window = window
+        self.remote = 0
+        self.pending = 0
+
+
+class RateLimiter:
+    """
+    The class `RateLimiter` limits the usage of the clients of every route in two tiers, so that a
+    request does not wait for Redis:
+
+    - in process, a token bucket per client and route admits or rejects the request without any I/O,
+      which alone keeps a single worker within the limit;
+    - the usage of every worker is added to a Redis counter per client, route and window of `seconds`
+      in batches, one pipelined round trip for all the clients, by `run` in the background: every
+      `sync_interval` seconds, or as soon as `hit` finds `sync_batch` units pending. A client whose
+      window is used up across the workers is rejected by all of them until the window ends.
+
+    The clients may thus exceed their limit by what the other workers admitted since their last sync:
+    a shorter `sync_interval` or a smaller `sync_batch` trades Redis load for accuracy, and
+    `sync_interval=0` syncs after every request. When Redis cannot be reached, or `run` is not running,
+    the in-process buckets keep limiting every worker on its own.
+    """
+
+    def __init__(self, redis_connection, sync_interval: float = 1.0, sync_batch: int = 100, clock=time.time):
+        """
+        :param redis_connection: An asyncio Redis client
+        :param sync_interval: The maximum number of seconds between two syncs with Redis
+        :param sync_batch: The number of pending units of usage that triggers a sync
+        :param clock: Returns the current time in seconds, the windows are aligned on it across workers
+        """
+        self.redis = redis_connection
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
+        self.clock = clock
+        self.enabled = True
+        self.states = {}
+        self.limits = {}
+        self.pending = 0
+        self.syncing = False
+        # set by `hit` to have `run` sync at once
+        self.sync_needed = asyncio.Event()
+
+    async def hit(self, route: str, client: str, times: int, seconds: float, cost: int = 1) -> float:
+        """
+        The function `hit` uses `cost` units of the limit of `times` units per `seconds` of a client of a
+        route. It returns 0 when the usage is admitted, otherwise the number of seconds after which it
+        may be, the usage not being counted, or `math.inf` when `cost` exceeds `times` and it never will.
+        It never waits for Redis, the usage is synced by `run`.
+        """
+        if not self.enabled:
+            return 0.0
+        now = self.clock()
+        window = int(now // seconds)
+        key = (route, client)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = LimitState(times, now, window)
+            self.limits[key] = (times, seconds)
+        elif state.window != window:
+            # the usage of the previous window, synced or not, does not count anymore
+            self.pending -= state.pending
+            state.window, state.remote, state.pending = window, 0, 0
+        state.tokens = min(times, state.tokens + (now - state.updated_at) * times / seconds)
+        state.updated_at = now
+
+        if cost > times:
+            RATE_LIMIT_DECISIONS.labels(route=route, result="limited").inc()
+            return math.inf
+        retry_after = max(cost - state.tokens, 0.0) * seconds / times
+        if state.remote + state.pending + cost > times:
+            retry_after = max(retry_after, (window + 1) * seconds - now)
+        if retry_after > 0:
+            RATE_LIMIT_DECISIONS.labels(route=route, result="limited").inc()
+            return retry_after
+        state.tokens -= cost
+        state.pending += cost
+        self.pending += cost
+        RATE_LIMIT_DECISIONS.labels(route=route, result="allowed").inc()
+        if self.pending >= self.sync_batch or self.sync_interval == 0:
+            self.sync_needed.set()
+        return 0.0
+
+    async def run(self) -> None:
+        """
+        The function `run` syncs the usage with Redis every `sync_interval` seconds, or as soon as `hit`
+        asks for it, until it is cancelled. It is started in the background by every worker.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self.sync_needed.wait(), self.sync_interval or None)
+            except asyncio.TimeoutError:
+                pass
+            self.sync_needed.clear()
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Could not sync the rate limits")
+
+    async def sync(self) -> None:
+        """
+        The function `sync` adds the pending usage of every client to its Redis counter, in one pipeline,
+        and reads back the usage of all the workers. The states of the clients idle for a whole window are
+        dropped. Concurrent calls return at once while a sync is running.
+        """
+        if self.syncing:
+            return
+        self.syncing = True
+        now = self.clock()
+        start = time.perf_counter()
+        try:
+            synced = []
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, state in list(self.states.items()):
+                    route, client = key
+                    times, seconds = self.limits[key]
+                    if state.window != int(now // seconds):
+                        # the usage of an ended window is not sent, an idle client has a full bucket again
+                        self.pending -= state.pending
+                        state.pending = 0
+                        if now - state.updated_at >= seconds:
+                            del self.states[key]
+                            del self.limits[key]
+                        continue
+                    if state.pending == 0:
+                        continue
+                    usage_key = USAGE_KEY.format(route=route, client=client, window=state.window)
+                    pipe.incrby(usage_key, state.pending)
+                    pipe.expire(usage_key, math.ceil(seconds) + 1)
+                    synced.append((state, state.window, state.pending))
+                results = await pipe.execute() if synced else []
+            for (state, window, sent), total in zip(synced, results[::2]):
+                # unless `hit` moved the client to the next window meanwhile, dropping its pending usage
+                if state.window == window:
+                    state.pending -= sent
+                    self.pending -= sent
+                    state.remote = int(total)
+        except RedisError:
+            logger.warning("Could not sync the rate limits with Redis, limiting in process only", exc_info=True)
+        finally:
+            self.syncing = False
+            RATE_LIMIT_SYNC_SECONDS.observe(time.perf_counter() - start)
+
+
+def client_identifier(request: Request) -> str:
+    """
+    The function `client_identifier` identifies the client of a request by the first address of its
+    `X-Forwarded-For` header, set by the proxy in front of the workers, or by its remote address.
+    """
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimit:
+    """
+    The class `RateLimit` is the limit of a route: `times` units per `seconds` per client, enforced by a
+    `RateLimiter`. Used as a dependency (`dependencies=[Depends(RateLimit(...))]`) every request costs
+    one unit; an endpoint can also call `hit` itself with the cost of the request, e.g. the number of
+    claims of a batch. An exceeded limit is answered with a 429 and a `Retry-After` header, and a request
+    costing more than the whole limit, which no retry would get admitted, with a 413.
+    """
+
+    def __init__(self, limiter: RateLimiter, times: int, seconds: float, route: str = None):
+        self.limiter = limiter
+        self.times = times
+        self.seconds = seconds
+        self.route = route
+
+    async def __call__(self, request: Request) -> None:
+        await self.hit(request)
+
+    async def hit(self, request: Request, cost: int = 1) -> None:
+        route = self.route or request.scope["route"].path
+        retry_after = await self.limiter.hit(route, client_identifier(request), self.times, self.seconds, cost)
+        if retry_after == math.inf:
+            raise HTTPException(status_code=413, detail=f"The request costs {cost} units, more than the limit of "
+                                                        f"{self.times} per {self.seconds:g} seconds: split it")
+        if retry_after > 0:
+            raise HTTPException(status_code=429, detail="Too Many Requests",
+                                headers={"Retry-After": str(math.ceil(retry_after))})
@@ -0,0 +1,159 @@
+import zlib
+from collections import deque
+import zstandard
+from fastapi import HTTPException
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from ..config.metrics_config import REQUEST_BODY_BYTES
+
+# Decompressed bytes produced at most per step, after which the limits are checked.
+OUTPUT_STEP = 64 * 1024
+# Compressed bytes fed to zstd per step: its decompression objects cannot bound their output, but a zstd
+# block expands at most ~32768 times, so a step yields at most ~32 MiB.
+ZSTD_INPUT_STEP = 1024
+# The ratio is only enforced past this decompressed size, small batches of identical claims compress well.
+RATIO_MIN_BYTES = 1024 * 1024
+
+
+class GzipDecoder:
+    """
+    The class `GzipDecoder` decompresses a gzip body incrementally, one or more concatenated members.
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(wbits=31)
+
+    def decompress(self, data: bytes):
+        while True:
+            chunk = self.decompressor.decompress(data, OUTPUT_STEP)
+            data = self.decompressor.unconsumed_tail
+            if self.decompressor.eof and self.decompressor.unused_data:
+                data = self.decompressor.unused_data + data
+                self.decompressor = zlib.decompressobj(wbits=31)
+            if chunk:
+                yield chunk
+            if not data and len(chunk) < OUTPUT_STEP:
+                return
+
+    @property
+    def complete(self) -> bool:
+        return self.decompressor.eof
+
+
+class ZstdDecoder:
+    """
+    The class `ZstdDecoder` decompresses a zstd body (one frame) incrementally.
+    """
+
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes):
+        for start in range(0, len(data), ZSTD_INPUT_STEP):
+            chunk = self.decompressor.decompress(data[start:start + ZSTD_INPUT_STEP])
+            if chunk:
+                yield chunk
+
+    @property
+    def complete(self) -> bool:
+        return self.decompressor.eof
+
+
+DECODERS = {"gzip": GzipDecoder, "zstd": ZstdDecoder}
+
+
+class DecompressedBody:
+    """
+    The class `DecompressedBody` is the `receive` callable given to the application in place of the one
+    of the server: it decompresses the body messages as they come in, and hands the decompressed body
+    out in chunks of at most `OUTPUT_STEP` bytes, so that a body is never held compressed and
+    decompressed as a whole unless the endpoint reads it whole.
+    """
+
+    def __init__(self, receive: Receive, encoding: str, max_size: int, max_ratio: float):
+        self.receive = receive
+        self.encoding = encoding
+        self.decoder = DECODERS[encoding]()
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+        self.compressed = 0
+        self.decompressed = 0
+        self.pending = deque()
+        self.received = False
+        self.finished = False
+
+    async def __call__(self) -> Message:
+        if self.finished:
+            # e.g. the disconnect listener of the streaming responses
+            return await self.receive()
+        while not self.pending and not self.received:
+            message = await self.receive()
+            if message["type"] != "http.request":
+                return message
+            self.feed(message.get("body", b""), more_body=message.get("more_body", False))
+        if self.pending:
+            body = self.pending.popleft()
+        else:
+            body = b""
+        more_body = bool(self.pending) or not self.received
+        self.finished = not more_body
+        return {"type": "http.request", "body": body, "more_body": more_body}
+
+    def feed(self, data: bytes, more_body: bool) -> None:
+        """
+        The function `feed` decompresses a message of the body, raising an `HTTPException` with a 413 as
+        soon as the decompressed body exceeds `max_size` bytes or `max_ratio` times the compressed bytes
+        received so far, and with a 400 if the body is not valid or ends within the compressed data.
+        """
+        self.compressed += len(data)
+        REQUEST_BODY_BYTES.labels(encoding=self.encoding, side="compressed").inc(len(data))
+        try:
+            for chunk in self.decoder.decompress(data):
+                self.decompressed += len(chunk)
+                REQUEST_BODY_BYTES.labels(encoding=self.encoding, side="decompressed").inc(len(chunk))
+                if self.decompressed > self.max_size:
+                    raise HTTPException(status_code=413,
+                                        detail=f"Decompressed body larger than {self.max_size} bytes")
+                if self.decompressed > max(RATIO_MIN_BYTES, self.max_ratio * self.compressed):
+                    raise HTTPException(status_code=413,
+                                        detail=f"Body compressed more than {self.max_ratio:g} times")
+                self.pending.append(chunk)
+        except (zlib.error, zstandard.ZstdError) as error:
+            raise HTTPException(status_code=400, detail=f"Invalid {self.encoding} body: {error}")
+        if not more_body:
+            self.received = True
+            if self.compressed and not self.decoder.complete:
+                raise HTTPException(status_code=400, detail=f"Truncated {self.encoding} body")
+
+
+class RequestDecompressionMiddleware:
+    """
+    The class `RequestDecompressionMiddleware` is an ASGI middleware accepting request bodies sent with
+    `Content-Encoding: gzip` or `zstd`. The body is decompressed incrementally as it streams in (see
+    `DecompressedBody`), and the application sees a plain body: the `Content-Encoding` and
+    `Content-Length` headers are removed. Other encodings are answered with a 415.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int, max_ratio: float):
+        self.app = app
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = Headers(scope=scope).get("content-encoding", "identity").strip().lower()
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+        if encoding not in DECODERS:
+            response = JSONResponse({"detail": f"Unsupported Content-Encoding: {encoding}"}, status_code=415,
+                                    headers={"Accept-Encoding": ", ".join(DECODERS)})
+            await response(scope, receive, send)
+            return
+        headers = [(name, value) for name, value in scope["headers"]
+                   if name.lower() not in (b"content-encoding", b"content-length")]
+        await self.app({**scope, "headers": headers},
+                       DecompressedBody(receive, encoding, self.max_size, self.max_ratio), send)
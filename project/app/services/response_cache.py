@@ -0,0 +1,170 @@
+import asyncio
+import json
+import logging
+import uuid
+from redis.exceptions import RedisError
+from ..config.metrics_config import TOP_N_CACHE
+
+# Version of the rankings, incremented by every batch of claims committed.
+RANKING_VERSION_KEY = "top:version"
+# Channel on which the new version is published, so that the workers stop reading the previous one. A
+# version published as `reset:<version>` also makes the workers reload their rankings from the database.
+RANKING_VERSION_CHANNEL = "top:invalidate"
+# Version of the last reset of the rankings, for the workers which were not subscribed when it was published.
+RANKING_RESET_KEY = "top:reset"
+# Cached response of a ranking request for one version of the rankings.
+RESPONSE_KEY = "top:response:{version}:{request}"
+# Held by the worker computing a missing response, the others wait for it instead of computing it too.
+LOCK_KEY = RESPONSE_KEY + ":lock"
+
+logger = logging.getLogger(__name__)
+
+
+async def bump_ranking_version(redis_connection, reset: bool = False) -> int:
+    """
+    The function `bump_ranking_version` invalidates every cached ranking response, of every worker,
+    by incrementing the version of the rankings and publishing it. The responses of the previous
+    version are not deleted, nothing reads them anymore and they expire. With `reset` the workers also
+    reload the rankings they keep in memory, e.g. after the aggregates were rebuilt.
+    """
+    version = await redis_connection.incr(RANKING_VERSION_KEY)
+    if reset:
+        await redis_connection.set(RANKING_RESET_KEY, version)
+        await redis_connection.publish(RANKING_VERSION_CHANNEL, f"reset:{version}")
+    else:
+        await redis_connection.publish(RANKING_VERSION_CHANNEL, version)
+    return version
+
+
+class RankingResponseCache:
+    """
+    The class `RankingResponseCache` caches the responses of the ranking endpoints in Redis, under a key
+    holding the version of the rankings. A committed batch bumps the version (`invalidate`), so a ranking
+    is fresh right after an ingest and an unchanged one can be cached for a long `ttl`.
+
+    After an invalidation, only the worker acquiring the lock of a response computes it; the others
+    poll for it for up to `lock_timeout` seconds, then compute it themselves. While `listen` runs, the
+    version is kept in memory and updated from the invalidation channel, so a hit costs a single `GET`.
+    Redis errors are not fatal: the response is then computed without the cache.
+
+    `listen` also awaits every coroutine function of `reset_handlers` when the rankings are reset (see
+    `bump_ranking_version`), or when it finds a reset it missed while it was not subscribed.
+    """
+
+    def __init__(self, redis_connection, ttl: int = 300, lock_timeout: float = 10.0, poll_interval: float = 0.05):
+        """
+        :param redis_connection: An asyncio Redis client
+        :param ttl: The number of seconds a response is cached
+        :param lock_timeout: The number of seconds a worker computing a response holds its lock
+        :param poll_interval: The number of seconds between two reads of a response being computed
+        """
+        self.redis = redis_connection
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        # version received from the invalidation channel, `None` when not listening
+        self.version = None
+        # called when the rankings are reset, and the version of the last reset seen
+        self.reset_handlers = []
+        self.reset_version = None
+
+    async def current_version(self) -> int:
+        if self.version is not None:
+            return self.version
+        return int(await self.redis.get(RANKING_VERSION_KEY) or 0)
+
+    async def invalidate(self) -> None:
+        try:
+            version = await bump_ranking_version(self.redis)
+        except RedisError:
+            # nothing can be read from the cache while Redis is unavailable
+            return
+        if self.version is not None:
+            self.version = max(self.version, version)
+
+    async def get_or_compute(self, request: str, compute) -> tuple[object, str]:
+        """
+        The function `get_or_compute` returns the cached response of `request`, or computes it with
+        `compute` and caches it.
+
+        :param request: Identifies the response, e.g. the path and the sorted query parameters
+        :type request: str
+        :param compute: A coroutine function returning a JSON serializable response
+        :return: A tuple `(response, result)` where `result` is "hit", "miss" (computed by this call) or
+        "coalesced" (computed by a concurrent call).
+        """
+        try:
+            version = await self.current_version()
+            key = RESPONSE_KEY.format(version=version, request=request)
+            cached = await self.redis.get(key)
+            if cached is not None:
+                return self.counted(json.loads(cached), "hit")
+            lock_key = LOCK_KEY.format(version=version, request=request)
+            token = uuid.uuid4().hex
+            if not await self.redis.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000)):
+                cached = await self.wait_for(key)
+                if cached is not None:
+                    return self.counted(json.loads(cached), "coalesced")
+        except RedisError:
+            return self.counted(await compute(), "miss")
+        response = await compute()
+        try:
+            await self.redis.set(key, json.dumps(response), ex=self.ttl)
+            if await self.redis.get(lock_key) == token:
+                await self.redis.delete(lock_key)
+        except RedisError:
+            pass
+        return self.counted(response, "miss")
+
+    async def wait_for(self, key: str):
+        """
+        The function `wait_for` polls for a response computed by another worker, for up to
+        `lock_timeout` seconds, and returns it or `None`.
+        """
+        for _ in range(max(1, int(self.lock_timeout / self.poll_interval))):
+            await asyncio.sleep(self.poll_interval)
+            cached = await self.redis.get(key)
+            if cached is not None:
+                return cached
+        return None
+
+    @staticmethod
+    def counted(response, result: str) -> tuple[object, str]:
+        TOP_N_CACHE.labels(layer="response", result=result).inc()
+        return response, result
+
+    async def listen(self) -> None:
+        """
+        The function `listen` follows the invalidation channel and keeps the version in memory until it
+        is cancelled. The version is read from Redis again whenever the subscription is lost, and so is
+        the version of the last reset, the rankings being reset if one was missed meanwhile.
+        """
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(RANKING_VERSION_CHANNEL)
+                # subscribed before reading, so that no bump falls between the two
+                self.version = int(await self.redis.get(RANKING_VERSION_KEY) or 0)
+                reset_version = int(await self.redis.get(RANKING_RESET_KEY) or 0)
+                if self.reset_version is not None and reset_version > self.reset_version:
+                    await self.reset(reset_version)
+                self.reset_version = reset_version
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        reset, _, version = str(message["data"]).rpartition(":")
+                        self.version = max(self.version, int(version))
+                        if reset:
+                            await self.reset(int(version))
+            except RedisError:
+                self.version = None
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def reset(self, version: int) -> None:
+        self.reset_version = max(self.reset_version or 0, version)
+        for handler in self.reset_handlers:
+            try:
+                await handler()
+            except Exception:
+                logger.exception("Could not reset a ranking")
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import sys
+from .config.db_config import async_session
+from .config.env_config import envs
+from .config.redis_config import get_binary_redis, get_redis
+from .models.spaceSavingSketch import SpaceSavingSketch
+from .models.topNPriorityQueue import TopNPriorityQueue
+from .services.ingest_queue import IngestWorker, requeue_dead_letters
+from .services.ranking import SketchRanking, create_ranking_backend
+from .services.response_cache import RankingResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+async def main(args: list[str]) -> None:
+    """
+    The function `main` runs the ingest worker writing the batches queued by `/claims?mode=async`, or,
+    with `--requeue-dead`, moves the dead-lettered batches back to the queue and exits.
+    """
+    redis_connection = get_redis()
+    if "--requeue-dead" in args:
+        logger.info("Requeued %d batches", await requeue_dead_letters(redis_connection))
+        return
+    # The worker updates the ranking like `/claims` does. With the `memory` backend the ranking lives in
+    # the web workers, which would never count the queued claims: the `redis` or `database` backend is required.
+    if envs.RANKING_BACKEND == "memory":
+        raise RuntimeError("The ingest worker requires RANKING_BACKEND=redis or database: with memory the "
+                           "queued claims would not be counted by the /top-provider of the web workers")
+    ranking = create_ranking_backend(envs.RANKING_BACKEND, TopNPriorityQueue(n=10), redis_connection)
+    # The queued claims are counted by the approximate ranking through a sketch published like the ones of the
+    # web workers, and emptied like them when the rankings are reset (e.g. by a bulk load).
+    approx_ranking, background_tasks = None, []
+    if envs.RANKING_SKETCH_SHARING == "redis":
+        approx_ranking = SketchRanking(SpaceSavingSketch(envs.RANKING_SKETCH_CAPACITY), redis_connection=get_binary_redis())
+        resets = RankingResponseCache(redis_connection)
+        resets.reset_handlers.append(approx_ranking.unload)
+        background_tasks = [asyncio.create_task(resets.listen()),
+                            asyncio.create_task(approx_ranking.run(async_session, envs.RANKING_SKETCH_PUBLISH_INTERVAL))]
+    else:
+        logger.warning("RANKING_SKETCH_SHARING is not redis: /top-provider?mode=approx does not count the queued claims")
+    worker = IngestWorker(redis_connection,
+                          async_session,
+                          ranking=ranking,
+                          approx_ranking=approx_ranking,
+                          name=envs.INGEST_WORKER_NAME,
+                          max_claims=envs.INGEST_WORKER_MAX_CLAIMS,
+                          max_attempts=envs.INGEST_MAX_ATTEMPTS,
+                          status_ttl=envs.INGEST_STATUS_TTL)
+    try:
+        await worker.run()
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        if approx_ranking is not None:
+            try:
+                await approx_ranking.retire()
+            except Exception:
+                logger.exception("Could not fold the ranking sketch of the worker into the shared one")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)  # pragma: no cover
+    asyncio.run(main(sys.argv[1:]))  # pragma: no cover
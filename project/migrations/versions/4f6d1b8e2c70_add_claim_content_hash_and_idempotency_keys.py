@@ -0,0 +1,37 @@
+"""add claim content hash and idempotency keys
+
+Revision ID: 4f6d1b8e2c70
+Revises: e2a7c4d9b861
+Create Date: 2026-10-18 16:20:11.604532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = '4f6d1b8e2c70'
+down_revision = 'e2a7c4d9b861'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Claims stored before this revision keep a NULL hash: they are not deduplicated against new ones.
+    op.add_column('claim', sa.Column('content_hash', sqlmodel.sql.sqltypes.AutoString(length=64), nullable=True))
+    op.create_index('ix_claim_content_hash', 'claim', ['content_hash'], unique=True)
+    op.create_table('idempotency_keys',
+    sa.Column('key', sqlmodel.sql.sqltypes.AutoString(length=255), nullable=False),
+    sa.Column('request_hash', sqlmodel.sql.sqltypes.AutoString(length=64), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=False),
+    sa.Column('response', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('idempotency_keys')
+    op.drop_index('ix_claim_content_hash', table_name='claim')
+    op.drop_column('claim', 'content_hash')
@@ -0,0 +1,37 @@
+"""add provider daily totals
+
+Revision ID: 5d8e2b6f4a1c
+Revises: c3f1a9d2b7e4
+Create Date: 2026-10-18 11:02:47.903114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = '5d8e2b6f4a1c'
+down_revision = 'c3f1a9d2b7e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('provider_daily_totals',
+    sa.Column('service_date', sa.Date(), nullable=False),
+    sa.Column('provider_npi', sqlmodel.sql.sqltypes.AutoString(length=10), nullable=False),
+    sa.Column('net_fee_sum', sa.Float(), nullable=False),
+    sa.Column('claim_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('service_date', 'provider_npi')
+    )
+    # backfill one bucket per provider and service day from the claims stored before this revision
+    op.execute(
+        "INSERT INTO provider_daily_totals (service_date, provider_npi, net_fee_sum, claim_count) "
+        "SELECT CAST(service_dttm AS date), provider_npi, sum(net_fee), count(*) FROM claim "
+        "GROUP BY CAST(service_dttm AS date), provider_npi"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('provider_daily_totals')
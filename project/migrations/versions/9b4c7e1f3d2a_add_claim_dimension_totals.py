@@ -0,0 +1,50 @@
+"""add claim dimension totals
+
+Revision ID: 9b4c7e1f3d2a
+Revises: 5d8e2b6f4a1c
+Create Date: 2026-10-18 13:41:05.276390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4c7e1f3d2a'
+down_revision = '5d8e2b6f4a1c'
+branch_labels = None
+depends_on = None
+
+DIMENSIONS = ['group_id', 'quadrant', 'submitted_proc']
+
+
+def upgrade() -> None:
+    op.create_table('claim_dimension_totals',
+    sa.Column('provider_npi', sqlmodel.sql.sqltypes.AutoString(length=10), nullable=False),
+    sa.Column('group_id', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('quadrant', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('submitted_proc', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('net_fee_sum', sa.Float(), nullable=False),
+    sa.Column('claim_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('provider_npi', 'group_id', 'quadrant', 'submitted_proc')
+    )
+    # backfill the rollup from the claims stored before this revision
+    op.execute(
+        "INSERT INTO claim_dimension_totals (provider_npi, group_id, quadrant, submitted_proc, net_fee_sum, claim_count) "
+        "SELECT provider_npi, group_id, COALESCE(quadrant, ''), submitted_proc, sum(net_fee), count(*) FROM claim "
+        "GROUP BY provider_npi, group_id, COALESCE(quadrant, ''), submitted_proc"
+    )
+    for dimension in DIMENSIONS:
+        # rollup rankings filtered on one dimension (the primary key covers provider_npi)
+        op.create_index(f'ix_claim_dimension_totals_{dimension}', 'claim_dimension_totals', [dimension, 'provider_npi'], unique=False)
+        # windowed rankings filtered on one dimension are answered from `claim` with an index only scan
+        op.create_index(f'ix_claim_{dimension}_service_dttm', 'claim', [dimension, 'service_dttm'], unique=False,
+                        postgresql_include=['provider_npi', 'net_fee'])
+
+
+def downgrade() -> None:
+    for dimension in DIMENSIONS:
+        op.drop_index(f'ix_claim_{dimension}_service_dttm', table_name='claim')
+        op.drop_index(f'ix_claim_dimension_totals_{dimension}', table_name='claim_dimension_totals')
+    op.drop_table('claim_dimension_totals')
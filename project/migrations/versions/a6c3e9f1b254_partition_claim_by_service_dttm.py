@@ -0,0 +1,125 @@
+"""partition claim by service_dttm
+
+Revision ID: a6c3e9f1b254
+Revises: 4f6d1b8e2c70
+Create Date: 2026-10-18 17:41:36.270915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c3e9f1b254'
+down_revision = '4f6d1b8e2c70'
+branch_labels = None
+depends_on = None
+
+DIMENSIONS = ['group_id', 'quadrant', 'submitted_proc']
+
+# `create_claim_partition(month)` creates the partition of the month of `month`, named `claim_yYYYYmMM`, unless
+# it exists. The claims of the month stored in `claim_default` meanwhile are moved to it before it is attached.
+CREATE_CLAIM_PARTITION = """
+CREATE OR REPLACE FUNCTION create_claim_partition(month date) RETURNS boolean AS $$
+DECLARE
+    start_at timestamp := date_trunc('month', month);
+    end_at timestamp := date_trunc('month', month) + interval '1 month';
+    partition text := 'claim_y' || to_char(start_at, 'YYYY') || 'm' || to_char(start_at, 'MM');
+BEGIN
+    -- serializes the workers maintaining the partitions
+    PERFORM pg_advisory_xact_lock(hashtext('create_claim_partition'));
+    IF to_regclass(partition) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE claim INCLUDING DEFAULTS)', partition);
+    EXECUTE format('WITH moved AS (DELETE FROM claim_default WHERE service_dttm >= %L AND service_dttm < %L RETURNING *) '
+                   'INSERT INTO %I SELECT * FROM moved', start_at, end_at, partition);
+    EXECUTE format('ALTER TABLE claim ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition, start_at, end_at);
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+# `maintain_claim_partitions(months_ahead)` creates the partitions of the current month and of the next
+# `months_ahead` ones, and of every month found in `claim_default`, and returns the number created.
+MAINTAIN_CLAIM_PARTITIONS = """
+CREATE OR REPLACE FUNCTION maintain_claim_partitions(months_ahead integer) RETURNS integer AS $$
+DECLARE
+    month timestamp;
+    created integer := 0;
+BEGIN
+    FOR month IN
+        SELECT generate_series(date_trunc('month', now()), date_trunc('month', now()) + make_interval(months => months_ahead),
+                               interval '1 month')
+        UNION
+        SELECT DISTINCT date_trunc('month', service_dttm) FROM claim_default
+    LOOP
+        IF create_claim_partition(month::date) THEN
+            created := created + 1;
+        END IF;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def create_claim_indexes() -> None:
+    # created on the partitioned table, every partition gets its own copy
+    op.create_index('ix_claim_content_hash', 'claim', ['content_hash', 'service_dttm'], unique=True)
+    op.create_index('ix_claim_provider_npi_id', 'claim', ['provider_npi', 'id'], unique=False)
+    op.create_index('ix_claim_subscriber_id_id', 'claim', ['subscriber_id', 'id'], unique=False)
+    op.create_index('ix_claim_group_id_id', 'claim', ['group_id', 'id'], unique=False)
+    op.create_index('ix_claim_service_dttm_id', 'claim', ['service_dttm', 'id'], unique=False)
+    for dimension in DIMENSIONS:
+        op.create_index(f'ix_claim_{dimension}_service_dttm', 'claim', [dimension, 'service_dttm'], unique=False,
+                        postgresql_include=['provider_npi', 'net_fee'])
+
+
+def upgrade() -> None:
+    # Unique constraints of a partitioned table must include the partition key: the primary key becomes
+    # (id, service_dttm) and the content hash is unique per service date, which is part of the hash.
+    op.execute("ALTER TABLE claim RENAME TO claim_unpartitioned")
+    op.execute("ALTER INDEX claim_pkey RENAME TO claim_unpartitioned_pkey")
+    op.execute(
+        "CREATE TABLE claim (LIKE claim_unpartitioned INCLUDING DEFAULTS, PRIMARY KEY (id, service_dttm)) "
+        "PARTITION BY RANGE (service_dttm)"
+    )
+    # claims of a month without partition yet, moved out by `create_claim_partition`
+    op.execute("CREATE TABLE claim_default PARTITION OF claim DEFAULT")
+    op.execute(CREATE_CLAIM_PARTITION)
+    op.execute(MAINTAIN_CLAIM_PARTITIONS)
+    op.execute(
+        "SELECT create_claim_partition(month::date) FROM "
+        "(SELECT DISTINCT date_trunc('month', service_dttm) AS month FROM claim_unpartitioned) AS months"
+    )
+    op.execute("SELECT maintain_claim_partitions(3)")
+    op.execute("INSERT INTO claim SELECT * FROM claim_unpartitioned")
+    # the id sequence outlives the old table and keeps numbering the claims
+    op.execute("ALTER SEQUENCE claim_id_seq OWNED BY NONE")
+    op.drop_table('claim_unpartitioned')
+    op.execute("ALTER SEQUENCE claim_id_seq OWNED BY claim.id")
+    create_claim_indexes()
+
+
+def downgrade() -> None:
+    # the claims of the partitions detached since the upgrade are not brought back
+    op.execute("ALTER TABLE claim RENAME TO claim_partitioned")
+    op.execute("ALTER INDEX claim_pkey RENAME TO claim_partitioned_pkey")
+    op.execute("CREATE TABLE claim (LIKE claim_partitioned INCLUDING DEFAULTS, PRIMARY KEY (id))")
+    op.execute("INSERT INTO claim SELECT * FROM claim_partitioned")
+    op.execute("ALTER SEQUENCE claim_id_seq OWNED BY NONE")
+    # drops every attached partition with it
+    op.execute("DROP TABLE claim_partitioned")
+    op.execute("ALTER SEQUENCE claim_id_seq OWNED BY claim.id")
+    op.execute("DROP FUNCTION maintain_claim_partitions(integer)")
+    op.execute("DROP FUNCTION create_claim_partition(date)")
+    op.create_index('ix_claim_provider_npi_id', 'claim', ['provider_npi', 'id'], unique=False)
+    op.create_index('ix_claim_subscriber_id_id', 'claim', ['subscriber_id', 'id'], unique=False)
+    op.create_index('ix_claim_group_id_id', 'claim', ['group_id', 'id'], unique=False)
+    op.create_index('ix_claim_service_dttm_id', 'claim', ['service_dttm', 'id'], unique=False)
+    op.create_index('ix_claim_content_hash', 'claim', ['content_hash'], unique=True)
+    for dimension in DIMENSIONS:
+        op.create_index(f'ix_claim_{dimension}_service_dttm', 'claim', [dimension, 'service_dttm'], unique=False,
+                        postgresql_include=['provider_npi', 'net_fee'])
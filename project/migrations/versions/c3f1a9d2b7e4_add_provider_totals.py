@@ -0,0 +1,38 @@
+"""add provider totals
+
+Revision ID: c3f1a9d2b7e4
+Revises: 7a0fe7de09fa
+Create Date: 2026-10-18 09:12:31.418205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1a9d2b7e4'
+down_revision = '7a0fe7de09fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('provider_totals',
+    sa.Column('provider_npi', sqlmodel.sql.sqltypes.AutoString(length=10), nullable=False),
+    sa.Column('net_fee_sum', sa.Float(), nullable=False),
+    sa.Column('claim_count', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('provider_npi')
+    )
+    op.create_index(op.f('ix_provider_totals_net_fee_sum'), 'provider_totals', ['net_fee_sum'], unique=False)
+    # backfill the totals of the claims stored before this revision
+    op.execute(
+        "INSERT INTO provider_totals (provider_npi, net_fee_sum, claim_count, updated_at) "
+        "SELECT provider_npi, sum(net_fee), count(*), now() FROM claim GROUP BY provider_npi"
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_provider_totals_net_fee_sum'), table_name='provider_totals')
+    op.drop_table('provider_totals')
@@ -0,0 +1,64 @@
+"""add provider stats
+
+Revision ID: d4b8f2a6c913
+Revises: a6c3e9f1b254
+Create Date: 2026-10-18 16:02:41.518307
+
+"""
+import math
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4b8f2a6c913'
+down_revision = 'a6c3e9f1b254'
+branch_labels = None
+depends_on = None
+
+# parameters of the `DDSketch` of the net fees, see `app/models/ddSketch.py`
+RELATIVE_ACCURACY = 0.01
+MIN_VALUE = 0.01
+LOG_GAMMA = math.log((1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY))
+OFFSET = math.ceil(math.log(MIN_VALUE) / LOG_GAMMA) - 1
+
+
+def upgrade() -> None:
+    op.create_table('provider_stats',
+    sa.Column('provider_npi', sqlmodel.sql.sqltypes.AutoString(length=10), nullable=False),
+    sa.Column('claim_count', sa.Integer(), nullable=False),
+    sa.Column('net_fee_mean', sa.Float(), nullable=False),
+    sa.Column('net_fee_m2', sa.Float(), nullable=False),
+    sa.Column('net_fee_min', sa.Float(), nullable=False),
+    sa.Column('net_fee_max', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('provider_npi')
+    )
+    op.create_table('provider_fee_buckets',
+    sa.Column('provider_npi', sqlmodel.sql.sqltypes.AutoString(length=10), nullable=False),
+    sa.Column('bucket', sa.Integer(), nullable=False),
+    sa.Column('claim_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('provider_npi', 'bucket')
+    )
+    # backfill the summaries from the claims stored before this revision, the sum of the squared deviations
+    # from the mean being their population variance times their count
+    op.execute(
+        "INSERT INTO provider_stats (provider_npi, claim_count, net_fee_mean, net_fee_m2, net_fee_min, net_fee_max, updated_at) "
+        "SELECT provider_npi, count(*), avg(net_fee), var_pop(net_fee) * count(*), min(net_fee), max(net_fee), now() "
+        "FROM claim WHERE net_fee IS NOT NULL GROUP BY provider_npi"
+    )
+    # and their buckets, numbered like `DDSketch.bucket`
+    op.execute(
+        "INSERT INTO provider_fee_buckets (provider_npi, bucket, claim_count) "
+        "SELECT provider_npi, bucket, count(*) FROM ("
+        f"  SELECT provider_npi, CASE WHEN abs(net_fee) < {MIN_VALUE} THEN 0 "
+        f"  ELSE sign(net_fee)::int * greatest(ceil(ln(abs(net_fee)) / {LOG_GAMMA!r})::int - {OFFSET}, 1) END AS bucket "
+        "  FROM claim WHERE net_fee IS NOT NULL"
+        ") AS buckets GROUP BY provider_npi, bucket"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('provider_fee_buckets')
+    op.drop_table('provider_stats')
@@ -0,0 +1,36 @@
+"""add claim query indexes
+
+Revision ID: e2a7c4d9b861
+Revises: 9b4c7e1f3d2a
+Create Date: 2026-10-18 15:02:47.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c4d9b861'
+down_revision = '9b4c7e1f3d2a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # GET /claims filters on one of these columns and pages on `id`: `WHERE column = :value AND id > :after_id
+    # ORDER BY id LIMIT :limit` is a single range scan of the composite index.
+    op.create_index('ix_claim_provider_npi_id', 'claim', ['provider_npi', 'id'], unique=False)
+    op.create_index('ix_claim_subscriber_id_id', 'claim', ['subscriber_id', 'id'], unique=False)
+    op.create_index('ix_claim_group_id_id', 'claim', ['group_id', 'id'], unique=False)
+    op.create_index('ix_claim_service_dttm_id', 'claim', ['service_dttm', 'id'], unique=False)
+    # superseded by ix_claim_provider_npi_id, which starts with the same column
+    op.drop_index('ix_provider_npi', table_name='claim')
+
+
+def downgrade() -> None:
+    op.create_index('ix_provider_npi', 'claim', ['provider_npi'], unique=False)
+    op.drop_index('ix_claim_service_dttm_id', table_name='claim')
+    op.drop_index('ix_claim_group_id_id', table_name='claim')
+    op.drop_index('ix_claim_subscriber_id_id', table_name='claim')
+    op.drop_index('ix_claim_provider_npi_id', table_name='claim')
@@ -0,0 +1,30 @@
+"""add claim xid
+
+Revision ID: f1c6a8e3d527
+Revises: d4b8f2a6c913
+Create Date: 2026-10-19 09:12:54.104821
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel             # NEW
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c6a8e3d527'
+down_revision = 'd4b8f2a6c913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # the claims stored so far are all committed: they come first in the feed, in id order
+    op.add_column('claim', sa.Column('xid', sa.BigInteger(), server_default='0', nullable=False))
+    # every claim stored from now on gets the id of its transaction, on every partition
+    op.alter_column('claim', 'xid', server_default=sa.text('pg_current_xact_id()::text::bigint'))
+    op.create_index('ix_claim_xid_id', 'claim', ['xid', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_claim_xid_id', table_name='claim')
+    op.drop_column('claim', 'xid')
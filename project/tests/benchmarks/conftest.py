@@ -0,0 +1,14 @@
+import pytest
+
+
+def pytest_collection_modifyitems(config, items):
+    """
+    The micro-benchmarks only run with `--benchmark-only` (or `--benchmark-enable`), so the unit and
+    integration test run stays fast. The load driver smoke test always runs.
+    """
+    if config.getoption("benchmark_only", False) or config.getoption("benchmark_enable", False):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --benchmark-only")
+    for item in items:
+        if "benchmark" in getattr(item, "fixturenames", ()):
+            item.add_marker(skip)
@@ -0,0 +1,17 @@
+import json
+from project.tests.benchmarks.load_driver import compare, main_cli, percentile
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert (percentile(values, 50), percentile(values, 99), percentile(values, 100)) == (50.0, 99.0, 100.0)
+
+
+def test_load_driver_smoke(tmp_path):
+    output = tmp_path / "results.json"
+    report = main_cli(["--batch-sizes", "1,20", "--requests", "4", "--concurrency", "2", "--top-requests", "4",
+                       "--output", str(output)])
+    assert json.loads(output.read_text()) == report
+    assert [entry["batch_size"] for entry in report["results"]["claims"]] == [1, 20]
+    assert set(report["results"]["top_provider"]["latency_ms"]) == {"p50", "p95", "p99", "max"}
+    assert len(compare(report, report)) == 3
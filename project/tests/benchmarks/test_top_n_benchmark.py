@@ -0,0 +1,42 @@
+import random
+import pytest
+from project.app.models.models import ClaimTopProvider
+from project.app.models.topNPriorityQueue import TopNPriorityQueue
+
+# number of distinct providers of the benchmarks
+CARDINALITIES = [1_000, 10_000, 100_000]
+# claims pushed by one round of `test_push`
+PUSHES = 10_000
+
+
+def make_claims(cardinality: int, count: int, seed: int = 7) -> list[ClaimTopProvider]:
+    rng = random.Random(seed)
+    return [ClaimTopProvider(f"{rng.randrange(cardinality):010d}", round(rng.uniform(-50, 500), 2)) for _ in range(count)]
+
+
+def loaded_queue(cardinality: int) -> TopNPriorityQueue:
+    pq = TopNPriorityQueue(n=10)
+    pq.load([(f"{npi:010d}", float(npi % 997)) for npi in range(cardinality)])
+    return pq
+
+
+@pytest.mark.parametrize("cardinality", CARDINALITIES)
+def test_push(benchmark, cardinality):
+    claims = make_claims(cardinality, PUSHES)
+
+    def push_all(pq):
+        for claim in claims:
+            pq.push(claim)
+
+    benchmark.extra_info["pushes"] = PUSHES
+    benchmark.pedantic(push_all, setup=lambda: ((loaded_queue(cardinality),), {}), rounds=10)
+
+
+@pytest.mark.parametrize("cardinality", CARDINALITIES)
+@pytest.mark.parametrize("n", [10, 100])
+def test_get_top_n(benchmark, cardinality, n):
+    pq = loaded_queue(cardinality)
+    for claim in make_claims(cardinality, PUSHES):
+        pq.push(claim)
+    top = benchmark(pq.get_top_n, n)
+    assert len(top) == n
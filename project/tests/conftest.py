@@ -1,4 +1,5 @@
 import pytest
+import pytest_asyncio
 from fastapi.testclient import TestClient
 
 @pytest.fixture
@@ -11,6 +12,20 @@ def client(app):
     return TestClient(app)
 
 
+# A valid claim as sent to `/claims`, whose net fee is 10.0.
+CLAIM = {"service_dttm": "2018-03-20 00:00:00", "submitted_proc": "D0180", "group_id": "GRP-1000",
+         "subscriber_id": "3730189502", "provider_npi": "1497775540", "provider_fees": 100.00,
+         "allowed_fees": 100.00, "member_co_ins": 10.00, "member_co_pay": 0.00, "quadrant": None}
+
+
+@pytest.fixture
+def make_claim():
+    """Builds the JSON of a claim sent to `/claims`, `CLAIM` with the given fields overridden."""
+    def make_claim(**fields):
+        return {**CLAIM, **fields}
+    return make_claim
+
+
 @pytest.fixture
 def envs():
     from ..app.config.env_config import envs
@@ -22,3 +37,41 @@ def assert_all_logs_contain_trace_info(caplog, envs):
         assert log.otelTraceID is not None
         assert log.otelSpanID is not None
         assert log.otelServiceName == envs.APP_NAME
+
+
+@pytest_asyncio.fixture
+async def sqlite_session(tmp_path):
+    """An `AsyncSession` bound to a throwaway sqlite database holding all SQLModel tables."""
+    from sqlmodel import SQLModel, create_engine
+    from sqlmodel.ext.asyncio.session import AsyncSession, AsyncEngine
+    from ..app.models import models  # noqa: F401 registers the tables on SQLModel.metadata
+
+    engine = AsyncEngine(create_engine(f"sqlite+aiosqlite:///{tmp_path / 'claims.db'}", future=True))
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+    await engine.dispose()
+
+
+@pytest.fixture
+def sqlite_client(app, tmp_path):
+    """A `TestClient` whose database sessions use a throwaway sqlite database."""
+    from sqlmodel import SQLModel, create_engine
+    from sqlmodel.ext.asyncio.session import AsyncSession, AsyncEngine
+    from ..app.config.db_config import get_read_session, get_session
+
+    url = f"sqlite+aiosqlite:///{tmp_path / 'app.db'}"
+
+    async def get_sqlite_session():
+        engine = AsyncEngine(create_engine(url, future=True))
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+        await engine.dispose()
+
+    app.dependency_overrides[get_session] = get_sqlite_session
+    app.dependency_overrides[get_read_session] = get_sqlite_session
+    yield TestClient(app)
+    app.dependency_overrides.clear()
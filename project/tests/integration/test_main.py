@@ -1,3 +1,12 @@
+import gzip
+import json
+from datetime import date, timedelta
+import pytest
+from fastapi import HTTPException
+from prometheus_client import REGISTRY
+from project.app.main import ranking_cache_key, service_window
+
+
 def test_hello(client):
     response = client.get("/hello")
     assert response.status_code == 200
@@ -14,3 +23,148 @@ def test_prometheus_metrics(client):
 def test_get_top_provider(client):
     response = client.get("/top_provider")
     assert response.status_code == 404
+
+def test_top_provider_ranks_the_stored_claims(sqlite_client, make_claim, monkeypatch):
+    from project.app import main
+    # the in-process ranking is loaded from the database of the test by the first ranking request
+    monkeypatch.setattr(main.pq, "loaded", False)
+    claims = [make_claim(provider_npi="1111111111", provider_fees=150.0), make_claim(provider_npi="2222222222"),
+              make_claim(provider_npi="3333333333", provider_fees=130.0)]
+    assert sqlite_client.post("/claims", json=claims).status_code == 200
+    response = sqlite_client.get("/top-provider", params={"n": 2})
+    assert response.status_code == 200
+    assert response.json() == [{"provider_npi": "1111111111", "net_fee": 60.0},
+                               {"provider_npi": "3333333333", "net_fee": 40.0}]
+    # a batch committed afterwards moves its provider in the loaded ranking
+    assert sqlite_client.post("/claims", json=[make_claim(provider_npi="2222222222", provider_fees=210.0)]).status_code == 200
+    response = sqlite_client.get("/top-provider", params={"n": 2})
+    assert [(row["provider_npi"], row["net_fee"]) for row in response.json()] == [("2222222222", 130.0),
+                                                                               ("1111111111", 60.0)]
+    assert sqlite_client.get("/top-provider", params={"n": 0}).status_code == 422
+
+def test_upload_claims(sqlite_client):
+    body = "Service Date,Submitted Procedure,Quadrant,Plan/Group #,Subscriber#,Provider NPI,Provider Fees,Allowed Fees,Member Coinsurance,Member Copay\n" \
+           "3/28/18 0:00,D0180,,GRP-1000,3730189502,1497775540,$100.00,$100.00,$10.00,$0.00\n"
+    response = sqlite_client.post("/claims/upload", content=body, headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 1
+
+def test_upload_claims_unsupported_format(sqlite_client):
+    response = sqlite_client.post("/claims/upload", content=b"{}", headers={"Content-Type": "application/json"})
+    assert response.status_code == 415
+
+def test_add_multiple_claims(sqlite_client, make_claim):
+    claim = make_claim()
+    response = sqlite_client.post("/claims", json=[claim, claim])
+    assert response.status_code == 200
+    assert [(row["id"], row["net_fee"]) for row in response.json()] == [(1, 10.0), (2, 10.0)]
+
+def test_add_multiple_claims_response_modes(sqlite_client, make_claim):
+    claim = make_claim()
+    response = sqlite_client.post("/claims?response_mode=ids", json=[claim, make_claim(member_co_ins=20.0)])
+    assert response.json() == [{"id": 1, "net_fee": 10.0}, {"id": 2, "net_fee": 20.0}]
+    response = sqlite_client.post("/claims?response_mode=none", json=[claim, make_claim(member_co_ins=30.0)])
+    assert response.json() == {"claims": 2, "inserted": 1, "duplicates": 1}
+    full = sqlite_client.post("/claims", json=[claim]).json()
+    assert full[0]["service_dttm"] == "2018-03-20T00:00:00" and full[0]["id"] == 1
+    assert sqlite_client.post("/claims?response_mode=echo", json=[claim]).status_code == 422
+
+def test_add_multiple_claims_async_mode_without_postgres(sqlite_client, make_claim):
+    # claim ids cannot be reserved on sqlite, the batch is stored in the request
+    response = sqlite_client.post("/claims?mode=async&response_mode=ids", json=[make_claim()])
+    assert response.status_code == 200
+    assert response.json() == [{"id": 1, "net_fee": 10.0}]
+
+def test_add_multiple_claims_stage_metrics(sqlite_client, make_claim):
+    def stage_count(stage):
+        return REGISTRY.get_sample_value("claims_ingest_stage_seconds_count", {"stage": stage}) or 0
+
+    stages = ["validation", "net_fee", "db_write", "aggregator_update"]
+    before = [stage_count(stage) for stage in stages]
+    batches = REGISTRY.get_sample_value("claims_batch_size_sum", {"source": "claims"}) or 0
+    claim = make_claim()
+    assert sqlite_client.post("/claims", json=[claim, claim, claim]).status_code == 200
+    # every stage is observed once per batch
+    assert [stage_count(stage) - count for stage, count in zip(stages, before)] == [1, 1, 1, 1]
+    assert REGISTRY.get_sample_value("claims_batch_size_sum", {"source": "claims"}) - batches == 3
+    assert "top_n_aggregator_memory_bytes" in sqlite_client.get("/metrics").text
+
+def test_add_multiple_claims_invalid(sqlite_client):
+    response = sqlite_client.post("/claims", json=[{"provider_npi": "123"}])
+    assert response.status_code == 422
+    assert ["body", 0, "provider_npi"] in [error["loc"] for error in response.json()["detail"]]
+
+def test_service_window():
+    assert service_window(None, None, None) is None
+    assert service_window(date(2018, 1, 1), date(2018, 3, 31), None) == (date(2018, 1, 1), date(2018, 3, 31))
+    assert service_window(date(2018, 1, 1), None, None) == (date(2018, 1, 1), date.max)
+    start, end = service_window(None, None, 7)
+    assert end - start == timedelta(days=6)
+    with pytest.raises(HTTPException):
+        service_window(date(2018, 3, 1), date(2018, 1, 1), None)
+    with pytest.raises(HTTPException):
+        service_window(date(2018, 3, 1), None, 7)
+
+def test_claims_feed(sqlite_client, make_claim):
+    claims = [make_claim(provider_fees=float(fee)) for fee in range(100, 103)]
+    assert sqlite_client.post("/claims", json=claims).status_code == 200
+    response = sqlite_client.get("/claims/feed", params={"cursor": 1, "limit": 10})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.headers["x-next-cursor"] == "0-3"
+    assert [json.loads(line)["net_fee"] for line in response.text.splitlines()] == [11.0, 12.0]
+    response = sqlite_client.get("/claims/feed", params={"cursor": "0-3"})
+    assert (response.headers["x-next-cursor"], response.text) == ("0-3", "")
+
+def test_get_claims(sqlite_client, make_claim):
+    claim = make_claim()
+    assert sqlite_client.post("/claims", json=[claim, claim, claim]).status_code == 200
+    response = sqlite_client.get("/claims", params={"provider_npi": "1497775540", "limit": 2, "fields": "net_fee"})
+    assert response.status_code == 200
+    assert response.json() == {"claims": [{"id": 1, "net_fee": 10.0}, {"id": 2, "net_fee": 10.0}], "next_after_id": 2}
+    response = sqlite_client.get("/claims", params={"after_id": 2, "fields": "id"})
+    assert response.json() == {"claims": [{"id": 3}], "next_after_id": None}
+    assert sqlite_client.get("/claims", params={"fields": "unknown"}).status_code == 400
+
+def test_add_multiple_claims_idempotency_key(sqlite_client, make_claim):
+    claim = make_claim()
+    headers = {"Idempotency-Key": "batch-1"}
+    first = sqlite_client.post("/claims", json=[claim, claim], headers=headers)
+    retry = sqlite_client.post("/claims", json=[claim, claim], headers=headers)
+    assert retry.status_code == 200
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json() == first.json()
+    assert sqlite_client.post("/claims", json=[claim], headers=headers).status_code == 422
+    # without a key, the claims already stored are recognized by their content hash
+    response = sqlite_client.post("/claims", json=[claim, claim, claim])
+    assert [row["id"] for row in response.json()] == [1, 2, 3]
+
+def test_get_provider_stats(sqlite_client, make_claim):
+    claim = make_claim()
+    assert sqlite_client.post("/claims", json=[claim, make_claim(member_co_ins=30.0)]).status_code == 200
+    stats = sqlite_client.get("/providers/1497775540/stats").json()
+    assert (stats["count"], stats["mean"], stats["stddev"], stats["min"], stats["max"]) == (2, 20.0, 10.0, 10.0, 30.0)
+    assert stats["p50"] == pytest.approx(10.0, rel=0.01)
+    assert sqlite_client.get("/providers/1111111111/stats").status_code == 404
+    assert sqlite_client.get("/providers/123/stats").status_code == 422
+
+def test_add_multiple_claims_compressed(sqlite_client, make_claim):
+    claims = [make_claim(member_co_ins=float(i)) for i in range(100)]
+    body = gzip.compress(json.dumps(claims).encode())
+    response = sqlite_client.post("/claims", content=body, headers={"Content-Type": "application/json",
+                                                                   "Content-Encoding": "gzip",
+                                                                   "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert [row["net_fee"] for row in response.json()] == [float(i) for i in range(100)]
+
+
+def test_ranking_cache_key_holds_the_resolved_window():
+    last_week = ranking_cache_key("/top-provider", [("last_days", "7"), ("n", "5")], (date(2024, 1, 1), date(2024, 1, 7)))
+    # the same request a day later is another ranking, and the same dates given explicitly the same one
+    assert last_week != ranking_cache_key("/top-provider", [("last_days", "7"), ("n", "5")],
+                                          (date(2024, 1, 2), date(2024, 1, 8)))
+    assert last_week == ranking_cache_key("/top-provider", [("n", "5"), ("service_date_from", "2024-01-01"),
+                                                            ("service_date_to", "2024-01-07")],
+                                          (date(2024, 1, 1), date(2024, 1, 7)))
+    assert ranking_cache_key("/top-provider", [("n", "5")], None) == "/top-provider?n=5"
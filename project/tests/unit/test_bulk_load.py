@@ -0,0 +1,138 @@
+import csv
+import json
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func, insert, inspect
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from project.app.models.models import Claim, ClaimDimensionTotal, ProviderDailyTotal, ProviderTotal
+from project.app.services.bulk_load import (LoadCheckpoint, load_claim_file, parse_claim_lines, read_chunks,
+                                            rebuild_claim_aggregates)
+from project.app.services.aggregate_rebuild import rebuild_from_claims
+from project.app.services.claim_ingest import ingest_claims, upsert_provider_totals
+from project.tests.unit.test_ranking import claim_row
+
+HEADER = "service date,submitted procedure,quadrant,Plan/Group #,Subscriber#,Provider NPI,provider fees,Allowed fees,member coinsurance,member copay"
+
+
+def claim_line(day, provider_npi, provider_fees):
+    return f"3/{day}/18 0:00,D0180,,GRP-1000,3730189502,{provider_npi},${provider_fees:.2f},$10.00,$0.00,$0.00"
+
+
+@pytest.fixture
+def claim_file(tmp_path):
+    lines = [HEADER, claim_line(1, "1111111111", 110), claim_line(2, "2222222222", 30), "",
+             claim_line(3, "not an npi", 50), claim_line(4, "1111111111", 20), "3/5/18 0:00,D0180",
+             claim_line(6, "3333333333", 15)]
+    path = tmp_path / "claims.csv"
+    path.write_text("\r\n".join(lines) + "\r\n")
+    return str(path)
+
+
+def test_parse_claim_lines(claim_file):
+    chunks = list(read_chunks(claim_file, "csv", chunk_size=4))
+    assert [(index, first_line_number, len(lines)) for index, first_line_number, _, lines in chunks] == [(0, 2, 4), (1, 6, 3)]
+    rows, errors, lines = parse_claim_lines(chunks[0][3], "csv", chunks[0][2], chunks[0][1])
+    assert lines == 3
+    assert [(row["provider_npi"], row["net_fee"]) for row in rows] == [("1111111111", 100.0), ("2222222222", 20.0)]
+    assert all(len(row["content_hash"]) == 64 for row in rows)
+    assert [(line_number, detail[0]["loc"]) for line_number, detail in errors] == [(5, ["provider_npi"])]
+
+
+def test_identical_claims_are_hashed_alike_whatever_the_chunks():
+    line = claim_line(1, "1111111111", 110)
+    together, _, _ = parse_claim_lines([line, line], "csv", HEADER.split(","), 2)
+    apart, _, _ = parse_claim_lines([line], "csv", HEADER.split(","), 3)
+    assert together[0]["content_hash"] == together[1]["content_hash"] == apart[0]["content_hash"]
+
+
+def test_read_chunks_keeps_quoted_line_breaks(tmp_path):
+    path = tmp_path / "quoted.csv"
+    path.write_text(f'{HEADER}\r\n3/1/18 0:00,D0180,"UR\r\nUL",GRP-1000,3730189502,1111111111,$10.00,$0.00,$0.00,$0.00\r\n'
+                    f'{claim_line(2, "not an npi", 50)}\r\n')
+    chunks = list(read_chunks(str(path), "csv", chunk_size=4))
+    assert [(first_line_number, len(lines)) for _, first_line_number, _, lines in chunks] == [(2, 2)]
+    rows, errors, lines = parse_claim_lines(chunks[0][3], "csv", chunks[0][2], chunks[0][1])
+    assert [row["quadrant"] for row in rows] == ["UR\r\nUL"]
+    assert (lines, [line_number for line_number, _ in errors]) == (2, [4])
+
+
+def test_read_chunks_recovers_from_stray_quotes_and_oversized_cells(tmp_path):
+    path = tmp_path / "stray.csv"
+    # a quote within an unquoted cell is kept as is, one opening a cell is never closed
+    stray = claim_line(1, "1111111111", 20).replace("GRP-1000", 'GRP 5"')
+    unterminated = '"' + claim_line(2, "1111111111", 20)
+    oversized = claim_line(3, "2222222222", 10).replace("GRP-1000", "G" * (csv.field_size_limit() + 1))
+    lines = [HEADER, stray, unterminated, oversized, claim_line(4, "3333333333", 30)]
+    path.write_text("\n".join(lines) + "\n")
+    chunks = list(read_chunks(str(path), "csv", chunk_size=10))
+    assert [(first_line_number, len(lines)) for _, first_line_number, _, lines in chunks] == [(2, 4)]
+    rows, errors, lines = parse_claim_lines(chunks[0][3], "csv", chunks[0][2], chunks[0][1])
+    assert [(row["provider_npi"], row["group_id"]) for row in rows] == [("1111111111", 'GRP 5"'),
+                                                                        ("3333333333", "GRP-1000")]
+    assert lines == 4
+    assert [(line_number, detail[0]["msg"].split(":")[0]) for line_number, detail in errors] == [
+        (3, "unterminated quoted cell"), (4, "invalid CSV")]
+
+
+@pytest.mark.asyncio
+async def test_load_resumes_from_checkpoint_and_rebuilds_aggregates(claim_file, sqlite_session, tmp_path):
+    session_factory = lambda: AsyncSession(sqlite_session.bind, expire_on_commit=False)
+    checkpoint_file = str(tmp_path / "claims.checkpoint.json")
+    # a claim ingested through the API before the backfill, counted again by the rebuild
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 5.0)])
+
+    # an interrupted load had committed the second chunk only
+    interrupted = LoadCheckpoint(checkpoint_file, claim_file, chunk_size=4)
+    interrupted.mark_done(1, {"lines": 2, "inserted": 0, "duplicates": 0, "failed": 1})
+
+    with ProcessPoolExecutor(2) as pool:
+        checkpoint = LoadCheckpoint(checkpoint_file, claim_file, chunk_size=100)
+        assert checkpoint.chunk_size == 4
+        report = await load_claim_file(claim_file, session_factory, pool, checkpoint, connections=1,
+                                       errors_path=str(tmp_path / "errors.ndjson"))
+        assert report == {"lines": 5, "inserted": 2, "duplicates": 0, "failed": 2}
+        assert checkpoint.done_below == 2
+
+        # every chunk is recorded, loading the file again reads nothing
+        again = await load_claim_file(claim_file, session_factory, pool, LoadCheckpoint(checkpoint_file, claim_file, 4),
+                                      connections=1)
+        assert again == report
+
+    errors = [json.loads(line) for line in open(tmp_path / "errors.ndjson")]
+    assert [error["line"] for error in errors] == [5]
+    stored = (await sqlite_session.execute(select(Claim.provider_npi, Claim.net_fee).order_by(Claim.id))).all()
+    # the claims of the second chunk are not loaded again
+    assert stored == [("1111111111", 5.0), ("1111111111", 100.0), ("2222222222", 20.0)]
+
+    assert await rebuild_claim_aggregates(sqlite_session) == 2
+    totals = (await sqlite_session.execute(select(ProviderTotal.provider_npi, ProviderTotal.net_fee_sum,
+                                                  ProviderTotal.claim_count))).all()
+    assert sorted(totals) == [("1111111111", 105.0, 2), ("2222222222", 20.0, 1)]
+    daily = (await sqlite_session.execute(select(ProviderDailyTotal.net_fee_sum))).scalars().all()
+    assert sorted(daily) == [5.0, 20.0, 100.0]
+    dimensions = (await sqlite_session.execute(select(ClaimDimensionTotal.quadrant, ClaimDimensionTotal.net_fee_sum))).all()
+    assert sorted(dimensions) == [("", 20.0), ("", 105.0)]
+
+
+@pytest.mark.asyncio
+async def test_rebuild_counts_the_claims_stored_meanwhile(sqlite_session):
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 10.0)])
+
+    async def fill(session, staging):
+        connection = await session.connection()
+        await connection.execute(insert(staging["provider_totals"]).from_select(
+            ["provider_npi", "net_fee_sum", "claim_count", "updated_at"],
+            select(Claim.provider_npi, func.sum(Claim.net_fee), func.count(), func.max(Claim.service_dttm))
+            .group_by(Claim.provider_npi)))
+        # a batch committed after the snapshot of the staging tables, through the same session since sqlite has
+        # a single writer: it is not in the staging tables but added to the swapped in totals
+        await ingest_claims(session, [claim_row("1111111111", 5.0), claim_row("2222222222", 7.0)])
+        return 1
+
+    assert await rebuild_from_claims(sqlite_session, [ProviderTotal.__table__], fill, upsert_provider_totals) == 1
+    totals = (await sqlite_session.execute(select(ProviderTotal.provider_npi, ProviderTotal.net_fee_sum,
+                                                  ProviderTotal.claim_count))).all()
+    assert sorted(totals) == [("1111111111", 15.0, 2), ("2222222222", 7.0, 1)]
+    assert "provider_totals_rebuild" not in await sqlite_session.run_sync(
+        lambda session: inspect(session.connection()).get_table_names())
@@ -0,0 +1,95 @@
+from datetime import datetime
+import pytest
+from pydantic import ValidationError
+from project.app.models.models import ClaimCreate
+from project.app.services.claim_columns import validate_claim_columns
+
+CLAIM = {
+    "service_dttm": "2018-03-20 00:00:00",
+    "submitted_proc": "D0180",
+    "group_id": "GRP-1000",
+    "subscriber_id": "3730189502",
+    "provider_npi": "1497775540",
+    "provider_fees": 100.00,
+    "allowed_fees": "100.00",
+    "member_co_ins": 10.00,
+    "member_co_pay": 5,
+    "quadrant": None,
+}
+
+
+def test_valid_batch_computes_net_fee():
+    rows, errors = validate_claim_columns([CLAIM, dict(CLAIM, provider_fees=250.0, allowed_fees=50.0)])
+    assert errors == {}
+    assert [row["net_fee"] for row in rows] == [15.0, 215.0]
+    assert rows[0]["service_dttm"] == datetime(2018, 3, 20)
+    assert rows[0]["allowed_fees"] == 100.0
+
+
+def test_errors_are_reported_per_row():
+    records = [
+        CLAIM,
+        dict(CLAIM, provider_npi="14977755401", provider_fees="abc"),
+        dict(CLAIM, submitted_proc="X0180", service_dttm="20/03/2018"),
+        {key: value for key, value in CLAIM.items() if key != "group_id"},
+        dict(CLAIM, subscriber_id=None),
+        "not a claim",
+    ]
+    rows, errors = validate_claim_columns(records)
+    assert len(rows) == 1
+    assert sorted(errors) == [1, 2, 3, 4, 5]
+    assert {(tuple(error["loc"]), error["type"]) for error in errors[1]} == {
+        (("provider_npi",), "value_error.str.regex"), (("provider_fees",), "type_error.float")}
+    assert {(tuple(error["loc"]), error["type"]) for error in errors[2]} == {
+        (("submitted_proc",), "value_error.str.regex"), (("service_dttm",), "value_error.datetime")}
+    assert errors[3] == [{"loc": ["group_id"], "msg": "field required", "type": "value_error.missing"}]
+    assert errors[4][0]["type"] == "type_error.none.not_allowed"
+    assert errors[5] == [{"loc": [], "msg": "value is not a valid dict", "type": "type_error.dict"}]
+
+
+def test_only_numbers_are_coerced_to_str():
+    rows, errors = validate_claim_columns([dict(CLAIM, group_id=1000, subscriber_id=3730189502.5, provider_npi=1497775540),
+                                           dict(CLAIM, group_id={"id": 1000}, provider_npi=["1497775540"], quadrant=[])])
+    assert (rows[0]["group_id"], rows[0]["subscriber_id"], rows[0]["provider_npi"]) == ("1000", "3730189502.5", "1497775540")
+    assert len(rows) == 1 and sorted(errors) == [1]
+    with pytest.raises(ValidationError) as pydantic_error:
+        ClaimCreate(**dict(CLAIM, group_id={"id": 1000}, provider_npi=["1497775540"], quadrant=[]))
+    assert {(tuple(error["loc"]), error["msg"], error["type"]) for error in errors[1]} == {
+        (error["loc"], error["msg"], error["type"]) for error in pydantic_error.value.errors()}
+
+
+def test_non_ascii_digits_are_not_an_npi():
+    _, errors = validate_claim_columns([dict(CLAIM, provider_npi="149777554٣")])
+    assert errors[0][0]["loc"] == ["provider_npi"]
+
+
+def test_missing_service_dttm_defaults_to_now():
+    claim = {key: value for key, value in CLAIM.items() if key != "service_dttm"}
+    rows, errors = validate_claim_columns([claim, dict(CLAIM, service_dttm="2018-03-20T00:00:00+02:00")])
+    assert errors == {}
+    assert isinstance(rows[0]["service_dttm"], datetime)
+    assert rows[1]["service_dttm"].utcoffset().total_seconds() == 7200
+
+
+def test_nested_fees_are_not_floats():
+    for records in ([dict(CLAIM, provider_fees=[1])], [dict(CLAIM, provider_fees=[1]), dict(CLAIM, provider_fees=2)]):
+        rows, errors = validate_claim_columns(records)
+        assert errors[0] == [{"loc": ["provider_fees"], "msg": "value is not a valid float", "type": "type_error.float"}]
+    assert [row["provider_fees"] for row in rows] == [2.0]
+    with pytest.raises(ValidationError):
+        ClaimCreate(**dict(CLAIM, provider_fees=[1]))
+
+
+@pytest.mark.parametrize("service_dttm", ["2024-01", "2024-01-15", "2024", "2024-01-15T10:00", "2024-01-15 10:00:05.25"])
+def test_service_dttm_is_parsed_like_pydantic(service_dttm):
+    rows, errors = validate_claim_columns([dict(CLAIM, service_dttm=service_dttm)])
+    try:
+        expected = ClaimCreate(**dict(CLAIM, service_dttm=service_dttm)).service_dttm
+    except ValidationError:
+        assert not rows and errors[0][0]["type"] == "value_error.datetime"
+    else:
+        assert errors == {} and rows[0]["service_dttm"] == expected
+
+
+def test_empty_batch():
+    assert validate_claim_columns([]) == ([], {})
@@ -0,0 +1,70 @@
+import json
+import pytest
+import time
+from datetime import datetime
+from project.app.services.claim_feed import (next_feed_cursor, parse_feed_cursor, stream_feed,
+                                             wait_for_feed_cursor)
+from project.app.services.claim_ingest import ingest_claims
+
+
+def claim_row(net_fee):
+    return {
+        "service_dttm": datetime(2018, 3, 20, 13, 5),
+        "submitted_proc": "D0180",
+        "group_id": "GRP-1000",
+        "subscriber_id": "3730189502",
+        "provider_npi": "1497775530",
+        "provider_fees": net_fee,
+        "allowed_fees": 0.0,
+        "member_co_ins": 0.0,
+        "member_co_pay": 0.0,
+        "quadrant": None,
+        "net_fee": net_fee,
+    }
+
+
+async def read_feed(session, cursor, end, partition_size=2):
+    return [json.loads(line) for chunk in [chunk async for chunk in stream_feed(session, cursor, end, partition_size)]
+            for line in chunk.splitlines()]
+
+
+@pytest.mark.asyncio
+async def test_feed_pages_by_id(sqlite_session):
+    await ingest_claims(sqlite_session, [claim_row(float(fee)) for fee in range(1, 6)])
+    assert await next_feed_cursor(sqlite_session, (0, 0), 3) == (0, 3)
+    page = await read_feed(sqlite_session, (0, 0), (0, 3))
+    assert [(claim["id"], claim["net_fee"]) for claim in page] == [(1, 1.0), (2, 2.0), (3, 3.0)]
+    assert page[0]["service_dttm"] == "2018-03-20T13:05:00"
+    assert "xid" not in page[0]
+    assert await next_feed_cursor(sqlite_session, (0, 3), 3) == (0, 5)
+    assert [claim["id"] for claim in await read_feed(sqlite_session, (0, 3), (0, 5))] == [4, 5]
+    # the end of the feed: the cursor stays and nothing is streamed
+    assert await next_feed_cursor(sqlite_session, (0, 5), 3) == (0, 5)
+    assert await read_feed(sqlite_session, (0, 5), (0, 5)) == []
+    assert parse_feed_cursor("5") == (0, 5) and parse_feed_cursor("812-5") == (812, 5)
+    with pytest.raises(ValueError):
+        parse_feed_cursor("5-")
+
+
+@pytest.mark.asyncio
+async def test_feed_waits_for_claims_committed_out_of_order(sqlite_session):
+    # transaction 100 reserved id 2 and is still running while transaction 101 commits id 3
+    await ingest_claims(sqlite_session, [{**claim_row(3.0), "id": 3, "xid": 101}])
+    assert await next_feed_cursor(sqlite_session, (0, 0), 10, horizon=100) == (0, 0)
+    # once transaction 100 commits, both claims are read, id 2 first since its transaction is older
+    await ingest_claims(sqlite_session, [{**claim_row(2.0), "id": 2, "xid": 100}])
+    cursor = await next_feed_cursor(sqlite_session, (0, 0), 1, horizon=102)
+    assert [claim["id"] for claim in await read_feed(sqlite_session, (0, 0), cursor)] == [2]
+    end = await next_feed_cursor(sqlite_session, cursor, 10, horizon=102)
+    assert [claim["id"] for claim in await read_feed(sqlite_session, cursor, end)] == [3]
+    # a claim committed after the consumer read id 3 still follows its cursor, whatever its id
+    await ingest_claims(sqlite_session, [{**claim_row(1.0), "id": 1, "xid": 102}])
+    last = await next_feed_cursor(sqlite_session, end, 10, horizon=103)
+    assert [claim["id"] for claim in await read_feed(sqlite_session, end, last)] == [1]
+
+
+@pytest.mark.asyncio
+async def test_feed_long_poll_times_out(sqlite_session):
+    start = time.monotonic()
+    assert await wait_for_feed_cursor(sqlite_session, (0, 0), 10, wait=0.2, poll_interval=0.05) == (0, 0)
+    assert time.monotonic() - start >= 0.2
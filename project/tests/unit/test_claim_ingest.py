@@ -0,0 +1,82 @@
+import pytest
+from sqlmodel import select
+from project.app.models.models import Claim, ClaimCreate, ProviderTotal
+from project.app.services.claim_ingest import build_claim_rows, chunked, claim_content_hashes, ingest_claims
+
+
+def make_claim(**overrides):
+    claim = {
+        "service_dttm": "2018-03-20 00:00:00",
+        "submitted_proc": "D0180",
+        "group_id": "GRP-1000",
+        "subscriber_id": "3730189502",
+        "provider_npi": "1497775540",
+        "provider_fees": 100.00,
+        "allowed_fees": 100.00,
+        "member_co_ins": 10.00,
+        "member_co_pay": 5.00,
+    }
+    claim.update(overrides)
+    return ClaimCreate(**claim)
+
+
+def test_build_claim_rows_computes_net_fee():
+    rows = build_claim_rows([make_claim(), make_claim(provider_fees=250.0, allowed_fees=50.0)])
+    assert [row["net_fee"] for row in rows] == [15.0, 215.0]
+    assert "id" not in rows[0]
+
+
+def test_chunked():
+    assert list(chunked([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    with pytest.raises(ValueError):
+        list(chunked([1], 0))
+
+
+@pytest.mark.asyncio
+async def test_ingest_claims_returns_ids(sqlite_session):
+    rows, inserted = await ingest_claims(sqlite_session, build_claim_rows([make_claim() for _ in range(5)]), chunk_size=2)
+    assert [row["id"] for row in rows] == [1, 2, 3, 4, 5]
+    assert inserted == rows
+    stored = (await sqlite_session.exec(select(Claim))).all()
+    assert len(stored) == 5
+
+
+@pytest.mark.asyncio
+async def test_ingest_claims_is_all_or_nothing(sqlite_session):
+    rows = build_claim_rows([make_claim(), make_claim()])
+    rows[1]["group_id"] = None  # violates NOT NULL
+    with pytest.raises(Exception):
+        await ingest_claims(sqlite_session, rows)
+    stored = (await sqlite_session.exec(select(Claim))).all()
+    assert stored == []
+    assert (await sqlite_session.exec(select(ProviderTotal))).all() == []
+
+
+@pytest.mark.asyncio
+async def test_ingest_claims_upserts_provider_totals(sqlite_session):
+    await ingest_claims(sqlite_session, build_claim_rows([make_claim(), make_claim(provider_npi="2222222222")]))
+    await ingest_claims(sqlite_session, build_claim_rows([make_claim(provider_fees=200.0)]))
+    totals = (await sqlite_session.exec(select(ProviderTotal).order_by(ProviderTotal.provider_npi))).all()
+    assert [(total.provider_npi, total.net_fee_sum, total.claim_count) for total in totals] == [
+        ("1497775540", 130.0, 2), ("2222222222", 15.0, 1)]
+
+
+@pytest.mark.asyncio
+async def test_ingest_claims_skips_stored_claims(sqlite_session):
+    first, _ = await ingest_claims(sqlite_session, build_claim_rows([make_claim(), make_claim()]))
+    # a retry of the batch with one more claim: only the new claim is stored and counted
+    rows, inserted = await ingest_claims(sqlite_session, build_claim_rows([make_claim(), make_claim(), make_claim()]))
+    assert [row["id"] for row in rows] == [first[0]["id"], first[1]["id"], 3]
+    assert [row["id"] for row in inserted] == [3]
+    assert len((await sqlite_session.exec(select(Claim))).all()) == 3
+    total = (await sqlite_session.exec(select(ProviderTotal))).one()
+    assert (total.net_fee_sum, total.claim_count) == (45.0, 3)
+
+
+def test_claim_content_hashes():
+    rows = build_claim_rows([make_claim(), make_claim(), make_claim(provider_fees=200.0)])
+    hashes = claim_content_hashes(rows)
+    assert len(set(hashes)) == 3
+    # the same batch always gets the same hashes, whatever the ids
+    assert claim_content_hashes([{**row, "id": 7} for row in rows]) == hashes
+    assert claim_content_hashes(rows[1:2]) == hashes[:1]
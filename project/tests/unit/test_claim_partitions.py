@@ -0,0 +1,15 @@
+import pytest
+from datetime import date
+from project.app.services.claim_partitions import detach_claim_partition, maintain_claim_partitions, partition_name
+
+
+def test_partition_name():
+    assert partition_name(date(2018, 3, 20)) == "claim_y2018m03"
+    assert partition_name(date(2026, 12, 1)) == "claim_y2026m12"
+
+
+@pytest.mark.asyncio
+async def test_only_postgres_is_partitioned(sqlite_session):
+    assert await maintain_claim_partitions(sqlite_session) == 0
+    with pytest.raises(NotImplementedError):
+        await detach_claim_partition(sqlite_session, date(2018, 3, 1))
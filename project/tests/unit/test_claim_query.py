@@ -0,0 +1,48 @@
+import pytest
+from datetime import datetime
+from project.app.services.claim_ingest import ingest_claims
+from project.app.services.claim_query import QUERY_FIELDS, parse_fields, query_claims
+
+
+def claim_row(provider_npi, subscriber_id, service_dttm):
+    return {
+        "service_dttm": service_dttm,
+        "submitted_proc": "D0180",
+        "group_id": "GRP-1000",
+        "subscriber_id": subscriber_id,
+        "provider_npi": provider_npi,
+        "provider_fees": 100.0,
+        "allowed_fees": 100.0,
+        "member_co_ins": 10.0,
+        "member_co_pay": 0.0,
+        "quadrant": None,
+        "net_fee": 10.0,
+    }
+
+
+def test_parse_fields():
+    assert parse_fields(None) == QUERY_FIELDS
+    assert parse_fields("net_fee, provider_npi,id,net_fee") == ["id", "net_fee", "provider_npi"]
+    with pytest.raises(ValueError, match="password"):
+        parse_fields("net_fee,password")
+
+
+@pytest.mark.asyncio
+async def test_query_claims_pages_with_keyset(sqlite_session):
+    await ingest_claims(sqlite_session, [
+        claim_row("1111111111", "S1", datetime(2018, 3, day)) for day in range(1, 6)
+    ] + [claim_row("2222222222", "S2", datetime(2018, 3, 1))])
+
+    claims, next_after_id = await query_claims(sqlite_session, {"provider_npi": "1111111111"}, limit=2,
+                                               fields=["id", "service_dttm"])
+    assert claims == [{"id": 1, "service_dttm": datetime(2018, 3, 1)}, {"id": 2, "service_dttm": datetime(2018, 3, 2)}]
+    assert next_after_id == 2
+    claims, next_after_id = await query_claims(sqlite_session, {"provider_npi": "1111111111"}, after_id=2, limit=3)
+    assert [claim["id"] for claim in claims] == [3, 4, 5]
+    assert next_after_id is None
+
+    claims, _ = await query_claims(sqlite_session, service_dttm_from=datetime(2018, 3, 1),
+                                   service_dttm_to=datetime(2018, 3, 2))
+    assert [claim["id"] for claim in claims] == [1, 2, 6]
+    claims, _ = await query_claims(sqlite_session, {"subscriber_id": "S2", "group_id": "GRP-1000"})
+    assert [(claim["id"], claim["net_fee"]) for claim in claims] == [(6, 10.0)]
@@ -0,0 +1,115 @@
+import csv
+import pytest
+from datetime import datetime
+from project.app.services.claim_upload import (detect_format, ingest_upload, iter_csv_rows, iter_lines, normalize_header,
+                                              normalize_record)
+
+CLAIM_CSV = (
+    "service date,submitted procedure,quadrant,Plan/Group #,Subscriber#,Provider NPI,provider fees,Allowed fees,member coinsurance,member copay\n"
+    "3/28/18 0:00,D0180,,GRP-1000,3730189502,1497775540,$100.00 ,$100.00 ,$0.00 ,$0.00 \n"
+    "3/28/18 0:00,D0210,,GRP-1000,3730189502,1497775540,\"$1,108.00 \",$108.00 ,$0.00 ,$0.00 \n"
+    "3/28/18 0:00,X4346,,GRP-1000,3730189502,1497775540,$130.00 ,$65.00 ,$16.25 ,$0.00 \n"
+    "3/28/18 0:00,D4211\n"
+)
+
+
+async def byte_chunks(data: bytes, size: int = 7):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def test_normalize_header():
+    assert normalize_header("Plan/Group #") == "group_id"
+    assert normalize_header(" MEMBER coinsurance") == "member_co_ins"
+    assert normalize_header("Provider NPI") == "provider_npi"
+    assert normalize_header("member_co_pay") == "member_co_pay"
+
+
+def test_normalize_record():
+    assert normalize_record({"Service Date": "3/28/18 0:00", "Provider Fees": "$1,100.00 ", "quadrant": " "}) == {
+        "service_dttm": datetime(2018, 3, 28), "provider_fees": "1100.00", "quadrant": None}
+
+
+def test_detect_format():
+    assert detect_format("text/csv; charset=utf-8") == "csv"
+    assert detect_format("application/json", "ndjson") == "ndjson"
+    with pytest.raises(ValueError):
+        detect_format("application/json")
+
+
+@pytest.mark.asyncio
+async def test_iter_lines_splits_across_chunks():
+    lines = [line async for line in iter_lines(byte_chunks("﻿a,b\r\nc,é\nlast".encode("utf-8"), size=3))]
+    assert lines == ["a,b", "c,é", "last"]
+
+
+@pytest.mark.asyncio
+async def test_iter_csv_rows_keeps_quoted_line_breaks():
+    body = 'a,b\r\n"line 1\r\nline ""2""",x\n\n"1\n\n2",y\n"open,z\n'
+    rows = [row async for row in iter_csv_rows(byte_chunks(body.encode(), size=4))]
+    assert rows == [(1, ["a", "b"], None), (2, ['line 1\r\nline "2"', "x"], None), (5, ["1\n\n2", "y"], None),
+                    (8, None, "unterminated quoted cell")]
+
+
+@pytest.mark.asyncio
+async def test_iter_csv_rows_recovers_from_stray_quotes():
+    # a quote within an unquoted cell is kept as is
+    body = 'a,b\n1,5" tooth\n2,x\n"3,y\n4,z\n5,w\n'
+    rows = [row async for row in iter_csv_rows(byte_chunks(body.encode()), max_record_lines=2)]
+    assert rows == [(1, ["a", "b"], None), (2, ["1", '5" tooth'], None), (3, ["2", "x"], None),
+                    (4, None, "unterminated quoted cell"), (5, ["4", "z"], None), (6, ["5", "w"], None)]
+
+
+@pytest.mark.asyncio
+async def test_iter_csv_rows_reports_oversized_cells():
+    body = f'a,b\n{"x" * (csv.field_size_limit() + 1)},1\n2,x\n'
+    rows = [row async for row in iter_csv_rows(byte_chunks(body.encode(), size=4096))]
+    assert [(line_number, error is not None) for line_number, _, error in rows] == [(1, False), (2, True), (3, False)]
+    assert rows[2][1] == ["2", "x"]
+
+
+@pytest.mark.asyncio
+async def test_ingest_csv_upload(sqlite_session):
+    committed = []
+
+    async def after_commit(rows):
+        committed.append(len(rows))
+
+    report = await ingest_upload(byte_chunks(CLAIM_CSV.encode()), "csv", sqlite_session, after_commit=after_commit, chunk_size=1)
+    assert report["lines"] == 4
+    assert report["inserted"] == 2
+    assert report["failed"] == 2
+    assert [error["line"] for error in report["errors"]] == [4, 5]
+    assert report["errors"][0]["errors"][0]["loc"] == ["submitted_proc"]
+    assert committed == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_ingest_ndjson_upload_truncates_errors(sqlite_session):
+    body = b'{"Service_Dttm": "2018-03-20T00:00:00", "submitted_proc": "D0180", "group_id": "G", "subscriber_id": "S", ' \
+           b'"provider_npi": "1497775540", "provider_fees": 1, "allowed_fees": 0, "member_co_ins": 0, "member_co_pay": 0}\n' \
+           b'not json\n[1]\n'
+    report = await ingest_upload(byte_chunks(body), "ndjson", sqlite_session, max_errors=1)
+    assert (report["inserted"], report["failed"], len(report["errors"]), report["errors_truncated"]) == (1, 2, 1, True)
+
+
+@pytest.mark.asyncio
+async def test_ingest_csv_upload_with_quoted_line_breaks(sqlite_session):
+    header = CLAIM_CSV.split("\n")[0]
+    body = (f"{header}\n"
+            '3/28/18 0:00,D0180,"UR\nUL",GRP-1000,3730189502,1497775540,$100.00,$90.00,$0.00,$0.00\n'
+            "3/28/18 0:00,D4211\n")
+    report = await ingest_upload(byte_chunks(body.encode(), size=5), "csv", sqlite_session, chunk_size=1)
+    assert (report["lines"], report["inserted"], report["failed"]) == (2, 1, 1)
+    # the line of an error is the first line of its record
+    assert [error["line"] for error in report["errors"]] == [4]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_size", [1, 2, 10])
+async def test_identical_claims_of_a_file_collapse_whatever_the_chunks(sqlite_session, chunk_size):
+    header, claim = CLAIM_CSV.split("\n")[:2]
+    other = claim.replace("D0180", "D0140")
+    body = "\n".join([header, claim, other, claim]) + "\n"
+    report = await ingest_upload(byte_chunks(body.encode()), "csv", sqlite_session, chunk_size=chunk_size)
+    assert (report["inserted"], report["duplicates"]) == (2, 1)
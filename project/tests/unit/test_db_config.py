@@ -0,0 +1,70 @@
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import create_engine
+from sqlmodel.ext.asyncio.session import AsyncEngine, AsyncSession
+from project.app.config.db_config import (InstrumentedPool, ReadSessionRouter, create_database_engine, engine_options,
+                                          replica_lag)
+
+
+def test_engine_options():
+    options = engine_options("postgresql+asyncpg://u:p@db/foo")
+    assert options["poolclass"] is InstrumentedPool
+    assert options["echo"] is False
+    assert (options["pool_size"], options["max_overflow"], options["pool_pre_ping"]) == (10, 20, True)
+    assert options["connect_args"] == {"statement_cache_size": 100}
+    # sqlite keeps its own pool
+    assert "poolclass" not in engine_options("sqlite+aiosqlite:///claims.db")
+
+
+def test_pool_gauges():
+    create_database_engine("postgresql+asyncpg://u:p@db/foo", engine_name="gauges")
+    assert REGISTRY.get_sample_value("db_pool_size", {"engine": "gauges"}) == 10
+    assert REGISTRY.get_sample_value("db_pool_checked_out", {"engine": "gauges"}) == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_records_wait_time(tmp_path):
+    pool_engine = AsyncEngine(create_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=InstrumentedPool,
+                                            pool_size=1, max_overflow=0, future=True))
+    pool_engine.sync_engine.pool.engine_name = "wait"
+    for _ in range(3):
+        async with pool_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+    await pool_engine.dispose()
+    assert REGISTRY.get_sample_value("db_pool_wait_seconds_count", {"engine": "wait"}) == 3
+
+
+@pytest.mark.asyncio
+async def test_read_router_falls_back_to_primary(tmp_path):
+    engines = {name: AsyncEngine(create_engine(f"sqlite+aiosqlite:///{tmp_path / name}.db", future=True))
+               for name in ("primary", "replica")}
+    for name, database_engine in engines.items():
+        async with database_engine.begin() as connection:
+            await connection.execute(text("CREATE TABLE origin (name TEXT)"))
+            await connection.execute(text("INSERT INTO origin VALUES (:name)"), {"name": name})
+    factories = {name: sessionmaker(database_engine, class_=AsyncSession) for name, database_engine in engines.items()}
+    lags = [0.5, 10.0]
+
+    async def probe(session):
+        return lags.pop(0)
+
+    router = ReadSessionRouter(factories["replica"], factories["primary"], max_lag=5.0, check_interval=0, probe=probe)
+
+    async def read_origin():
+        async with (await router.session_factory())() as session:
+            return (await session.execute(text("SELECT name FROM origin"))).scalar()
+
+    assert await read_origin() == "replica"
+    assert REGISTRY.get_sample_value("db_replica_lag_seconds") == 0.5
+    assert await read_origin() == "primary"
+    # the replica cannot be reached
+    await engines["replica"].dispose()
+    (tmp_path / "replica.db").unlink()
+    (tmp_path / "replica.db").mkdir()
+    router.probe = replica_lag
+    assert await read_origin() == "primary"
+    await engines["primary"].dispose()
+    # without a replica, the primary is read without measuring anything
+    assert await ReadSessionRouter(factories["primary"], factories["primary"], probe=None).use_replica() is False
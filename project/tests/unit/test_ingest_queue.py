@@ -0,0 +1,152 @@
+import pytest
+from datetime import datetime
+from fakeredis import aioredis
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from project.app.models.models import Claim, ProviderTotal
+from project.app.models.spaceSavingSketch import SpaceSavingSketch
+from project.app.models.topNPriorityQueue import TopNPriorityQueue
+from project.app.services.claim_ingest import assign_content_hashes, ingest_claims
+from project.app.services.ingest_queue import (DEAD_LETTER_KEY, QUEUE_KEY, IngestWorker, encode_batch, enqueue_claims,
+                                               get_batch_status, requeue_dead_letters)
+from project.app.services.ranking import InProcessRanking, RedisRanking, SketchRanking
+
+
+def claim_row(claim_id, provider_npi="1497775530", net_fee=10.0):
+    return {
+        "id": claim_id,
+        "service_dttm": datetime(2018, 3, 20, 13, 5),
+        "submitted_proc": "D0180",
+        "group_id": "GRP-1000",
+        "subscriber_id": "3730189502",
+        "provider_npi": provider_npi,
+        "provider_fees": net_fee,
+        "allowed_fees": 0.0,
+        "member_co_ins": 0.0,
+        "member_co_pay": 0.0,
+        "quadrant": None,
+        "net_fee": net_fee,
+    }
+
+
+@pytest.fixture
+def redis_connection():
+    return aioredis.FakeRedis(decode_responses=True)
+
+
+def make_worker(redis_connection, sqlite_session, **kwargs):
+    return IngestWorker(redis_connection, lambda: AsyncSession(sqlite_session.bind, expire_on_commit=False),
+                        block_timeout=1, **kwargs)
+
+
+async def stored_ids(session):
+    result = await session.execute(select(Claim.id).order_by(Claim.id))
+    return result.scalars().all()
+
+
+@pytest.mark.asyncio
+async def test_worker_coalesces_queued_batches(redis_connection, sqlite_session):
+    first = await enqueue_claims(redis_connection, [claim_row(10), claim_row(11, "1111111111", 5.0)])
+    second = await enqueue_claims(redis_connection, [claim_row(12), claim_row(13)])
+    assert (await get_batch_status(redis_connection, first))["status"] == "queued"
+
+    ranking = InProcessRanking(TopNPriorityQueue(n=10))
+    await ranking.load(sqlite_session)
+    approx_ranking = SketchRanking(SpaceSavingSketch(10))
+    await approx_ranking.load(sqlite_session)
+    worker = make_worker(redis_connection, sqlite_session, ranking=ranking, approx_ranking=approx_ranking)
+    assert await worker.run_once() == 2
+
+    # the first claim of the second batch is the one of the first batch, the second one is new
+    assert await stored_ids(sqlite_session) == [10, 11, 13]
+    totals = (await sqlite_session.execute(select(ProviderTotal.provider_npi, ProviderTotal.net_fee_sum))).all()
+    assert sorted(totals) == [("1111111111", 5.0), ("1497775530", 20.0)]
+    assert [provider.provider_npi for provider in await ranking.get_top_n(2)] == ["1497775530", "1111111111"]
+    assert [(provider.provider_npi, provider.net_fee) for provider in await approx_ranking.get_top_n(2)] == [
+        ("1497775530", 20.0), ("1111111111", 5.0)]
+    for batch_id, duplicates in ((first, 0), (second, 1)):
+        status = await get_batch_status(redis_connection, batch_id)
+        assert (status["status"], status["duplicates"]) == ("stored", duplicates)
+    assert await get_batch_status(redis_connection, "unknown") is None
+
+
+@pytest.mark.asyncio
+async def test_worker_isolates_failing_batch(redis_connection, sqlite_session):
+    good = await enqueue_claims(redis_connection, [claim_row(1)])
+    bad = await enqueue_claims(redis_connection, [{**claim_row(2), "provider_npi": None}])
+    worker = make_worker(redis_connection, sqlite_session, max_attempts=2)
+
+    assert await worker.run_once() == 2
+    assert await stored_ids(sqlite_session) == [1]
+    assert (await get_batch_status(redis_connection, good))["status"] == "stored"
+    status = await get_batch_status(redis_connection, bad)
+    assert (status["status"], status["attempts"]) == ("retrying", 1)
+    assert "IntegrityError" in status["error"]
+
+    assert await worker.run_once() == 1
+    status = await get_batch_status(redis_connection, bad)
+    assert (status["status"], status["attempts"]) == ("failed", 2)
+    assert await redis_connection.llen(QUEUE_KEY) == 0
+    assert await redis_connection.llen(DEAD_LETTER_KEY) == 1
+
+    assert await requeue_dead_letters(redis_connection) == 1
+    assert (await get_batch_status(redis_connection, bad))["status"] == "queued"
+    assert await redis_connection.llen(QUEUE_KEY) == 1
+
+
+@pytest.mark.asyncio
+async def test_worker_recovers_committed_batch_without_duplicates(redis_connection, sqlite_session):
+    # a previous run committed the batch then died before acknowledging it
+    await ingest_claims(sqlite_session, [claim_row(7), claim_row(8)])
+    worker = make_worker(redis_connection, sqlite_session)
+    await redis_connection.lpush(worker.processing_key, encode_batch("b1", [claim_row(7), claim_row(8), claim_row(9)]))
+
+    assert await worker.recover() == 1
+    assert await worker.run_once() == 1
+    assert await stored_ids(sqlite_session) == [7, 8, 9]
+    total = (await sqlite_session.execute(select(ProviderTotal.claim_count))).scalar_one()
+    assert total == 3
+    assert await redis_connection.llen(worker.processing_key) == 0
+
+
+@pytest.mark.asyncio
+async def test_worker_reloads_the_ranking_missing_a_committed_batch(redis_connection, sqlite_session, monkeypatch):
+    ranking = RedisRanking(redis_connection)
+    await ranking.load(sqlite_session)
+    batch_id = await enqueue_claims(redis_connection, [claim_row(1)])
+    worker = make_worker(redis_connection, sqlite_session, ranking=ranking)
+
+    async def unavailable(claims):
+        raise ConnectionError("ranking unavailable")
+
+    # the claims are committed, then the ranking fails
+    monkeypatch.setattr(ranking, "push_claims", unavailable)
+    assert await worker.run_once() == 1
+    assert (await get_batch_status(redis_connection, batch_id))["status"] == "retrying"
+    monkeypatch.undo()
+
+    # stored again the claim is a duplicate, and the ranking is loaded again with it
+    assert await worker.run_once() == 1
+    status = await get_batch_status(redis_connection, batch_id)
+    assert (status["status"], status["duplicates"]) == ("stored", 1)
+    assert not await ranking.is_loaded()
+    await ranking.load(sqlite_session)
+    assert [(provider.provider_npi, provider.net_fee) for provider in await ranking.get_top_n(1)] == [("1497775530", 10.0)]
+
+
+@pytest.mark.asyncio
+async def test_worker_keeps_the_content_hashes_of_the_request(redis_connection, sqlite_session):
+    # `/claims` hashed the whole request and only queued its second claim, the first one being stored
+    rows = assign_content_hashes([claim_row(1), claim_row(2)])
+    await ingest_claims(sqlite_session, rows[:1])
+    await enqueue_claims(redis_connection, rows[1:])
+    assert await make_worker(redis_connection, sqlite_session).run_once() == 1
+    assert await stored_ids(sqlite_session) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_worker_refuses_the_memory_ranking(monkeypatch):
+    from project.app import worker
+    monkeypatch.setattr(worker.envs, "RANKING_BACKEND", "memory")
+    with pytest.raises(RuntimeError, match="RANKING_BACKEND"):
+        await worker.main([])
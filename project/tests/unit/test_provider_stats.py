@@ -0,0 +1,60 @@
+import math
+import random
+import statistics
+import pytest
+from project.app.models.ddSketch import DDSketch
+from project.app.models.netFeeSummary import NetFeeSummary
+from project.app.services.claim_ingest import ingest_claims
+from project.app.services.provider_stats import fetch_provider_stats, rebuild_provider_stats
+from project.tests.unit.test_ranking import claim_row
+
+
+def exact_quantile(values, q):
+    return sorted(values)[round(q * (len(values) - 1))]
+
+
+def test_summaries_merge_like_one_summary():
+    rng = random.Random(7)
+    # mostly positive fees over several orders of magnitude, some refunds and some zeros
+    values = [rng.lognormvariate(4, 1.5) * (-1 if rng.random() < 0.1 else 1) for _ in range(20000)] + [0.0] * 500
+    rng.shuffle(values)
+    parts = [NetFeeSummary.of(values[start:start + 3000]) for start in range(0, len(values), 3000)]
+    merged = NetFeeSummary()
+    for part in parts:
+        merged.merge(part)
+
+    whole = NetFeeSummary.of(values)
+    assert merged.sketch.counts == whole.sketch.counts
+    stats = merged.as_dict()
+    assert stats["count"] == len(values)
+    assert stats["mean"] == pytest.approx(statistics.fmean(values))
+    assert stats["stddev"] == pytest.approx(statistics.pstdev(values))
+    assert (stats["min"], stats["max"]) == (min(values), max(values))
+    for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        assert stats[name] == pytest.approx(exact_quantile(values, q), rel=0.01)
+    assert len(merged.sketch.counts) < 1000
+
+    with pytest.raises(ValueError):
+        DDSketch(relative_accuracy=0.02).merge(DDSketch())
+
+
+@pytest.mark.asyncio
+async def test_provider_stats_merge_on_ingest_and_rebuild(sqlite_session):
+    rng = random.Random(3)
+    fees = [round(rng.uniform(-50, 500), 2) for _ in range(300)]
+    for start in range(0, len(fees), 100):
+        await ingest_claims(sqlite_session, [claim_row("1111111111", fee) for fee in fees[start:start + 100]])
+    await ingest_claims(sqlite_session, [claim_row("2222222222", 42.0)])
+
+    stats = await fetch_provider_stats(sqlite_session, "1111111111")
+    assert stats["count"] == 300
+    assert stats["mean"] == pytest.approx(statistics.fmean(fees))
+    assert stats["stddev"] == pytest.approx(statistics.pstdev(fees))
+    assert (stats["min"], stats["max"]) == (min(fees), max(fees))
+    assert math.isclose(stats["p50"], exact_quantile(fees, 0.5), rel_tol=0.01)
+    assert await fetch_provider_stats(sqlite_session, "3333333333") is None
+
+    # pages split the claims of the first provider, their summaries are merged like batches
+    assert await rebuild_provider_stats(sqlite_session, page_size=64) == 301
+    assert await fetch_provider_stats(sqlite_session, "1111111111") == pytest.approx(stats)
+    assert (await fetch_provider_stats(sqlite_session, "2222222222"))["p50"] == 42.0
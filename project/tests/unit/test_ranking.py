@@ -0,0 +1,194 @@
+import pytest
+from datetime import date, datetime
+from fakeredis import aioredis
+from project.app.models.models import RankDimension
+from project.app.models.spaceSavingSketch import SpaceSavingSketch
+from project.app.models.topNPriorityQueue import TopNPriorityQueue
+from project.app.services.claim_ingest import ingest_claims
+from project.app.services import ranking as ranking_module
+from project.app.services.ranking import (InProcessRanking, RedisRanking, SketchRanking, create_ranking_backend,
+                                          fetch_top_by_dimension, fetch_top_providers_in_window)
+from project.tests.unit.test_space_saving_sketch import exact_totals, skewed_claims
+
+
+def claim_row(provider_npi, net_fee, service_dttm=datetime(2018, 3, 20)):
+    return {
+        "service_dttm": service_dttm,
+        "submitted_proc": "D0180",
+        "group_id": "GRP-1000",
+        "subscriber_id": "3730189502",
+        "provider_npi": provider_npi,
+        "provider_fees": net_fee,
+        "allowed_fees": 0.0,
+        "member_co_ins": 0.0,
+        "member_co_pay": 0.0,
+        "quadrant": None,
+        "net_fee": net_fee,
+    }
+
+
+def as_pairs(top):
+    return [(element.provider_npi, element.net_fee) for element in top]
+
+
+@pytest.fixture
+def redis_connection():
+    return aioredis.FakeRedis(decode_responses=True)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["memory", "redis", "database"])
+async def test_backends_load_then_track_ingest(backend, sqlite_session, redis_connection):
+    ranking = create_ranking_backend(backend, TopNPriorityQueue(n=10), redis_connection)
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 10.0), claim_row("2222222222", 30.0),
+                                         claim_row("1111111111", 15.0)])
+    await ranking.load(sqlite_session)
+    assert await ranking.is_loaded()
+    assert as_pairs(await ranking.get_top_n(10, session=sqlite_session)) == [("2222222222", 30.0), ("1111111111", 25.0)]
+
+    _, claims = await ingest_claims(sqlite_session, [claim_row("1111111111", 12.0), claim_row("3333333333", 1.0)])
+    await ranking.push_claims(claims)
+    assert as_pairs(await ranking.get_top_n(2, session=sqlite_session)) == [("1111111111", 37.0), ("2222222222", 30.0)]
+
+
+@pytest.mark.asyncio
+async def test_in_process_ranking_reads_database_after_evictions(sqlite_session):
+    ranking = InProcessRanking(TopNPriorityQueue(n=10, capacity=3))
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 10.0), claim_row("2222222222", 20.0),
+                                         claim_row("3333333333", 30.0), claim_row("4444444444", 5.0)])
+    await ranking.load(sqlite_session)
+    assert ranking.pq.evicted_max == 5.0
+    assert as_pairs(await ranking.get_top_n(3, session=sqlite_session)) == [
+        ("3333333333", 30.0), ("2222222222", 20.0), ("1111111111", 10.0)]
+
+    # the evicted provider comes back with a partial total, the ranking falls back to provider_totals
+    _, claims = await ingest_claims(sqlite_session, [claim_row("4444444444", 22.0)])
+    await ranking.push_claims(claims)
+    assert as_pairs(ranking.pq.get_top_n(2)) == [("3333333333", 30.0), ("4444444444", 22.0)]
+    assert as_pairs(await ranking.get_top_n(2, session=sqlite_session)) == [("3333333333", 30.0), ("4444444444", 27.0)]
+
+
+@pytest.mark.asyncio
+async def test_redis_ranking_is_shared_between_workers(redis_connection):
+    worker_1, worker_2 = RedisRanking(redis_connection), RedisRanking(redis_connection)
+    await worker_1.push_claims([{"id": 1, "provider_npi": "1111111111", "net_fee": 5.0}])
+    await worker_2.push_claims([{"id": 2, "provider_npi": "1111111111", "net_fee": 7.0},
+                                {"id": 3, "provider_npi": "2222222222", "net_fee": 1.0}])
+    assert as_pairs(await worker_1.get_top_n(10)) == as_pairs(await worker_2.get_top_n(10)) == [
+        ("1111111111", 12.0), ("2222222222", 1.0)]
+
+
+@pytest.mark.asyncio
+async def test_redis_ranking_seeding_keeps_the_claims_pushed_meanwhile(sqlite_session, redis_connection, monkeypatch):
+    seeding, other_worker = RedisRanking(redis_connection), RedisRanking(redis_connection)
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 10.0)])
+    read_totals = ranking_module.fetch_provider_totals
+
+    async def fetch_provider_totals(session):
+        # committed once the lock is taken: counted by the totals, and logged
+        _, claims = await ingest_claims(sqlite_session, [claim_row("2222222222", 4.0)])
+        await other_worker.push_claims(claims)
+        result = await read_totals(session)
+        # committed after the totals were read: only counted by the log
+        _, claims = await ingest_claims(sqlite_session, [claim_row("1111111111", 7.0), claim_row("3333333333", 1.0)])
+        await other_worker.push_claims(claims)
+        return result
+
+    monkeypatch.setattr(ranking_module, "fetch_provider_totals", fetch_provider_totals)
+    await seeding.load(sqlite_session)
+    assert await seeding.is_loaded() and not await redis_connection.exists(seeding.lock_key)
+    assert as_pairs(await seeding.get_top_n(10)) == [("1111111111", 17.0), ("2222222222", 4.0), ("3333333333", 1.0)]
+
+
+@pytest.mark.asyncio
+async def test_redis_ranking_takes_over_an_expired_seeding(sqlite_session, redis_connection):
+    ranking = RedisRanking(redis_connection, load_timeout=1)
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 10.0)])
+    # a worker died while seeding the sorted set
+    await redis_connection.set(ranking.lock_key, "dead", ex=1)
+    await ranking.load(sqlite_session)
+    assert as_pairs(await ranking.get_top_n(10)) == [("1111111111", 10.0)]
+
+
+@pytest.mark.asyncio
+async def test_sketch_ranking_merges_the_sketches_of_the_workers(sqlite_session):
+    redis_connection = aioredis.FakeRedis()
+    workers = [SketchRanking(SpaceSavingSketch(capacity=100), redis_connection=redis_connection, name=f"worker-{index}")
+               for index in range(2)]
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 50000.0), claim_row("2222222222", 30.0)])
+    for worker in workers:
+        await worker.load(sqlite_session)
+    # disjoint streams of claims, one per worker, with more providers than counters
+    claims = skewed_claims(4000, 1000)
+    for index, (provider_npi, net_fee) in enumerate(claims):
+        await workers[index % 2].push_claims([{"id": index + 10, "provider_npi": provider_npi, "net_fee": net_fee}])
+    for worker in workers:
+        await worker.publish()
+    totals = exact_totals([("1111111111", 50000.0), ("2222222222", 30.0), *claims])
+
+    top = await workers[0].get_top_n_with_errors(10)
+    assert top == await workers[1].get_top_n_with_errors(10)
+    assert top[0][0] == "1111111111"
+    merged = await workers[0].merged_sketch()
+    assert merged.total_weight == pytest.approx(sum(totals.values()))
+    for provider_npi, estimate, error, _ in top:
+        assert estimate - error - 1e-6 <= totals[provider_npi] <= estimate + 1e-6
+        assert error <= merged.error_bound() + 1e-6
+
+    # a worker shutting down folds its sketch into the base
+    await workers[1].retire()
+    assert list(await redis_connection.hkeys("ranking:sketch:workers")) == [b"worker-0"]
+    assert (await workers[0].merged_sketch()).total_weight == pytest.approx(sum(totals.values()))
+
+    # once the totals are rebuilt the shared sketch is seeded again from the database, without the claims of
+    # the workers (which were never stored here)
+    await workers[0].reset_shared()
+    await workers[0].unload()
+    assert not await workers[0].is_loaded()
+    await workers[0].load(sqlite_session)
+    assert (await workers[0].merged_sketch()).total_weight == pytest.approx(50030.0)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_ranking_backend("memcached", TopNPriorityQueue(n=10), None)
+
+
+def test_in_process_backend_wraps_queue():
+    pq = TopNPriorityQueue(n=10)
+    assert create_ranking_backend("memory", pq, None).pq is pq
+    assert isinstance(create_ranking_backend("memory", pq, None), InProcessRanking)
+
+
+@pytest.mark.asyncio
+async def test_top_providers_in_window(sqlite_session):
+    await ingest_claims(sqlite_session, [
+        claim_row("1111111111", 50.0, datetime(2018, 1, 15, 10)),
+        claim_row("2222222222", 20.0, datetime(2018, 3, 1)),
+        claim_row("2222222222", 20.0, datetime(2018, 3, 31, 23, 59)),
+        claim_row("3333333333", 30.0, datetime(2018, 4, 1)),
+    ])
+    top = await fetch_top_providers_in_window(sqlite_session, date(2018, 3, 1), date(2018, 3, 31))
+    assert as_pairs(top) == [("2222222222", 40.0)]
+    top = await fetch_top_providers_in_window(sqlite_session, date(2018, 1, 1), date(2018, 12, 31), n=2)
+    assert as_pairs(top) == [("1111111111", 50.0), ("2222222222", 40.0)]
+
+
+@pytest.mark.asyncio
+async def test_top_by_dimension(sqlite_session):
+    rows = [
+        {**claim_row("1000000001", 50.0, datetime(2018, 3, 1)), "group_id": "GRP-2", "quadrant": "UR"},
+        {**claim_row("1000000002", 40.0, datetime(2018, 3, 2)), "group_id": "GRP-2", "quadrant": None},
+        claim_row("1000000001", 30.0, datetime(2018, 3, 20)),
+        claim_row("1000000003", 20.0, datetime(2018, 3, 20)),
+    ]
+    await ingest_claims(sqlite_session, rows)
+
+    assert await fetch_top_by_dimension(sqlite_session, RankDimension.group_id) == [("GRP-2", 90.0), ("GRP-1000", 50.0)]
+    assert await fetch_top_by_dimension(sqlite_session, RankDimension.quadrant, n=1) == [(None, 90.0)]
+    top = await fetch_top_by_dimension(sqlite_session, RankDimension.provider_npi, {"group_id": "GRP-1000"})
+    assert top == [("1000000001", 30.0), ("1000000003", 20.0)]
+    # windows are answered from the claims, the rollup has no service date
+    window = (date(2018, 3, 2), date.max)
+    top = await fetch_top_by_dimension(sqlite_session, RankDimension.provider_npi, {"group_id": "GRP-2"}, window=window)
+    assert top == [("1000000002", 40.0)]
@@ -0,0 +1,47 @@
+import pytest
+from fakeredis import aioredis
+from project.app.models.commitWatermark import CommitWatermark
+from project.app.models.topNPriorityQueue import TopNPriorityQueue
+from project.app.services.claim_ingest import ingest_claims
+from project.app.services.ranking import InProcessRanking
+from project.app.services.ranking_snapshot import (FileSnapshotStore, RedisSnapshotStore, decode_snapshot,
+                                                   encode_snapshot, restore_snapshot, take_snapshot)
+from project.tests.unit.test_ranking import as_pairs, claim_row
+
+
+def test_snapshot_round_trip():
+    totals = [("1111111111", 25.5), ("2222222222", -3.0), ("A" * 40, 1e9)]
+    watermark = CommitWatermark(100, 120, frozenset({104, 117}))
+    assert decode_snapshot(encode_snapshot(totals, watermark)) == (totals, watermark)
+    assert decode_snapshot(encode_snapshot([], CommitWatermark(max_id=42))) == ([], CommitWatermark(max_id=42))
+    with pytest.raises(ValueError):
+        decode_snapshot(b"not a snapshot")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["file", "redis"])
+async def test_restore_catches_up_with_claims_after_snapshot(backend, sqlite_session, tmp_path):
+    if backend == "file":
+        store = FileSnapshotStore(str(tmp_path / "ranking.snapshot"))
+    else:
+        store = RedisSnapshotStore(aioredis.FakeRedis())
+    ranking = InProcessRanking(TopNPriorityQueue(n=10))
+    assert await restore_snapshot(ranking, sqlite_session, store) is False
+    assert not await ranking.is_loaded()
+
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 10.0), claim_row("2222222222", 30.0)])
+    assert await take_snapshot(sqlite_session, store) == 2
+    await ingest_claims(sqlite_session, [claim_row("1111111111", 25.0), claim_row("3333333333", 1.0)])
+
+    assert await restore_snapshot(ranking, sqlite_session, store) is True
+    assert await ranking.is_loaded()
+    assert as_pairs(await ranking.get_top_n(10)) == [("1111111111", 35.0), ("2222222222", 30.0), ("3333333333", 1.0)]
+    assert ranking.pq.watermark == CommitWatermark(max_id=4)
+
+
+@pytest.mark.asyncio
+async def test_file_store_takes_turns(tmp_path):
+    store = FileSnapshotStore(str(tmp_path / "ranking.snapshot"))
+    assert await store.claim_turn(60)
+    await store.save(encode_snapshot([], CommitWatermark()))
+    assert not await store.claim_turn(60)
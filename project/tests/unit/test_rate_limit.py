@@ -0,0 +1,107 @@
+import asyncio
+import math
+import pytest
+from fakeredis import aioredis
+from fastapi import Depends, FastAPI, Request
+from fastapi.testclient import TestClient
+from project.app.services.rate_limit import RateLimit, RateLimiter
+
+
+class FakeClock:
+    def __init__(self, now=6000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_bucket_limits_without_redis_round_trips():
+    redis_connection = aioredis.FakeRedis()
+    clock = FakeClock(6054.0)
+    limiter = RateLimiter(redis_connection, sync_interval=3600, sync_batch=1000, clock=clock)
+    assert [await limiter.hit("/top", "a", times=10, seconds=60) for _ in range(10)] == [0.0] * 10
+    # the window ends at 6060
+    assert await limiter.hit("/top", "a", times=10, seconds=60) == pytest.approx(6.0)
+    assert await limiter.hit("/top", "b", times=10, seconds=60) == 0.0
+    assert await redis_connection.keys("ratelimit:*") == []
+    # a new window, but the bucket only got one token back, not a burst of 10
+    clock.now = 6060.0
+    assert await limiter.hit("/top", "a", times=10, seconds=60) == 0.0
+    assert await limiter.hit("/top", "a", times=10, seconds=60) == pytest.approx(6.0)
+
+
+@pytest.mark.asyncio
+async def test_workers_share_the_window_through_redis():
+    redis_connection = aioredis.FakeRedis()
+    clock = FakeClock()
+    workers = [RateLimiter(redis_connection, sync_interval=3600, sync_batch=5, clock=clock) for _ in range(2)]
+    # `hit` completes without ever suspending, i.e. without waiting for Redis, and asks `run` for a sync
+    # once 5 units are pending
+    with pytest.raises(StopIteration) as admitted:
+        workers[0].hit("/claims", "a", times=8, seconds=60, cost=4).send(None)
+    assert admitted.value.value == 0.0 and not workers[0].sync_needed.is_set()
+    assert await workers[0].hit("/claims", "a", times=8, seconds=60) == 0.0
+    assert workers[0].sync_needed.is_set() and await redis_connection.keys("ratelimit:*") == []
+    await workers[0].sync()
+    # the usage of the other workers is only seen after a sync
+    assert await workers[1].hit("/claims", "a", times=8, seconds=60, cost=5) == 0.0
+    await workers[1].sync()
+    assert int(await redis_connection.get("ratelimit:/claims:a:100")) == 10
+    assert await workers[1].hit("/claims", "a", times=8, seconds=60) == pytest.approx(60.0)
+    assert await workers[0].hit("/claims", "a", times=8, seconds=60) == 0.0
+    await workers[0].sync()
+    assert await workers[0].hit("/claims", "a", times=8, seconds=60) == pytest.approx(60.0)
+    # a batch larger than the limit is never admitted
+    assert await workers[1].hit("/claims", "a", times=8, seconds=60, cost=9) == math.inf
+    clock.now += 60
+    assert await workers[1].hit("/claims", "a", times=8, seconds=60, cost=8) == 0.0
+    # the clients idle for a whole window are dropped at the next sync
+    clock.now += 120
+    await workers[0].sync()
+    assert workers[0].states == {} and workers[0].pending == 0
+
+
+@pytest.mark.asyncio
+async def test_run_syncs_in_the_background():
+    redis_connection = aioredis.FakeRedis()
+    limiter = RateLimiter(redis_connection, sync_interval=3600, sync_batch=2, clock=FakeClock())
+    task = asyncio.create_task(limiter.run())
+    try:
+        assert await limiter.hit("/claims", "a", times=8, seconds=60, cost=2) == 0.0
+        for _ in range(100):
+            if limiter.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert int(await redis_connection.get("ratelimit:/claims:a:100")) == 2
+        assert not limiter.sync_needed.is_set()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_rate_limit_dependency_answers_429():
+    limiter = RateLimiter(aioredis.FakeRedis(), sync_interval=0, clock=FakeClock())
+    app = FastAPI()
+
+    @app.get("/limited", dependencies=[Depends(RateLimit(limiter, times=2, seconds=60))])
+    async def limited():
+        return {}
+
+    batch_limit = RateLimit(limiter, times=5, seconds=60, route="/batches")
+
+    @app.post("/batches")
+    async def batches(request: Request):
+        await batch_limit.hit(request, cost=len(await request.json()))
+        return {}
+
+    client = TestClient(app)
+    assert [client.get("/limited").status_code for _ in range(3)] == [200, 200, 429]
+    assert client.get("/limited").headers["Retry-After"] == "60"
+    assert client.get("/limited", headers={"X-Forwarded-For": "10.0.0.2, 10.0.0.1"}).status_code == 200
+    assert client.post("/batches", json=[1, 2, 3]).status_code == 200
+    assert client.post("/batches", json=[1, 2, 3]).status_code == 429
+    # a batch larger than the whole limit could never be admitted
+    response = client.post("/batches", json=[1] * 6, headers={"X-Forwarded-For": "10.0.0.3"})
+    assert response.status_code == 413 and "Retry-After" not in response.headers
+    assert response.json()["detail"] == "The request costs 6 units, more than the limit of 5 per 60 seconds: split it"
@@ -0,0 +1,53 @@
+import gzip
+import json
+import zstandard
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from project.app.services.request_compression import RequestDecompressionMiddleware
+
+
+def create_client(max_size=10 * 1024 * 1024, max_ratio=50):
+    app = FastAPI()
+    app.add_middleware(RequestDecompressionMiddleware, max_size=max_size, max_ratio=max_ratio)
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        chunks = [len(chunk) async for chunk in request.stream()]
+        return {"size": sum(chunks), "chunks": len(chunks), "encoding": request.headers.get("content-encoding")}
+
+    @app.post("/json")
+    async def read_json(request: Request):
+        return await request.json()
+
+    return TestClient(app)
+
+
+def test_bodies_are_decompressed_as_they_stream_in():
+    client = create_client()
+    claims = [{"provider_npi": f"{i:010d}", "net_fee": i} for i in range(20000)]
+    body = json.dumps(claims).encode()
+    for encoding, compressed in (("gzip", gzip.compress(body)), ("zstd", zstandard.ZstdCompressor().compress(body)),
+                                 ("gzip", gzip.compress(body[:1000]) + gzip.compress(body[1000:]))):
+        response = client.post("/json", content=compressed, headers={"Content-Encoding": encoding})
+        assert response.json() == claims
+    response = client.post("/echo", content=gzip.compress(body), headers={"Content-Encoding": "gzip"})
+    assert response.json()["size"] == len(body)
+    assert response.json()["chunks"] > 1
+    assert response.json()["encoding"] is None
+    assert client.post("/json", json=[1, 2]).json() == [1, 2]
+
+
+def test_invalid_and_oversized_bodies_are_rejected():
+    client = create_client(max_size=4 * 1024 * 1024)
+    assert client.post("/echo", content=b"abc", headers={"Content-Encoding": "br"}).status_code == 415
+    assert client.post("/echo", content=b"not gzip", headers={"Content-Encoding": "gzip"}).status_code == 400
+    assert client.post("/echo", content=gzip.compress(b"[1, 2]")[:-4], headers={"Content-Encoding": "gzip"}).status_code == 400
+    # zip bombs: the ratio check stops them before the size limit is reached
+    bomb = gzip.compress(b"0" * 3 * 1024 * 1024)
+    response = client.post("/echo", content=bomb, headers={"Content-Encoding": "gzip"})
+    assert (response.status_code, response.json()["detail"]) == (413, "Body compressed more than 50 times")
+    response = create_client(max_size=1024).post("/echo", content=gzip.compress(b"1" * 2048),
+                                                 headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 413
+    bomb = zstandard.ZstdCompressor().compress(b"0" * 3 * 1024 * 1024)
+    assert client.post("/echo", content=bomb, headers={"Content-Encoding": "zstd"}).status_code == 413
@@ -0,0 +1,107 @@
+import asyncio
+import pytest
+from fakeredis import aioredis
+from project.app.services.response_cache import RANKING_VERSION_KEY, RankingResponseCache, bump_ranking_version
+
+
+def counting(response, delay=0.0):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return response
+
+    return compute, calls
+
+
+@pytest.mark.asyncio
+async def test_caches_until_invalidated():
+    cache = RankingResponseCache(aioredis.FakeRedis(decode_responses=True))
+    compute, calls = counting([{"provider_npi": "1497775530", "net_fee": 10.0}])
+    assert (await cache.get_or_compute("/top-provider?n=10", compute))[1] == "miss"
+    assert await cache.get_or_compute("/top-provider?n=10", compute) == \
+        ([{"provider_npi": "1497775530", "net_fee": 10.0}], "hit")
+    assert (await cache.get_or_compute("/top-provider?n=5", compute))[1] == "miss"
+    await cache.invalidate()
+    assert (await cache.get_or_compute("/top-provider?n=10", compute))[1] == "miss"
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_are_coalesced():
+    redis_connection = aioredis.FakeRedis(decode_responses=True)
+    caches = [RankingResponseCache(redis_connection, poll_interval=0.01) for _ in range(5)]
+    compute, calls = counting(["top"], delay=0.05)
+    results = await asyncio.gather(*(cache.get_or_compute("/top-provider", compute) for cache in caches))
+    assert len(calls) == 1
+    assert sorted(result for _, result in results) == ["coalesced"] * 4 + ["miss"]
+    assert all(response == ["top"] for response, _ in results)
+
+
+@pytest.mark.asyncio
+async def test_listen_follows_the_invalidations():
+    redis_connection = aioredis.FakeRedis(decode_responses=True)
+    await redis_connection.set(RANKING_VERSION_KEY, 3)
+    cache = RankingResponseCache(redis_connection)
+    listener = asyncio.create_task(cache.listen())
+    try:
+        for _ in range(100):
+            if cache.version == 3:
+                break
+            await asyncio.sleep(0.01)
+        assert cache.version == 3
+        # bumped by another worker
+        await bump_ranking_version(redis_connection)
+        for _ in range(100):
+            if cache.version == 4:
+                break
+            await asyncio.sleep(0.01)
+        assert await cache.current_version() == 4
+    finally:
+        listener.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await listener
+
+
+@pytest.mark.asyncio
+async def test_listen_resets_the_rankings():
+    redis_connection = aioredis.FakeRedis(decode_responses=True)
+    cache = RankingResponseCache(redis_connection)
+    resets = []
+
+    async def reset():
+        resets.append(cache.version)
+
+    cache.reset_handlers.append(reset)
+    listener = asyncio.create_task(cache.listen())
+    try:
+        for _ in range(100):
+            if cache.reset_version is not None:
+                break
+            await asyncio.sleep(0.01)
+        await bump_ranking_version(redis_connection)
+        await bump_ranking_version(redis_connection, reset=True)
+        for _ in range(100):
+            if resets:
+                break
+            await asyncio.sleep(0.01)
+        assert resets == [2] and cache.reset_version == 2
+    finally:
+        listener.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await listener
+
+    # a reset published while the worker was not subscribed is found when it subscribes again
+    await bump_ranking_version(redis_connection, reset=True)
+    listener = asyncio.create_task(cache.listen())
+    try:
+        for _ in range(100):
+            if len(resets) == 2:
+                break
+            await asyncio.sleep(0.01)
+        assert resets == [2, 3]
+    finally:
+        listener.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await listener
@@ -0,0 +1,69 @@
+import random
+import pytest
+from project.app.models.commitWatermark import CommitWatermark
+from project.app.models.spaceSavingSketch import SpaceSavingSketch
+from project.app.models.topNPriorityQueue import TopNPriorityQueue
+from project.app.models.models import ClaimTopProvider
+
+
+def exact_totals(claims):
+    totals = {}
+    for provider_npi, net_fee in claims:
+        totals[provider_npi] = totals.get(provider_npi, 0.0) + net_fee
+    return totals
+
+
+def skewed_claims(count, providers, seed=7):
+    rng = random.Random(seed)
+    # a few heavy providers among many light ones
+    return [(f"{rng.randrange(10) if rng.random() < 0.3 else rng.randrange(providers):010d}", rng.uniform(1, 100))
+            for _ in range(count)]
+
+
+def test_exact_while_counters_are_left():
+    sketch = SpaceSavingSketch(capacity=10)
+    for provider_npi, net_fee in [("a", 5.0), ("b", 7.0), ("a", 4.0), ("c", 1.0)]:
+        sketch.push(provider_npi, net_fee)
+    assert sketch.get_top_n(2) == [("a", 9.0, 0.0, True), ("b", 7.0, 0.0, True)]
+
+
+def test_bounds_hold_with_fixed_memory():
+    claims = skewed_claims(20000, 5000)
+    sketch = SpaceSavingSketch(capacity=200)
+    for provider_npi, net_fee in claims:
+        sketch.push(provider_npi, net_fee)
+    assert len(sketch) == 200
+    totals = exact_totals(claims)
+    for provider_npi, estimate, error, guaranteed in sketch.get_top_n(20):
+        assert estimate - error - 1e-6 <= totals[provider_npi] <= estimate + 1e-6
+        assert error <= sketch.error_bound() + 1e-6
+    exact = TopNPriorityQueue(n=10)
+    for provider_npi, net_fee in claims:
+        exact.push(ClaimTopProvider(provider_npi, net_fee))
+    guaranteed = [provider_npi for provider_npi, _, _, is_guaranteed in sketch.get_top_n(10) if is_guaranteed]
+    assert set(guaranteed) <= {provider.provider_npi for provider in exact.get_top_n(10)}
+
+
+def test_merge_of_disjoint_streams():
+    claims = skewed_claims(20000, 5000)
+    left, right = SpaceSavingSketch(capacity=300), SpaceSavingSketch(capacity=300)
+    for index, (provider_npi, net_fee) in enumerate(claims):
+        (left if index % 2 else right).push(provider_npi, net_fee)
+    merged = SpaceSavingSketch.from_bytes(left.to_bytes()).merge(SpaceSavingSketch.from_bytes(right.to_bytes()))
+    assert len(merged) == 300
+    assert merged.total_weight == pytest.approx(sum(net_fee for _, net_fee in claims))
+    totals = exact_totals(claims)
+    for provider_npi, estimate, error, _ in merged.get_top_n(20):
+        assert estimate - error - 1e-6 <= totals[provider_npi] <= estimate + 1e-6
+
+
+def test_load_replays_only_claims_after_watermark():
+    sketch = SpaceSavingSketch(capacity=10)
+    sketch.begin_load()
+    sketch.push("a", 1.0, position=(0, 5))  # already counted by the load
+    sketch.push("b", 2.0, position=(0, 7))
+    sketch.load_totals([("a", 10.0)])
+    sketch.load_totals([("b", 3.0)])
+    sketch.end_load(CommitWatermark(max_id=6))
+    assert sketch.loaded
+    assert [(key, estimate) for key, estimate, _, _ in sketch.get_top_n(10)] == [("a", 10.0), ("b", 5.0)]
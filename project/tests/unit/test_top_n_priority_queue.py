@@ -0,0 +1,114 @@
+import random
+from project.app.models.commitWatermark import CommitWatermark
+from project.app.models.models import ClaimTopProvider
+from project.app.models.topNPriorityQueue import TopNPriorityQueue
+
+
+def as_pairs(top):
+    return [(element.provider_npi, element.net_fee) for element in top]
+
+
+def test_push_accumulates_per_provider():
+    pq = TopNPriorityQueue(n=2)
+    pq.push(ClaimTopProvider("1111111111", 10.0))
+    pq.push(ClaimTopProvider("2222222222", 15.0))
+    pq.push(ClaimTopProvider("1111111111", 10.0))
+    pq.push(ClaimTopProvider("3333333333", 1.0))
+    assert as_pairs(pq.get_top_n()) == [("1111111111", 20.0), ("2222222222", 15.0)]
+
+
+def test_negative_net_fee_moves_provider_down():
+    pq = TopNPriorityQueue(n=3)
+    for npi, fee in [("a", 5.0), ("b", 4.0), ("c", 3.0), ("a", -4.5)]:
+        pq.push(ClaimTopProvider(npi, fee))
+    assert as_pairs(pq.get_top_n()) == [("b", 4.0), ("c", 3.0), ("a", 0.5)]
+
+
+def test_matches_brute_force():
+    rng = random.Random(7)
+    pq = TopNPriorityQueue(n=10)
+    totals = {}
+    for _ in range(5000):
+        npi, fee = f"{rng.randrange(300):010d}", rng.uniform(-20, 100)
+        totals[npi] = totals.get(npi, 0.0) + fee
+        pq.push(ClaimTopProvider(npi, fee))
+    expected = sorted(totals.values(), reverse=True)[:10]
+    assert [element.net_fee for element in pq.get_top_n()] == expected
+    assert len(pq) == len(totals)
+
+
+def test_capacity_evicts_lowest_totals():
+    pq = TopNPriorityQueue(n=3, capacity=10)
+    for i in range(11):
+        pq.push(ClaimTopProvider(str(i), float(i)))
+    assert len(pq) == 9
+    assert pq.evicted_max == 1.0
+    assert as_pairs(pq.get_top_n()) == [("10", 10.0), ("9", 9.0), ("8", 8.0)]
+
+
+def test_exact_top_n_accounts_for_evicted_providers():
+    pq = TopNPriorityQueue(n=3, capacity=10)
+    for i in range(11):
+        pq.push(ClaimTopProvider(str(i), float(i)))
+    assert as_pairs(pq.get_exact_top_n()) == [("10", 10.0), ("9", 9.0), ("8", 8.0)]
+    pq.push(ClaimTopProvider("1", 7.5))  # evicted with 1.0, back with a partial total of 7.5 out of 8.5
+    assert pq.partial == {"1"}
+    assert pq.get_exact_top_n() is None
+    assert as_pairs(pq.get_exact_top_n(2)) == [("10", 10.0), ("9", 9.0)]
+
+
+def test_negative_evictions_are_tracked():
+    pq = TopNPriorityQueue(n=1, capacity=2)
+    for npi, fee in (("a", -5.0), ("b", -10.0), ("c", -20.0)):
+        pq.push(ClaimTopProvider(npi, fee))
+    assert pq.evicted_max == -10.0
+    pq.push(ClaimTopProvider("c", 30.0))  # evicted with -20.0, back with a partial total of 30.0 out of 10.0
+    assert pq.partial == {"c"}
+    assert pq.get_exact_top_n() is None
+    pq.push(ClaimTopProvider("a", 50.0))
+    assert as_pairs(pq.get_exact_top_n()) == [("a", 45.0)]
+
+
+def test_load_replays_only_claims_after_watermark():
+    pq = TopNPriorityQueue(n=10)
+    pq.push(ClaimTopProvider("a", 100.0), position=(0, 1))  # replaced by the load
+    pq.begin_load()
+    pq.push(ClaimTopProvider("a", 1.0), position=(0, 5))  # already counted by the load
+    pq.push(ClaimTopProvider("b", 2.0), position=(0, 7))  # committed after the load query
+    assert pq.is_empty() is False and pq.loaded is False
+    pq.load([("a", 10.0), ("b", 3.0)], CommitWatermark(max_id=6))
+    assert pq.loaded
+    assert as_pairs(pq.get_top_n()) == [("a", 10.0), ("b", 5.0)]
+
+
+def test_load_replays_claims_committed_after_watermark_with_lower_ids():
+    # the load query saw transactions 101 and 103 running, and none from 105 on
+    watermark = CommitWatermark(101, 105, frozenset({101, 103}))
+    pq = TopNPriorityQueue(n=10)
+    pq.begin_load()
+    pq.push(ClaimTopProvider("a", 1.0), position=(100, 9))  # committed before the load query
+    pq.push(ClaimTopProvider("a", 2.0), position=(102, 8))  # committed before the load query
+    pq.push(ClaimTopProvider("b", 4.0), position=(101, 3))  # reserved its id first, committed last
+    pq.push(ClaimTopProvider("c", 8.0), position=(103, 5))
+    pq.push(ClaimTopProvider("c", 16.0), position=(106, 10))
+    pq.load([("a", 3.0)], watermark)
+    assert as_pairs(pq.get_top_n()) == [("c", 24.0), ("b", 4.0), ("a", 3.0)]
+    assert [watermark.counts(xid, 1) for xid in (0, 100, 101, 102, 103, 104, 105)] == [True, True, False, True,
+                                                                                      False, True, False]
+
+
+def test_abort_load_applies_buffered_claims():
+    pq = TopNPriorityQueue(n=10)
+    pq.begin_load()
+    pq.push(ClaimTopProvider("a", 1.0), position=(0, 1))
+    pq.abort_load()
+    assert not pq.loaded
+    assert as_pairs(pq.get_top_n()) == [("a", 1.0)]
+
+
+def test_memory_bytes_grows_with_providers():
+    pq = TopNPriorityQueue(n=10)
+    empty = pq.memory_bytes()
+    for index in range(100):
+        pq.push(ClaimTopProvider(f"{index:010d}", 1.0))
+    assert pq.memory_bytes() > empty + 100 * 59